@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+from hpit.server.app import ServerApp
+app_instance = ServerApp.get_instance()
+app = app_instance.app
+
+from hpit.management.settings_manager import SettingsManager
+settings = SettingsManager.get_server_settings()
+
+class Command:
+    description = "Moves delivered messages and responses into their daily (or weekly) archive collections."
+
+    def __init__(self, manager, parser):
+        self.manager = manager
+
+        parser.add_argument("--drop-older-than", type=int, dest="drop_days",
+            default=getattr(settings, 'ARCHIVE_RETENTION_DAYS', None),
+            help="Drop archive collections older than this many days.")
+
+    def run(self, arguments, configuration):
+        self.arguments = arguments
+        self.configuration = configuration
+
+        archives = [app_instance.sent_messages_archive, app_instance.sent_responses_archive]
+
+        with app.app_context():
+            for archive in archives:
+                moved = archive.archive()
+                print("Archived " + str(moved) + " documents from " + archive.hot_collection + ".")
+
+                if arguments.drop_days is not None:
+                    for name in archive.drop_before(datetime.now() - timedelta(days=arguments.drop_days)):
+                        print("Dropped " + name + ".")
+
+        print("DONE! - Archived the delivered messages and responses.")
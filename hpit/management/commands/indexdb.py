@@ -10,6 +10,29 @@ from hpit.management.settings_manager import SettingsManager
 settings = SettingsManager.get_server_settings()
 plugin_settings = SettingsManager.get_plugin_settings()
 
+#The date field each collection's documents expire on.
+RETENTION_FIELDS = {
+    'plugin_messages': 'time_created',
+    'responses': 'time_created',
+    'sent_messages_and_transactions': 'time_received',
+    'sent_responses': 'time_response_received',
+    'entity_log': 'created_on',
+    'dead_letter_messages': 'time_created',
+    'idempotency_keys': 'time_created',
+}
+
+#Seconds to keep documents in each collection. None keeps them forever. 
+#Overridden per collection by MONGO_RETENTION in settings.json.
+DEFAULT_RETENTION = {
+    'plugin_messages': 60 * 60 * 24,
+    'responses': 60 * 60 * 24,
+    'sent_messages_and_transactions': None,
+    'sent_responses': None,
+    'entity_log': 60 * 60 * 24 * 7,
+    'dead_letter_messages': 60 * 60 * 24 * 7,
+    'idempotency_keys': 60 * 60,
+}
+
 
 class Command:
     description = "Indexes the Mongo Database."
@@ -17,6 +40,26 @@ class Command:
     def __init__(self, manager, parser):
         self.manager = manager
 
+    def retention(self):
+        retention = dict(DEFAULT_RETENTION)
+        retention.update(getattr(settings, 'MONGO_RETENTION', {}))
+        return retention
+
+    def create_ttl_index(self, collection, field, seconds):
+        """
+        Creates an index on field that expires documents after seconds (or a plain
+        index if seconds is None), replacing an existing index on the field that
+        has a different expiry.
+        """
+        for name, index in collection.index_information().items():
+            if index['key'] == [(field, 1)] and index.get('expireAfterSeconds') != seconds:
+                collection.drop_index(name)
+
+        if seconds is None:
+            collection.create_index(field)
+        else:
+            collection.create_index(field, expireAfterSeconds=seconds)
+
     def run(self, arguments, configuration):
         self.arguments = arguments
         self.configuration = configuration
@@ -24,15 +67,58 @@ class Command:
         #server dbs
         with app.app_context():
             mongo.db.plugin_messages.create_index('receiver_entity_id')
+            mongo.db.plugin_messages.create_index([
+                ('receiver_entity_id', 1),
+                ('claim_token', 1),
+                ('_id', 1)
+            ])
+            mongo.db.plugin_messages.create_index([
+                ('receiver_entity_id', 1),
+                ('priority', -1),
+                ('_id', 1)
+            ])
+            mongo.db.plugin_messages.create_index('claim_token')
+            mongo.db.plugin_messages.create_index([
+                ('receiver_entity_id', 1),
+                ('lease_expires', 1)
+            ])
+            mongo.db.plugin_messages.create_index([
+                ('receiver_entity_id', 1),
+                ('message_id', 1)
+            ])
             mongo.db.plugin_transactions.create_index('receiver_entity_id')
+            mongo.db.dead_letter_messages.create_index('receiver_entity_id')
+            mongo.db.idempotency_keys.create_index([
+                ('sender_entity_id', 1),
+                ('idempotency_key', 1)
+            ], unique=True)
+            mongo.db.messages_and_transactions.create_index('ancestors')
+
+            mongo.db.metric_counters.create_index([
+                ('metric', 1),
+                ('granularity', 1),
+                ('time', 1)
+            ], unique=True)
+            mongo.db.metric_counters.create_index('expires', expireAfterSeconds=0)
 
-            mongo.db.sent_messages_and_transactions.create_index('time_received')
-            #mongo.db.sent_responses.create_index('time_response_received')
+            #expire old documents
+            for collection, seconds in self.retention().items():
+                self.create_ttl_index(mongo.db[collection], RETENTION_FIELDS[collection], seconds)
 
             mongo.db.sent_messages_and_transactions.create_index([
                 ("receiver_entity_id", -1),
                 ("message_id", 1)
             ])
+            mongo.db.sent_messages_and_transactions.create_index([
+                ("receiver_entity_id", 1),
+                ("time_received", 1),
+                ("_id", 1)
+            ])
+            mongo.db.entity_log.create_index([
+                ("entity_id", 1),
+                ("created_on", 1),
+                ("_id", 1)
+            ])
             mongo.db.responses.create_index([
                     ('receiver_entity_id',1),
                     ('session_token',1)
@@ -51,5 +137,11 @@ class Command:
             ('sender_entity_id', 1)
         ])
         plugin_db.hpit_knowledge_tracing.create_index('student_id')
+        plugin_db.hpit_problems_worked.create_index('student_id')
+        plugin_db.hpit_steps.create_index('problem_id')
+        plugin_db.hpit_boredom_detection.create_index([
+            ('student_id', 1),
+            ('time', -1)
+        ])
 
         print("DONE! - Indexed the mongo database.")
\ No newline at end of file
@@ -0,0 +1,26 @@
+from hpit.server.app import ServerApp
+app_instance = ServerApp.get_instance()
+app = app_instance.app
+
+class Command:
+    description = "Adds the responses received since the last run to the hourly report rollups."
+
+    def __init__(self, manager, parser):
+        self.manager = manager
+
+        parser.add_argument("--rebuild", action="store_true",
+            help="Recompute the rollups from every stored response.")
+
+    def run(self, arguments, configuration):
+        self.arguments = arguments
+        self.configuration = configuration
+
+        rollups = app_instance.response_rollups
+
+        with app.app_context():
+            if arguments.rebuild:
+                rollups.rebuild()
+
+            processed = rollups.run()
+
+        print("DONE! - Rolled up " + str(processed) + " responses.")
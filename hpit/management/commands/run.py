@@ -14,4 +14,4 @@ class Command:
         self.args = args
         self.configuration = configuration
 
-        app.run(port=int(settings.HPIT_BIND_PORT), host=settings.HPIT_BIND_IP)
+        app.run(port=int(settings.HPIT_BIND_PORT), host=settings.HPIT_BIND_IP, threaded=True)
@@ -1,4 +1,6 @@
 import os
+from sqlalchemy import inspect
+
 from hpit.server.app import ServerApp
 app_instance = ServerApp.get_instance()
 app = app_instance.app
@@ -8,17 +10,32 @@ mongo = app_instance.mongo
 from hpit.management.settings_manager import SettingsManager
 settings = SettingsManager.get_server_settings()
 
+#Columns added to existing tables since they were first created, as
+#(table, column, column type). create_all() only creates missing tables.
+ADDED_COLUMNS = [
+    ('plugin', 'max_queue_depth', 'INTEGER'),
+]
+
 class Command:
-    description = "Creates all the tables in the database."
+    description = "Creates all the tables in the database and adds columns missing from existing ones."
     
     def __init__(self, manager, parser):
         self.manager = manager
 
+    def add_missing_columns(self):
+        inspector = inspect(db.engine)
+
+        for table, column, column_type in ADDED_COLUMNS:
+            if column not in [c['name'] for c in inspector.get_columns(table)]:
+                db.engine.execute('ALTER TABLE ' + table + ' ADD COLUMN ' + column + ' ' + column_type)
+                print("Added column " + table + "." + column)
+
     def run(self, arguments, configuration):
         self.arguments = arguments
         self.configuration = configuration
 
         db.create_all()
+        self.add_missing_columns()
 
         with app.app_context():
             mongo.db.plugin_messages.create_index('receiver_entity_id')
@@ -94,9 +94,32 @@ class EntityManager:
         self.write_configuration(configuration)
         
         
+    def entity_replicas(self, entity):
+        """
+        The number of processes to run for an entity, as specified in configuration
+        """
+        
+        return max(int(entity.get('replicas', 1)), 1)
+
+
+    def entity_pidfile(self, name, entity_type, entity_id, replica):
+        """
+        The pidfile for one replica of an entity. The first replica keeps the
+        historical, unnumbered pidfile name.
+        """
+        
+        pidfile = name + "_" + entity_type + '_' + entity_id
+        if replica:
+            pidfile += '_' + str(replica)
+
+        return os.path.join('tmp', pidfile + '.pid')
+
+
     def spin_up_entity(self, entity, entity_type):
         """
-        Start an entity, as specified in configuration
+        Start an entity, as specified in configuration. Plugins with a 'replicas'
+        setting are started that many times; the processes share the plugin's
+        queue and each message is handed to only one of them.
         """
         
         entity_subtype = entity['type']
@@ -119,15 +142,20 @@ class EntityManager:
             
         subp_args.extend([entity_id, api_key, entity_type, entity_subtype, name])
         
-        print("Starting entity: " + name + " ID#: " + entity_id)
+        for replica in range(0, self.entity_replicas(entity)):
+            print("Starting entity: " + name + " ID#: " + entity_id + " Replica#: " + str(replica))
 
-        with open("log/output_"+name+"_"+entity_type+"_"+entity_subtype+".txt","w") as f:
-            subp = subprocess.Popen(subp_args, stdout = f, stderr = f)
+            output = "log/output_"+name+"_"+entity_type+"_"+entity_subtype
+            if replica:
+                output += "_" + str(replica)
 
-        pidfile = os.path.join('tmp', name+"_"+ entity_type + '_' + entity_id + '.pid')
-       
-        with open(pidfile,"w") as pfile:
-            pfile.write(str(subp.pid))
+            with open(output + ".txt","w") as f:
+                subp = subprocess.Popen(subp_args, stdout = f, stderr = f)
+
+            pidfile = self.entity_pidfile(name, entity_type, entity_id, replica)
+           
+            with open(pidfile,"w") as pfile:
+                pfile.write(str(subp.pid))
 
 
     def wind_down_entity(self, entity, entity_type):
@@ -141,23 +169,24 @@ class EntityManager:
         if 'name' in entity:
             name = entity['name']
         
-        print("Stopping entity: " + entity_id)
-        pidfile = os.path.join('tmp', name+"_"+ entity_type + '_' + entity_id + '.pid')
-
-        try:
-            with open(pidfile) as f:
-                pid = f.read()
-
-                try:
-                    os.kill(int(pid), signal.SIGTERM)
-                except OSError:
-                    print("Failed to kill entity " + str(entity_id))
-
-            os.remove(pidfile)
-        except ProcessLookupError:
-            print("Error: Process ID not found. The process may have exited prematurely.")
-        except FileNotFoundError:
-            print("Error: Could not find PIDfile for entity: " + entity_id)
+        for replica in range(0, self.entity_replicas(entity)):
+            print("Stopping entity: " + entity_id + " Replica#: " + str(replica))
+            pidfile = self.entity_pidfile(name, entity_type, entity_id, replica)
+
+            try:
+                with open(pidfile) as f:
+                    pid = f.read()
+
+                    try:
+                        os.kill(int(pid), signal.SIGTERM)
+                    except OSError:
+                        print("Failed to kill entity " + str(entity_id))
+
+                os.remove(pidfile)
+            except ProcessLookupError:
+                print("Error: Process ID not found. The process may have exited prematurely.")
+            except FileNotFoundError:
+                print("Error: Could not find PIDfile for entity: " + entity_id)
 
 
     def start(self, arguments, configuration):
@@ -56,8 +56,13 @@ class KnowledgeTracingPlugin(Plugin):
         #    self._post_data("message-auth",{"message_name":"get_student_model_fragment","other_entity_id":"88bb246d-7347-4f57-8cbe-95944a4e0027"}) #problem manager
         #self._post_data("share-message",{"message_name":"get_student_model_fragment","other_entity_ids":["88bb246d-7347-4f57-8cbe-95944a4e0027"]}) #problem manager
         
-        for k,v in self.shared_messages.items():
-            self._post_data("share-message",{"message_name":k,"other_entity_ids":self.shared_messages[k]})
+        response = self._post_data("share-messages",{"shared_messages":self.shared_messages})
+        if response.text != "OK" and self.logger:
+            if response.status_code == 200:
+                #The other messages were shared.
+                self.send_log_entry("ERROR: could not share messages this plugin does not own, " + str(response.json().get("message_names")))
+            else:
+                self.send_log_entry("ERROR: could not share messages, " + response.text)
             
         
     def check_skill_manager(self, message):
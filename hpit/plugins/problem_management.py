@@ -69,8 +69,13 @@ class ProblemManagementPlugin(Plugin):
         #    self._post_data("message-auth",{"message_name":"get_student_model_fragment","other_entity_id":"360798c9-2598-4468-a624-d60f6d4b9f4d"}) #knowledge tracing
         #self._post_data("share-message",{"message_name":"get_student_model_fragment","other_entity_ids":["360798c9-2598-4468-a624-d60f6d4b9f4d"]}) #knowledge tracing
         
-        for k,v in self.shared_messages.items():
-            self._post_data("share-message",{"message_name":k,"other_entity_ids":self.shared_messages[k]})
+        response = self._post_data("share-messages",{"shared_messages":self.shared_messages})
+        if response.text != "OK" and self.logger:
+            if response.status_code == 200:
+                #The other messages were shared.
+                self.send_log_entry("ERROR: could not share messages this plugin does not own, " + str(response.json().get("message_names")))
+            else:
+                self.send_log_entry("ERROR: could not share messages, " + response.text)
         
         
     #Problem Management Plugin
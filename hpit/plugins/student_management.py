@@ -18,6 +18,9 @@ import json
 
 class StudentManagementPlugin(Plugin):
 
+    #How many resource ids to ask HPIT for at once.
+    RESOURCE_ID_BLOCK_SIZE = 100
+
     def __init__(self, entity_id, api_key, logger, args = None):
         super().__init__(entity_id, api_key) 
         self.logger = logger
@@ -29,6 +32,7 @@ class StudentManagementPlugin(Plugin):
         self.student_model_fragment_names = ["knowledge_tracing","problem_management","hint_factory"]
         self.student_models = {}
         self.timeout_threads = {}
+        self.resource_ids = {}
         
         if args:
             try:
@@ -55,6 +59,20 @@ class StudentManagementPlugin(Plugin):
         })
 
 
+    def next_resource_id(self, owner_id):
+        """
+        Returns a new resource id owned by owner_id, from a pool that is refilled
+        a block at a time from HPIT's /new-resource/batch route.
+        """
+        pool = self.resource_ids.setdefault(str(owner_id), [])
+
+        if not pool:
+            response = self._post_data("new-resource/batch",{"owner_id":owner_id,"count":self.RESOURCE_ID_BLOCK_SIZE}).json()
+            pool.extend(response["resource_ids"])
+
+        return pool.pop(0)
+        
+
     #Student Management Plugin
     def add_student_callback(self, message):
         try:
@@ -67,8 +85,7 @@ class StudentManagementPlugin(Plugin):
             except KeyError:
                 attributes = {}
             
-            response = self._post_data("new-resource",{"owner_id":message["sender_entity_id"]}).json()
-            resource_id = response["resource_id"]
+            resource_id = self.next_resource_id(message["sender_entity_id"])
                    
             student_id = self.db.insert({"attributes":attributes,"resource_id":str(resource_id),"owner_id":str(message["sender_entity_id"])})
             
@@ -213,8 +230,7 @@ class StudentManagementPlugin(Plugin):
             student = self.db.find_one({"attributes."+str(attribute_name):attribute_value})
                   
             if not student:
-                response = self._post_data("new-resource",{"owner_id":message["sender_entity_id"]}).json()
-                resource_id = response["resource_id"]
+                resource_id = self.next_resource_id(message["sender_entity_id"])
                 attributes = {attribute_name:attribute_value}   
                 student_id = self.db.insert({"attributes":{attribute_name:attribute_value},"resource_id":str(resource_id),"owner_id":str(message["sender_entity_id"])})
             
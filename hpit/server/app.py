@@ -6,7 +6,6 @@ from flask import Flask, request, session, abort, Response
 from flask import render_template, url_for, jsonify
 from flask.ext.babel import Babel
 from flask.ext.mail import Mail
-from flask.ext.pymongo import PyMongo
 from flask.ext.sqlalchemy import SQLAlchemy
 from flaskext.markdown import Markdown
 from flask.ext.user import current_user, login_required, UserManager, UserMixin, SQLAlchemyAdapter
@@ -19,10 +18,22 @@ from gears_coffeescript import CoffeeScriptCompiler
 #Comment out this block if you run this file directly. (Strictly for development purposes only)
 from .flask_gears import Gears
 from .sessions import MongoSessionInterface
+from .notifier import MessageNotifier
+from .archive import MessageArchive
+from .metrics import RequestMetrics, CountedPyMongo
+from .counters import RollingCounters
+from .rollups import ResponseRollups
+from .queues import QueueDepths
 
 #For running this file directly uncomment this and comment the block above it.
 #from flask_gears import Gears
 #from sessions import MongoSessionInterface
+#from notifier import MessageNotifier
+#from archive import MessageArchive
+#from metrics import RequestMetrics
+#from counters import RollingCounters
+#from rollups import ResponseRollups
+#from queues import QueueDepths
 #from settings import MONGO_DBNAME, SECRET_KEY, DEBUG_MODE
 
 from hpit.management.settings_manager import SettingsManager
@@ -62,7 +73,7 @@ class ServerApp:
         self.app.logger.addHandler(log_handler)
 
         try:
-            self.mongo = PyMongo(self.app)
+            self.mongo = CountedPyMongo(self.app)
             #self.app.session_interface = MongoSessionInterface(self.app, self.mongo)
         except ConnectionFailure:
             self.mongo = None
@@ -72,6 +83,22 @@ class ServerApp:
         self.mail = Mail(self.app)
         self.md = Markdown(self.app)
         self.csrf = CsrfProtect(self.app)
+        self.notifier = MessageNotifier()
+        self.metrics = RequestMetrics()
+        self.metrics.init_app(self.app)
+        self.counters = RollingCounters(self.mongo)
+        self.queue_depths = QueueDepths(self.mongo)
+
+        archive_period = getattr(settings, 'ARCHIVE_PERIOD', 'day')
+        archive_hot_days = getattr(settings, 'ARCHIVE_HOT_DAYS', 7)
+        self.sent_messages_archive = MessageArchive(self.mongo,
+            'sent_messages_and_transactions', 'sent_messages_', 'time_received',
+            archive_period, archive_hot_days, indexes=['receiver_entity_id', 'message_id',
+                [('receiver_entity_id', 1), ('time_received', 1), ('_id', 1)]])
+        self.sent_responses_archive = MessageArchive(self.mongo,
+            'sent_responses', 'sent_responses_', 'time_response_received',
+            archive_period, archive_hot_days, indexes=['receiver_entity_id', 'message_id'])
+        self.response_rollups = ResponseRollups(self.mongo, self.sent_responses_archive)
 
         self.user_bootstrapped = False
 
@@ -0,0 +1,192 @@
+import heapq
+import re
+from datetime import datetime, timedelta
+from itertools import chain, islice
+
+from pymongo.errors import DuplicateKeyError
+
+class MessageArchive:
+    """
+    Splits a collection of delivered documents (e.g. sent_messages_and_transactions)
+    into a small "hot" collection and time partitioned archive collections, one
+    per day or per week, named after the day the partition starts:
+
+        sent_messages_2026_10_18
+
+    The hot collection keeps the documents from the last hot_days days, which
+    is all the routes that update delivered documents (e.g. /response) need.
+    archive() moves older documents into their partitions, and queries over a
+    time range only read the partitions that overlap it. Dropping a partition
+    removes a whole day (or week) at once.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, mongo, hot_collection, prefix, time_field, period='day', hot_days=7, indexes=None):
+        if period not in ['day', 'week']:
+            raise ValueError("Archive period must be 'day' or 'week'.")
+
+        self.mongo = mongo
+        self.hot_collection = hot_collection
+        self.prefix = prefix
+        self.time_field = time_field
+        self.period = period
+        self.hot_days = hot_days
+        self.indexes = indexes or []
+
+        self.name_pattern = re.compile('^' + re.escape(prefix) + r'(\d{4}_\d{2}_\d{2})$')
+
+    def partition_length(self):
+        if self.period == 'week':
+            return timedelta(days=7)
+
+        return timedelta(days=1)
+
+    def partition_start(self, when):
+        """
+        The start of the partition a document dated 'when' belongs in.
+        """
+        start = datetime(when.year, when.month, when.day)
+
+        if self.period == 'week':
+            start -= timedelta(days=start.weekday())
+
+        return start
+
+    def partition_name(self, when):
+        return self.prefix + self.partition_start(when).strftime('%Y_%m_%d')
+
+    def partitions(self):
+        """
+        The existing partitions as a list of (start, collection name), oldest first.
+        """
+        result = []
+
+        for name in self.mongo.db.collection_names():
+            match = self.name_pattern.match(name)
+            if match:
+                result.append((datetime.strptime(match.group(1), '%Y_%m_%d'), name))
+
+        return sorted(result)
+
+    def collections(self, start=None, end=None):
+        """
+        The hot collection followed by the partitions that may hold documents
+        dated between start and end. Either bound may be None for an open range.
+        """
+        length = self.partition_length()
+
+        names = [self.hot_collection] + [
+            name for partition_start, name in self.partitions()
+            if (end is None or partition_start < end) and
+               (start is None or partition_start + length > start)
+        ]
+
+        return [self.mongo.db[name] for name in names]
+
+    def find(self, query, start=None, end=None, projection=None):
+        """
+        Iterates over the documents matching query in the hot collection and in
+        the partitions overlapping start and end.
+        """
+        return chain.from_iterable(
+            collection.find(query, projection) for collection in self.collections(start, end))
+
+    def find_page(self, query, limit, after=None, projection=None):
+        """
+        The first 'limit' documents matching query in (time_field, _id) order,
+        across the hot collection and the partitions. 'after' is the (time, _id)
+        of the last document of the previous page, or None for the first page;
+        partitions that end before that time are not read.
+
+        Documents reach the archive out of _id order (e.g. by priority), so pages
+        follow the time they were archived under rather than their _id.
+        """
+        start = None
+
+        if after:
+            start, after_id = after
+            query = {'$and': [query, {'$or': [
+                {self.time_field: {'$gt': start}},
+                {self.time_field: start, '_id': {'$gt': after_id}}
+            ]}]}
+
+        cursors = [
+            self._decorated(collection.find(query, projection).sort([(self.time_field, 1), ('_id', 1)]).limit(limit), i)
+            for i, collection in enumerate(self.collections(start))
+        ]
+
+        #heapq.merge has no key argument before Python 3.5, so merge (time, _id, i, document)
+        #tuples; i breaks ties so documents themselves are never compared.
+        return [d for t, _id, i, d in islice(heapq.merge(*cursors), limit)]
+
+    def _decorated(self, cursor, i):
+        return ((d[self.time_field], d['_id'], i, d) for d in cursor)
+
+    def find_one(self, query, start=None, end=None):
+        for collection in self.collections(start, end):
+            document = collection.find_one(query)
+            if document:
+                return document
+
+        return None
+
+    def count(self, query, start=None, end=None):
+        return sum(collection.find(query).count() for collection in self.collections(start, end))
+
+    def archive(self, now=None):
+        """
+        Moves the documents older than the hot window out of the hot collection
+        and into their partitions. Safe to re-run after an interruption.
+        Returns the number of documents moved.
+        """
+        if now is None:
+            now = datetime.now()
+
+        cutoff = self.partition_start(now - timedelta(days=self.hot_days))
+        hot = self.mongo.db[self.hot_collection]
+        indexed = set()
+        moved = 0
+
+        while True:
+            documents = list(hot.find({self.time_field: {'$lt': cutoff}}).limit(self.BATCH_SIZE))
+            if not documents:
+                break
+
+            by_partition = {}
+            for document in documents:
+                by_partition.setdefault(self.partition_name(document[self.time_field]), []).append(document)
+
+            for name, partition_documents in by_partition.items():
+                partition = self.mongo.db[name]
+
+                if name not in indexed:
+                    for index in [self.time_field] + self.indexes:
+                        partition.create_index(index)
+                    indexed.add(name)
+
+                try:
+                    partition.insert(partition_documents, continue_on_error=True)
+                except DuplicateKeyError:
+                    #Already copied by a run that stopped before removing them.
+                    pass
+
+            hot.remove({'_id': {'$in': [d['_id'] for d in documents]}})
+            moved += len(documents)
+
+        return moved
+
+    def drop_before(self, when):
+        """
+        Drops the partitions that only hold documents dated before 'when'.
+        Returns the names of the dropped partitions.
+        """
+        length = self.partition_length()
+        dropped = []
+
+        for partition_start, name in self.partitions():
+            if partition_start + length <= when:
+                self.mongo.db.drop_collection(name)
+                dropped.append(name)
+
+        return dropped
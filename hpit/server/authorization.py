@@ -0,0 +1,89 @@
+import threading
+
+from hpit.server.app import ServerApp
+app_instance = ServerApp.get_instance()
+db = app_instance.db
+mongo = app_instance.mongo
+
+from hpit.server.models import MessageAuth
+from .versions import SharedVersion
+
+class MessageAuthCache:
+    """
+    A process local copy of the MessageAuth model: the message names each entity
+    is authorized for and the owner of each message name, so that authorization
+    checks are set and dict lookups rather than SQL queries.
+
+    Anything that changes MessageAuth rows must call invalidate() after
+    committing, the same way as with the SubscriptionRoutingTable.
+    """
+    instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if not cls.instance:
+            cls.instance = MessageAuthCache()
+
+        return cls.instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = SharedVersion(mongo, 'message_auth')
+        self.tables = None
+        self.tables_version = None
+
+    def authorized(self, entity_id):
+        """
+        Returns the set of message names entity_id is authorized for.
+        """
+        return self._tables()[0].get(str(entity_id), frozenset())
+
+    def owner(self, message_name):
+        """
+        Returns the entity id of the owner of message_name, or None.
+        """
+        owners = self._tables()[1].get(message_name)
+        return owners[0] if owners else None
+
+    def is_owner(self, entity_id, message_name):
+        return str(entity_id) in self._tables()[1].get(message_name, [])
+
+    def exists(self, message_name):
+        """
+        True if anyone is authorized for message_name.
+        """
+        return message_name in self._tables()[2]
+
+    def invalidate(self):
+        self.version.bump()
+
+    def _tables(self):
+        version = self.version.current()
+
+        if version is None:
+            #Stamp a version, so the cache notices if the stamp is lost (e.g. a dropped database).
+            self.version.bump()
+            version = self.version.current()
+
+        with self.lock:
+            if self.tables is None or version != self.tables_version:
+                self.tables = self._build_tables()
+                self.tables_version = version
+
+            return self.tables
+
+    def _build_tables(self):
+        authorized = {}
+        owners = {}
+        message_names = set()
+
+        auths = db.session.query(MessageAuth.entity_id, MessageAuth.message_name, MessageAuth.is_owner)
+
+        for entity_id, message_name, is_owner in auths:
+            authorized.setdefault(entity_id, set()).add(message_name)
+            message_names.add(message_name)
+
+            if is_owner:
+                owners.setdefault(message_name, []).append(entity_id)
+
+        return authorized, owners, message_names
@@ -0,0 +1,133 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from hpit.management.settings_manager import SettingsManager
+settings = SettingsManager.get_server_settings()
+
+COUNTER_FLUSH_INTERVAL = getattr(settings, 'COUNTER_FLUSH_INTERVAL', 1)
+
+#(name, bucket length, how long buckets are kept)
+GRANULARITIES = [
+    ('second', timedelta(seconds=1), timedelta(minutes=2)),
+    ('minute', timedelta(minutes=1), timedelta(hours=2)),
+    ('hour', timedelta(hours=1), timedelta(days=2)),
+]
+
+#(granularity, window) for the last second, minute, hour and day.
+WINDOWS = [
+    ('second', timedelta(seconds=1)),
+    ('second', timedelta(minutes=1)),
+    ('minute', timedelta(hours=1)),
+    ('hour', timedelta(days=1)),
+]
+
+def _encode(entity_id):
+    """
+    Makes an entity id safe to use in a MongoDB field name.
+    """
+    return str(entity_id).replace('%', '%25').replace('.', '%2E').replace('$', '%24').replace('|', '%7C')
+
+def _bucket_start(when, length):
+    seconds = int(length.total_seconds())
+    timestamp = int(time.mktime(when.timetuple()))
+    return datetime.fromtimestamp(timestamp - timestamp % seconds)
+
+
+class RollingCounters:
+    """
+    Counts events (e.g. 'messages_created') per second, minute and hour in the
+    metric_counters MongoDB collection, broken down by sender and receiver, so
+    the dashboard can report recent throughput without counting documents.
+
+    Events are added up in memory and written with one $inc per bucket at most
+    every COUNTER_FLUSH_INTERVAL seconds. Old buckets are removed by a TTL index
+    on 'expires' (see the indexdb command).
+    """
+
+    def __init__(self, mongo):
+        self.mongo = mongo
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.time()
+
+    def record(self, metric, pairs):
+        """
+        Counts one event per (sender_entity_id, receiver_entity_id) pair.
+        """
+        now = datetime.now()
+
+        with self.lock:
+            for granularity, length, _ in GRANULARITIES:
+                bucket = self.pending.setdefault((metric, granularity, _bucket_start(now, length)), {})
+
+                for sender, receiver in pairs:
+                    key = _encode(sender) + '|' + _encode(receiver)
+                    bucket[key] = bucket.get(key, 0) + 1
+
+            due = time.time() - self.last_flush >= COUNTER_FLUSH_INTERVAL
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+
+        retention = {granularity: keep for granularity, _, keep in GRANULARITIES}
+
+        for (metric, granularity, start), bucket in pending.items():
+            increments = {'pairs.' + key: count for key, count in bucket.items()}
+            increments['total'] = sum(bucket.values())
+
+            self.mongo.db.metric_counters.update(
+                {'metric': metric, 'granularity': granularity, 'time': start},
+                {
+                    '$inc': increments,
+                    '$set': {'expires': start + retention[granularity]},
+                },
+                upsert=True
+            )
+
+    def counts(self, metric, senders=None, receivers=None):
+        """
+        The number of events in the last second, minute, hour and day. With
+        senders and/or receivers, only the events sent by one of the senders or
+        received by one of the receivers are counted.
+        """
+        self.flush()
+
+        now = datetime.now()
+        senders = set(_encode(s) for s in senders or [])
+        receivers = set(_encode(r) for r in receivers or [])
+
+        def _matches(key):
+            sender, receiver = key.split('|')
+            return sender in senders or receiver in receivers
+
+        buckets = {}
+        for granularity in set(g for g, _ in WINDOWS):
+            longest = max(window for g, window in WINDOWS if g == granularity)
+            buckets[granularity] = list(self.mongo.db.metric_counters.find({
+                'metric': metric,
+                'granularity': granularity,
+                'time': {'$gt': now - longest},
+            }))
+
+        result = []
+        for granularity, window in WINDOWS:
+            count = 0
+
+            for bucket in buckets[granularity]:
+                if bucket['time'] <= now - window:
+                    continue
+
+                if senders or receivers:
+                    count += sum(c for k, c in bucket.get('pairs', {}).items() if _matches(k))
+                else:
+                    count += bucket.get('total', 0)
+
+            result.append(count)
+
+        return tuple(result)
@@ -4,3 +4,4 @@ class PluginForm(form.Form):
     name = fields.StringField('Plugin Name', validators=[validators.input_required()])
     description = fields.StringField('Plugin Description', validators=[validators.optional()])
     internal = fields.BooleanField('Internal Plugin')
+    max_queue_depth = fields.IntegerField('Maximum Queued Messages', validators=[validators.optional(), validators.NumberRange(min=1)])
@@ -0,0 +1,91 @@
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import bindparam
+
+from hpit.server.app import ServerApp
+app_instance = ServerApp.get_instance()
+db = app_instance.db
+
+from hpit.server.models import Plugin, Tutor
+
+from hpit.management.settings_manager import SettingsManager
+settings = SettingsManager.get_server_settings()
+
+HEARTBEAT_FLUSH_INTERVAL = getattr(settings, 'HEARTBEAT_FLUSH_INTERVAL', 5)
+
+class HeartbeatStore:
+    """
+    Records when each entity last pinged the server in memory and writes them
+    to Plugin.time_last_polled and Tutor.time_last_polled together, with one
+    batched UPDATE per table, at most every HEARTBEAT_FLUSH_INTERVAL seconds.
+
+    The flush happens at the end of the first request (of any kind) after the
+    interval has passed, and whenever active() is asked who is connected, so a
+    process that stops receiving beats still writes the ones it holds.
+    """
+    instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if not cls.instance:
+            cls.instance = HeartbeatStore()
+
+        return cls.instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.time()
+
+    def beat(self, entity_id):
+        """
+        Records a heartbeat from a plugin or tutor.
+        """
+        with self.lock:
+            self.pending[entity_id] = datetime.now()
+
+    def flush_due(self):
+        """
+        Flushes if heartbeats are pending and HEARTBEAT_FLUSH_INTERVAL has passed
+        since the last flush. Called when each request is torn down.
+        """
+        with self.lock:
+            due = self.pending and time.time() - self.last_flush >= HEARTBEAT_FLUSH_INTERVAL
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the heartbeats recorded since the last flush to the database.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+
+        if not pending:
+            return
+
+        rows = [{'b_entity_id': k, 'b_time_last_polled': v} for k, v in pending.items()]
+
+        #An entity id is either a plugin or a tutor, the other update matches nothing.
+        for model in [Plugin, Tutor]:
+            table = model.__table__
+            db.session.execute(
+                table.update().
+                    where(table.c.entity_id == bindparam('b_entity_id')).
+                    values(time_last_polled=bindparam('b_time_last_polled')),
+                rows
+            )
+
+        db.session.commit()
+
+    def active(self, model, since):
+        """
+        The plugins or tutors (per model) that have pinged since the given time.
+        """
+        self.flush()
+
+        return list(model.query.filter(model.time_last_polled >= since))
@@ -0,0 +1,286 @@
+import bisect
+import threading
+import time
+from functools import wraps
+
+from flask import g, has_request_context, request
+from flask.ext.pymongo import PyMongo
+from pymongo.collection import Collection
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+#Collection and cursor methods that make a round trip to MongoDB. A find is 
+#counted once, however many batches its cursor fetches.
+COLLECTION_CALLS = ['find', 'find_one', 'find_and_modify', 'insert', 'update', 'remove', 'save', 'aggregate']
+CURSOR_CALLS = ['count', 'distinct']
+
+class _RouteMetrics:
+    def __init__(self):
+        self.requests = {}
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.count = 0
+        self.response_bytes = 0
+        self.mongo_calls = 0
+        self.sql_calls = 0
+
+    def quantile(self, q):
+        """
+        Estimates a latency quantile from the histogram, as the upper bound of the
+        bucket it falls in.
+        """
+        rank = q * self.count
+        seen = 0
+
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return float('inf')
+
+
+class RequestMetrics:
+    """
+    Per route request counts, latency histograms, response sizes and the
+    number of MongoDB and SQL calls made while serving requests. MongoDB calls
+    are counted by the app's CountedPyMongo, SQL calls with an engine event.
+
+    Recording a request costs a dict lookup and a few additions under a lock,
+    so it is left on in production. The numbers are kept per server process;
+    render() formats them as Prometheus text for the /metrics route.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.started = time.time()
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+        event.listen(Engine, 'before_cursor_execute', self._count_sql)
+
+    def _before_request(self):
+        g.metrics_started = time.time()
+        g.metrics_mongo_calls = 0
+        g.metrics_sql_calls = 0
+
+    def _after_request(self, response):
+        if 'metrics_started' not in g:
+            return response
+
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        method = request.method
+        started = g.metrics_started
+
+        #Files (send_file) are passed through untouched, with their length set.
+        if not response.is_streamed or response.direct_passthrough:
+            self.record(route, method, response.status_code, time.time() - started,
+                response.content_length, g.metrics_mongo_calls, g.metrics_sql_calls)
+            return response
+
+        #A streamed response (e.g. a history page or an event stream) is recorded
+        #when it closes, with the bytes streamed and the calls made while streaming.
+        calls = g._get_current_object()
+        body = _CountedBody(response.response, response.charset)
+        response.response = body
+
+        response.call_on_close(lambda: self.record(route, method, response.status_code,
+            time.time() - started, body.bytes, calls.metrics_mongo_calls, calls.metrics_sql_calls))
+
+        return response
+
+    def _count_sql(self, *args):
+        if has_request_context() and 'metrics_sql_calls' in g:
+            g.metrics_sql_calls += 1
+
+    def record(self, route, method, status, latency, response_bytes, mongo_calls, sql_calls):
+        with self.lock:
+            metrics = self.routes.get(route)
+            if not metrics:
+                metrics = self.routes[route] = _RouteMetrics()
+
+            key = (method, status)
+            metrics.requests[key] = metrics.requests.get(key, 0) + 1
+            metrics.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            metrics.latency_sum += latency
+            metrics.count += 1
+            metrics.response_bytes += response_bytes or 0
+            metrics.mongo_calls += mongo_calls
+            metrics.sql_calls += sql_calls
+
+    def summary(self):
+        """
+        A list of dicts, one per route, with the request count, requests per
+        second, latency percentiles and average calls per request. Busiest first.
+        """
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1)
+
+            result = [{
+                'route': route,
+                'count': m.count,
+                'rate': m.count / elapsed,
+                'p50': m.quantile(0.5),
+                'p95': m.quantile(0.95),
+                'p99': m.quantile(0.99),
+                'mean_bytes': m.response_bytes / m.count,
+                'mongo_calls': m.mongo_calls / m.count,
+                'sql_calls': m.sql_calls / m.count,
+            } for route, m in self.routes.items()]
+
+        return sorted(result, key=lambda r: r['count'], reverse=True)
+
+    def render(self):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            '# TYPE hpit_requests_total counter',
+            '# TYPE hpit_request_duration_seconds histogram',
+            '# TYPE hpit_response_size_bytes_total counter',
+            '# TYPE hpit_mongo_calls_total counter',
+            '# TYPE hpit_sql_calls_total counter',
+        ]
+
+        with self.lock:
+            for route, m in sorted(self.routes.items()):
+                label = 'route="' + route.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+                for (method, status), count in sorted(m.requests.items()):
+                    lines.append('hpit_requests_total{' + label + ',method="' + method + '",status="' + str(status) + '"} ' + str(count))
+
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], m.buckets):
+                    cumulative += count
+                    lines.append('hpit_request_duration_seconds_bucket{' + label + ',le="' + str(bound) + '"} ' + str(cumulative))
+
+                lines.append('hpit_request_duration_seconds_sum{' + label + '} ' + repr(m.latency_sum))
+                lines.append('hpit_request_duration_seconds_count{' + label + '} ' + str(m.count))
+
+                for q in [0.5, 0.95, 0.99]:
+                    lines.append('hpit_request_duration_seconds_quantile{' + label + ',quantile="' + str(q) + '"} ' + str(m.quantile(q)))
+
+                lines.append('hpit_response_size_bytes_total{' + label + '} ' + str(m.response_bytes))
+                lines.append('hpit_mongo_calls_total{' + label + '} ' + str(m.mongo_calls))
+                lines.append('hpit_sql_calls_total{' + label + '} ' + str(m.sql_calls))
+
+        return '\n'.join(lines) + '\n'
+
+
+class _CountedBody:
+    """
+    Wraps the body of a streamed response, counting the bytes it yields.
+    """
+
+    def __init__(self, body, charset):
+        self.body = body
+        self.charset = charset
+        self.bytes = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.bytes += len(chunk if isinstance(chunk, bytes) else chunk.encode(self.charset))
+            yield chunk
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+class CountedPyMongo(PyMongo):
+    """
+    The app's Flask-PyMongo wrapper. Within a request, its db counts the calls
+    that make a round trip to MongoDB into the request's metrics. Other MongoDB
+    clients (e.g. the plugins' or the tests') are left alone.
+    """
+
+    @property
+    def db(self):
+        db = super().db
+
+        if not has_request_context() or 'metrics_mongo_calls' not in g:
+            return db
+
+        return _CountedDatabase(db)
+
+
+def _count_mongo_call():
+    if has_request_context() and 'metrics_mongo_calls' in g:
+        g.metrics_mongo_calls += 1
+
+def _counted(method):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        _count_mongo_call()
+        return method(*args, **kwargs)
+
+    return wrapper
+
+
+class _CountedDatabase:
+    def __init__(self, database):
+        self._database = database
+
+    def __getattr__(self, name):
+        attribute = getattr(self._database, name)
+
+        if isinstance(attribute, Collection):
+            return _CountedCollection(attribute)
+
+        return attribute
+
+    def __getitem__(self, name):
+        return _CountedCollection(self._database[name])
+
+
+class _CountedCollection:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+
+        if name == 'find':
+            return _counted(lambda *args, **kwargs: _CountedCursor(attribute(*args, **kwargs)))
+
+        if name in COLLECTION_CALLS:
+            return _counted(attribute)
+
+        return attribute
+
+
+class _CountedCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cursor, name)
+
+        if name in CURSOR_CALLS:
+            return _counted(attribute)
+
+        if not callable(attribute):
+            return attribute
+
+        #Keep chained calls such as sort() and limit() wrapped.
+        @wraps(attribute)
+        def chained(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            return self if result is self._cursor else result
+
+        return chained
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __next__(self):
+        return next(self._cursor)
+
+    def __getitem__(self, index):
+        return self._cursor[index]
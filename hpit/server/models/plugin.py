@@ -18,6 +18,7 @@ class Plugin(db.Model):
     description = db.Column(db.String(1400), nullable=False)
     internal = db.Column(db.Boolean(),nullable=False, default = False)
     connected = db.Column(db.Boolean())
+    max_queue_depth = db.Column(db.Integer)
 
     time_last_polled = db.Column(db.DateTime, nullable=False, default=datetime.now)
 
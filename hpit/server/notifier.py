@@ -0,0 +1,97 @@
+import threading
+
+class MessageNotifier:
+    """
+    Wakes up requests that are blocked waiting for something to be queued
+    for them (long-polling).
+
+    Each channel is an arbitrary hashable key, e.g. ('plugin_messages', entity_id).
+    A request registers with listen() *before* it queries the database and then
+    waits on the returned listener, so a notification sent between the query
+    and the wait is never lost:
+
+        with notifier.listen(channel) as listener:
+            messages = query()
+            if not messages and listener.wait(timeout):
+                messages = query()
+
+    Notifications are process local. When the server runs with several uWSGI
+    workers a listener may sleep through a notify issued by another worker, which
+    is why callers always wait with a bounded timeout.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}
+
+    def listen(self, channel):
+        return _Listener(self, channel)
+
+    def notify(self, *channels):
+        with self.lock:
+            for channel in channels:
+                state = self.channels.get(channel)
+                if not state:
+                    continue
+
+                state.generation += 1
+                state.condition.notify_all()
+
+    def _register(self, channel):
+        with self.lock:
+            state = self.channels.get(channel)
+            if not state:
+                state = _ChannelState(self.lock)
+                self.channels[channel] = state
+
+            state.listeners += 1
+            return state.generation
+
+    def _unregister(self, channel):
+        with self.lock:
+            state = self.channels[channel]
+            state.listeners -= 1
+            if not state.listeners:
+                del self.channels[channel]
+
+    def _wait(self, channel, generation, timeout):
+        with self.lock:
+            state = self.channels[channel]
+            state.condition.wait_for(lambda: state.generation != generation, timeout)
+            return state.generation
+
+
+class _ChannelState:
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.generation = 0
+        self.listeners = 0
+
+
+class _Listener:
+    def __init__(self, notifier, channel):
+        self.notifier = notifier
+        self.channel = channel
+        self.generation = None
+
+    def __enter__(self):
+        self.generation = self.notifier._register(self.channel)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.notifier._unregister(self.channel)
+        return False
+
+    def wait(self, timeout):
+        """
+        Block until the channel is notified or the timeout expires. Returns True
+        if the channel was notified since the listener was opened or last woken.
+        """
+        if timeout <= 0:
+            return False
+
+        generation = self.notifier._wait(self.channel, self.generation, timeout)
+        woken = generation != self.generation
+        self.generation = generation
+
+        return woken
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from hpit.management.settings_manager import SettingsManager
+settings = SettingsManager.get_server_settings()
+
+QUEUE_DEPTH_INTERVAL = getattr(settings, 'QUEUE_DEPTH_INTERVAL', 5)
+MAX_QUEUE_DEPTH = getattr(settings, 'MAX_QUEUE_DEPTH', None)
+
+class QueueDepths:
+    """
+    The number of messages queued in plugin_messages for each receiver.
+
+    Depths are only counted for the receivers they are asked for, one indexed
+    count on receiver_entity_id per receiver, at most every QUEUE_DEPTH_INTERVAL
+    seconds, and kept per server process, so checking a receiver's depth when
+    routing a message is usually a dict lookup. Messages this process queues in
+    between are added to the counts with add().
+    """
+
+    def __init__(self, mongo):
+        self.mongo = mongo
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.counted = {}
+
+    def depths(self, entity_ids):
+        """
+        Returns a dict of receiver_entity_id -> number of queued messages for
+        the given entity ids.
+        """
+        now = time.time()
+
+        with self.lock:
+            stale = [entity_id for entity_id in entity_ids
+                if entity_id not in self.counted or now - self.counted[entity_id] >= QUEUE_DEPTH_INTERVAL]
+
+        for entity_id in stale:
+            self.refresh(entity_id)
+
+        with self.lock:
+            return {entity_id: self.counts.get(entity_id, 0) for entity_id in entity_ids}
+
+    def depth(self, entity_id):
+        return self.depths([entity_id])[entity_id]
+
+    def limit(self, max_queue_depth):
+        """
+        The queue limit of a plugin with the given max_queue_depth, which 
+        defaults to MAX_QUEUE_DEPTH. None means no limit.
+        """
+        if max_queue_depth is None:
+            return MAX_QUEUE_DEPTH
+
+        return max_queue_depth
+
+    def full(self, max_depths):
+        """
+        Given a dict of entity_id -> max_queue_depth, returns the set of entity
+        ids whose queues are at or over their limit. Only plugins with a limit
+        are counted.
+        """
+        limits = {entity_id: self.limit(m) for entity_id, m in max_depths.items()}
+        limits = {entity_id: l for entity_id, l in limits.items() if l is not None}
+
+        if not limits:
+            return set()
+
+        depths = self.depths(list(limits))
+        return set(entity_id for entity_id, l in limits.items() if depths[entity_id] >= l)
+
+    def add(self, entity_id, count):
+        with self.lock:
+            self.counts[entity_id] = self.counts.get(entity_id, 0) + count
+
+    def refresh(self, entity_id):
+        count = self.mongo.db.plugin_messages.find({'receiver_entity_id': entity_id}).count()
+
+        with self.lock:
+            self.counts[entity_id] = count
+            self.counted[entity_id] = time.time()
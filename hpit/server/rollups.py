@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+#Upper bounds (seconds) of the response latency histogram buckets, the last bucket is unbounded.
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+class ResponseRollups:
+    """
+    Hourly aggregates of delivered responses, per message name, kept in the
+    response_rollups collection: the number of responses, the sum of their
+    latencies (seconds from the message being created to the response being
+    received) and a latency histogram. Hours are those of the original
+    message's time_created.
+
+    run() is incremental. It only reads the responses received since the
+    previous run, tracked by a watermark in rollup_state.
+    """
+
+    NAME = 'response_latency'
+
+    #Responses received in the last moments may still be being written.
+    SETTLE_TIME = timedelta(minutes=1)
+
+    def __init__(self, mongo, sent_responses_archive):
+        self.mongo = mongo
+        self.archive = sent_responses_archive
+
+    def watermark(self):
+        state = self.mongo.db.rollup_state.find_one({'_id': self.NAME})
+
+        if not state:
+            return None
+
+        return state['until']
+
+    def run(self, now=None):
+        """
+        Adds the responses received since the last run to the rollups.
+        Returns the number of responses added.
+        """
+        if now is None:
+            now = datetime.now()
+
+        since = self.watermark()
+        until = now - self.SETTLE_TIME
+
+        received = {'$lt': until}
+        if since:
+            received['$gte'] = since
+
+        responses = self.archive.find(
+            {'time_response_received': received}, start=since, end=until,
+            projection={'time_response_received': True, 'message.time_created': True, 'message.message_name': True})
+
+        rollups = {}
+        processed = 0
+
+        for response in responses:
+            created = response['message']['time_created']
+            latency = (response['time_response_received'] - created).total_seconds()
+            hour = datetime(created.year, created.month, created.day, created.hour)
+
+            rollup = rollups.setdefault((hour, response['message']['message_name']), {'count': 0, 'latency_sum': 0.0})
+            rollup['count'] += 1
+            rollup['latency_sum'] += latency
+
+            bucket = 'histogram.' + str(_bucket_index(latency))
+            rollup[bucket] = rollup.get(bucket, 0) + 1
+
+            processed += 1
+
+        for (hour, message_name), increments in rollups.items():
+            self.mongo.db.response_rollups.update(
+                {'hour': hour, 'message_name': message_name},
+                {'$inc': increments},
+                upsert=True
+            )
+
+        self.mongo.db.rollup_state.update(
+            {'_id': self.NAME},
+            {'$set': {'until': until}},
+            upsert=True
+        )
+
+        return processed
+
+    def rebuild(self):
+        """
+        Forgets the rollups so the next run recomputes them from every stored response.
+        """
+        self.mongo.db.response_rollups.drop()
+        self.mongo.db.rollup_state.remove({'_id': self.NAME})
+
+    def hours(self, start, end, exclude_message_names=None):
+        """
+        The rollups for the hours between start and end, summed over message names.
+        Returns a list of (hour, count, latency_sum, histogram list), oldest first.
+        """
+        query = {'hour': {'$gte': start, '$lt': end}}
+        if exclude_message_names:
+            query['message_name'] = {'$nin': exclude_message_names}
+
+        totals = {}
+        for rollup in self.mongo.db.response_rollups.find(query):
+            total = totals.setdefault(rollup['hour'], [0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)])
+            total[0] += rollup['count']
+            total[1] += rollup['latency_sum']
+
+            for index, count in rollup.get('histogram', {}).items():
+                total[2][int(index)] += count
+
+        return [(hour, t[0], t[1], t[2]) for hour, t in sorted(totals.items())]
+
+
+def _bucket_index(latency):
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if latency <= bound:
+            return index
+
+    return len(LATENCY_BUCKETS)
@@ -0,0 +1,83 @@
+import threading
+
+from hpit.server.app import ServerApp
+app_instance = ServerApp.get_instance()
+db = app_instance.db
+mongo = app_instance.mongo
+
+from hpit.server.models import Plugin, Subscription
+from .versions import SharedVersion
+
+class SubscriptionRoutingTable:
+    """
+    A process local map of message_name -> receiver entity ids, built from the
+    Subscription model so that routing a message does not hit the SQL database.
+    It also holds each plugin's max_queue_depth.
+
+    Anything that changes subscriptions or plugins must call invalidate() after committing.
+    That bumps a version shared through MongoDB, and every process rebuilds its
+    table the next time it routes a message.
+    """
+    instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if not cls.instance:
+            cls.instance = SubscriptionRoutingTable()
+
+        return cls.instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = SharedVersion(mongo, 'subscriptions')
+        self.routes = None
+        self.max_depths = None
+        self.routes_version = None
+
+    def receivers(self, message_name):
+        """
+        Returns the entity ids of the plugins subscribed to message_name.
+        """
+        return self.lookup([message_name])[message_name]
+
+    def lookup(self, message_names):
+        """
+        Returns a dict of message_name -> subscribed entity ids for several
+        message names, checking the shared version only once.
+        """
+        version = self.version.current()
+
+        with self.lock:
+            self._refresh(version)
+            return {name: list(self.routes.get(name, [])) for name in message_names}
+
+    def max_queue_depths(self, entity_ids):
+        """
+        Returns a dict of entity_id -> the plugin's max_queue_depth, None for
+        plugins without a limit of their own.
+        """
+        version = self.version.current()
+
+        with self.lock:
+            self._refresh(version)
+            return {entity_id: self.max_depths.get(entity_id) for entity_id in entity_ids}
+
+    def invalidate(self):
+        self.version.bump()
+
+    def _refresh(self, version):
+        if self.routes is None or version != self.routes_version:
+            self.routes = self._build_routes()
+            self.max_depths = dict(db.session.query(Plugin.entity_id, Plugin.max_queue_depth))
+            self.routes_version = version
+
+    def _build_routes(self):
+        routes = {}
+
+        subscriptions = db.session.query(Subscription.message_name, Plugin.entity_id).join(
+            Plugin, Subscription.plugin_id == Plugin.id)
+
+        for message_name, entity_id in subscriptions:
+            routes.setdefault(message_name, []).append(entity_id)
+
+        return routes
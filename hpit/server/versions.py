@@ -0,0 +1,57 @@
+from uuid import uuid4
+
+from flask import g, has_request_context
+
+class SharedVersion:
+    """
+    A version stamp kept in MongoDB so that caches held by separate server
+    processes (e.g. uWSGI workers) can tell when another process changed the
+    data they were built from.
+
+    The stamp is a random token rather than a counter so that a cache can never
+    mistake a reset stamp (e.g. a dropped database) for the one it was built at.
+    """
+
+    def __init__(self, mongo, name):
+        self.mongo = mongo
+        self.name = name
+
+    def current(self):
+        """
+        The current stamp, or None if there is none. Within a request the stamp
+        is read from MongoDB once and reused, so the caches checking it cost one
+        read per request however often they are consulted.
+        """
+        versions = self._request_versions()
+        if versions is not None and self.name in versions:
+            return versions[self.name]
+
+        document = self.mongo.db.cache_versions.find_one({'_id': self.name})
+        version = document['version'] if document else None
+
+        if versions is not None:
+            versions[self.name] = version
+
+        return version
+
+    def bump(self):
+        version = str(uuid4())
+
+        self.mongo.db.cache_versions.update(
+            {'_id': self.name},
+            {'$set': {'version': version}},
+            upsert=True
+        )
+
+        versions = self._request_versions()
+        if versions is not None:
+            versions[self.name] = version
+
+    def _request_versions(self):
+        if not has_request_context():
+            return None
+
+        if not hasattr(g, 'cache_versions'):
+            g.cache_versions = {}
+
+        return g.cache_versions
@@ -1,8 +1,11 @@
 from uuid import uuid4
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime,timedelta
-from flask import session, jsonify, abort, request, Response
+from flask import session, jsonify, request, Response, stream_with_context, json
 import uuid
+import time
 
 from hpit.server.app import ServerApp
 app_instance = ServerApp.get_instance()
@@ -10,13 +13,36 @@ app = app_instance.app
 mongo = app_instance.mongo
 db = app_instance.db
 csrf = app_instance.csrf
+notifier = app_instance.notifier
+sent_messages_archive = app_instance.sent_messages_archive
+counters = app_instance.counters
+queue_depths = app_instance.queue_depths
 
 from hpit.server.models import Plugin, Tutor, Subscription, MessageAuth, ResourceAuth
+from hpit.server.routing import SubscriptionRoutingTable
+routing_table = SubscriptionRoutingTable.get_instance()
+from hpit.server.heartbeats import HeartbeatStore
+heartbeats = HeartbeatStore.get_instance()
+from hpit.server.authorization import MessageAuthCache
+auth_cache = MessageAuthCache.get_instance()
 
 from hpit.management.settings_manager import SettingsManager
 settings = SettingsManager.get_server_settings()
 
-import random
+LONG_POLL_MAX_WAIT = getattr(settings, 'LONG_POLL_MAX_WAIT', 30)
+LONG_POLL_RECHECK_INTERVAL = getattr(settings, 'LONG_POLL_RECHECK_INTERVAL', 5)
+SHARED_MESSAGE_PAYLOADS = getattr(settings, 'SHARED_MESSAGE_PAYLOADS', False)
+MAX_MESSAGES_PER_POLL = getattr(settings, 'MAX_MESSAGES_PER_POLL', 1000)
+MESSAGE_LEASE_SECONDS = getattr(settings, 'MESSAGE_LEASE_SECONDS', 60)
+LIST_PAGE_SIZE = getattr(settings, 'LIST_PAGE_SIZE', 1000)
+MAX_NEW_RESOURCES = getattr(settings, 'MAX_NEW_RESOURCES', 1000)
+MESSAGE_CALL_TIMEOUT = getattr(settings, 'MESSAGE_CALL_TIMEOUT', 30)
+QUEUE_OVERFLOW_POLICY = getattr(settings, 'QUEUE_OVERFLOW_POLICY', 'reject')
+MESSAGE_PRIORITIES = getattr(settings, 'MESSAGE_PRIORITIES', {})
+
+#Plugins receive higher priority messages first, then the oldest first.
+DELIVERY_ORDER = [('priority', -1), ('_id', 1)]
+QUEUE_OVERFLOW_RETRY_AFTER = getattr(settings, 'QUEUE_OVERFLOW_RETRY_AFTER', 30)
 
 def _map_mongo_document(document):
     mapped_doc = {}
@@ -33,6 +59,11 @@ def _map_mongo_document(document):
 
     return mapped_doc
 
+@app.teardown_request
+def _flush_heartbeats(exception):
+    if exception is None:
+        heartbeats.flush_due()
+
 def user_verified(message_name,plugin):
     if "." in message_name:
         message_parts = message_name.split(".")
@@ -47,6 +78,266 @@ def user_verified(message_name,plugin):
         
     
 
+def _plugin_channel(entity_id):
+    return ('plugin_messages', entity_id)
+
+def _response_channel(entity_id, session_token):
+    return ('responses', entity_id, session_token)
+
+def _wait_parameter():
+    """
+    Reads the optional long-polling 'wait' query parameter (in seconds), bounded
+    by LONG_POLL_MAX_WAIT. Returns None if the parameter is malformed.
+    """
+    try:
+        wait = float(request.args.get('wait', 0))
+    except (TypeError, ValueError):
+        return None
+
+    if wait < 0:
+        return None
+
+    return min(wait, LONG_POLL_MAX_WAIT)
+
+def _ack_parameter():
+    """
+    Reads the optional 'ack' query parameter. True if the messages should stay
+    leased to the plugin until it acknowledges them.
+    """
+    return request.args.get('ack', '').lower() in ['1', 'true', 'yes']
+
+def _max_messages_parameter():
+    """
+    Reads the optional 'max_messages' query parameter, defaulting to (and bounded
+    by) MAX_MESSAGES_PER_POLL. Returns None if the parameter is malformed.
+    """
+    try:
+        max_messages = int(request.args.get('max_messages', MAX_MESSAGES_PER_POLL))
+    except (TypeError, ValueError):
+        return None
+
+    if max_messages < 1:
+        return None
+
+    return min(max_messages, MAX_MESSAGES_PER_POLL)
+
+PAGE_CURSOR_EPOCH = datetime(1970, 1, 1)
+
+def _since_parameter():
+    """
+    Reads the optional 'since' query parameter, the 'next' cursor returned with 
+    the previous page of a list. Returns the (time, id) of the last item of that
+    page, or False if it is not a valid cursor.
+    """
+    since = request.args.get('since')
+    if not since:
+        return None
+
+    try:
+        milliseconds, item_id = since.split('_')
+        return PAGE_CURSOR_EPOCH + timedelta(milliseconds=int(milliseconds)), ObjectId(item_id)
+    except (InvalidId, TypeError, ValueError):
+        return False
+
+def _page_cursor(item_time, item_id):
+    """
+    The 'next' cursor of a page ending with the item with the given time and id.
+    Mongo keeps times to the millisecond, so the cursor does too.
+    """
+    return str((item_time - PAGE_CURSOR_EPOCH) // timedelta(milliseconds=1)) + '_' + str(item_id)
+
+def _limit_parameter():
+    """
+    Reads the optional 'limit' query parameter, defaulting to (and bounded by)
+    LIST_PAGE_SIZE. Returns None if the parameter is malformed.
+    """
+    try:
+        limit = int(request.args.get('limit', LIST_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return None
+
+    if limit < 1:
+        return None
+
+    return min(limit, LIST_PAGE_SIZE)
+
+def _stream_page(key, items):
+    """
+    Streams a page of a list as the JSON object {key: [...], 'next': cursor}, one
+    item at a time, so large pages are never serialized in one piece. items is
+    an iterable of ((time, id), dict), the cursor is made from the time and id
+    of the last item, or null.
+    """
+    def _stream():
+        yield '{' + json.dumps(key) + ': ['
+
+        last = None
+        for index, (position, item) in enumerate(items):
+            yield (', ' if index else '') + json.dumps(item)
+            last = position
+
+        yield '], "next": ' + json.dumps(_page_cursor(*last) if last else None) + '}'
+
+    return Response(stream_with_context(_stream()), mimetype='application/json')
+
+def _long_poll(channel, wait, fetch):
+    """
+    Calls fetch() and, while it comes back empty, blocks for up to 'wait' seconds
+    until something is queued on the channel. The wait is re-checked every
+    LONG_POLL_RECHECK_INTERVAL seconds in case the notify came from another worker.
+    """
+    deadline = time.time() + wait
+
+    with notifier.listen(channel) as listener:
+        result = fetch()
+
+        while not result:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            listener.wait(min(remaining, LONG_POLL_RECHECK_INTERVAL))
+            result = fetch()
+
+    return result
+
+def _route_messages(messages):
+    """
+    Queues a copy of each message (already inserted into messages_and_transactions)
+    for every plugin subscribed to it, with a single bulk insert. When
+    SHARED_MESSAGE_PAYLOADS is on the copies reference the payload stored with the
+    original message instead of duplicating it. Copies for plugins whose queues
+    are full go to dead_letter_messages instead. Returns the set of plugins a
+    copy was queued for.
+    """
+    plugin_messages = []
+    receivers = set()
+    now = datetime.now()
+
+    routes = routing_table.lookup({m['message_name'] for m in messages})
+
+    for message in messages:
+        for plugin_entity_id in routes[message['message_name']]:
+            plugin_message = {
+                'message_id': message['_id'],
+
+                'sender_entity_id': message['sender_entity_id'],
+                'session_token': message['session_token'],
+                'receiver_entity_id': plugin_entity_id,
+
+                'time_created': now,
+
+                'message_name': message['message_name'],
+                'priority': MESSAGE_PRIORITIES.get(message['message_name'], 0),
+            }
+
+            if not SHARED_MESSAGE_PAYLOADS:
+                plugin_message['payload'] = message['payload']
+
+            plugin_messages.append(plugin_message)
+            receivers.add(plugin_entity_id)
+
+    if plugin_messages:
+        full = queue_depths.full(routing_table.max_queue_depths(receivers))
+
+        if full:
+            mongo.db.dead_letter_messages.insert([p for p in plugin_messages if p['receiver_entity_id'] in full])
+            plugin_messages = [p for p in plugin_messages if p['receiver_entity_id'] not in full]
+            receivers -= full
+
+    if plugin_messages:
+        mongo.db.plugin_messages.insert(plugin_messages)
+        counters.record('messages_created', _entity_pairs(plugin_messages))
+
+        for receiver in receivers:
+            queue_depths.add(receiver, len([p for p in plugin_messages if p['receiver_entity_id'] == receiver]))
+
+    notifier.notify(*[_plugin_channel(r) for r in receivers])
+
+    return receivers
+
+def _overflow_response(message_names):
+    """
+    With the 'reject' QUEUE_OVERFLOW_POLICY, returns a 429 response asking the
+    sender to retry later if every plugin subscribed to message_names has a full
+    queue. Otherwise returns None, and routing skips only the full queues, so
+    one stalled subscriber does not hold up the others.
+    """
+    if QUEUE_OVERFLOW_POLICY != 'reject':
+        return None
+
+    routes = routing_table.lookup(set(message_names))
+    receivers = set(r for entity_ids in routes.values() for r in entity_ids)
+
+    if not receivers or queue_depths.full(routing_table.max_queue_depths(receivers)) != receivers:
+        return None
+
+    return ("Message queue full. Retry later.", 429, {
+        'mimetype': "application/json",
+        'Retry-After': str(QUEUE_OVERFLOW_RETRY_AFTER),
+    })
+
+def _entity_pairs(documents):
+    return [(d['sender_entity_id'], d['receiver_entity_id']) for d in documents]
+
+def _set_ancestry(messages):
+    """
+    Records each message's ancestry before it is inserted: the ids of the message
+    it was sent in reaction to (named by '_seed_message_id' in its payload), that
+    message's parent, and so on, root first. The parents are looked up with a
+    single query.
+    """
+    parent_ids = {}
+    for message in messages:
+        seed = message['payload'].get('_seed_message_id') if isinstance(message.get('payload'), dict) else None
+
+        try:
+            parent_ids[id(message)] = ObjectId(seed) if seed else None
+        except (InvalidId, TypeError):
+            parent_ids[id(message)] = None
+
+    parents = {}
+    wanted = list({p for p in parent_ids.values() if p})
+    if wanted:
+        for parent in mongo.db.messages_and_transactions.find({'_id': {'$in': wanted}}, {'ancestors': True}):
+            parents[parent['_id']] = parent
+
+    for message in messages:
+        parent = parents.get(parent_ids[id(message)])
+        message['ancestors'] = parent.get('ancestors', []) + [parent['_id']] if parent else []
+
+def _hydrate_payloads(documents):
+    """
+    Returns the payloads of routed message documents, in order. Documents queued 
+    without a copy of their payload (see SHARED_MESSAGE_PAYLOADS) are resolved 
+    against messages_and_transactions with a single query.
+    """
+    missing = list({d['message_id'] for d in documents if 'payload' not in d})
+
+    originals = {}
+    if missing:
+        for original in mongo.db.messages_and_transactions.find({'_id': {'$in': missing}}, {'payload': True}):
+            originals[original['_id']] = original['payload']
+
+    return [d['payload'] if 'payload' in d else originals.get(d['message_id'], {}) for d in documents]
+
+def _message_error(submitted):
+    """
+    Returns the name of the first missing or invalid parameter of a message
+    submitted to the /message or /message/batch routes, or None if it is valid.
+    """
+    for x in ['name', 'payload']:
+        if x not in submitted:
+            return x
+
+    if submitted['name'] == "transaction":
+        return "name"
+
+    if not isinstance(submitted['payload'], dict):
+        return "payload"
+
+    return None
+
 def bad_parameter_response(parameter):
     return ("Missing parameter: " + parameter, 401, dict(mimetype="application/json"))
 
@@ -210,15 +501,56 @@ def log():
     if 'entity_id' not in session:
         return auth_failed_response()
 
-    mongo.db.entity_log.insert({
+    _insert_log_entries([request.json['log_entry']])
+
+    return ok_response()
+
+
+@csrf.exempt
+@app.route("/log/batch", methods=["POST"])
+def log_batch():
+    """
+    SUPPORTS: POST
+
+    Stores many strings as log entries agains't the connected tutor or plugin,
+    with a single write.
+
+    Accepts: JSON
+        - log_entries : List => The texts to log, oldest first
+
+    Returns: 
+        403         - A connection with HPIT must be established first.
+        404         - Could not find the entity stored in the session.
+        200:OK      - Added the log entries
+    """
+    if 'log_entries' not in request.json or not isinstance(request.json['log_entries'], list):
+        return bad_parameter_response('log_entries')
+
+    if 'entity_id' not in session:
+        return auth_failed_response()
+
+    _insert_log_entries(request.json['log_entries'])
+
+    return ok_response()
+
+
+def _insert_log_entries(log_entries):
+    """
+    Writes log entries for the connected entity without waiting for MongoDB to
+    acknowledge them (w=0), logging is best effort and should not slow down the
+    plugins and tutors doing it.
+    """
+    if not log_entries:
+        return
+
+    now = datetime.now()
+    mongo.db.entity_log.insert([{
         'entity_id': session['entity_id'],
         'session_token': session["token"],
-        'log_entry': request.json['log_entry'],
-        'created_on': datetime.now().isoformat(),
+        'log_entry': log_entry,
+        'created_on': now,
         'deleted': False
-    })
-
-    return ok_response()
+    } for log_entry in log_entries], w=0)
 
 
 @csrf.exempt
@@ -227,24 +559,43 @@ def log_list():
     """
     SUPPORTS: GET
 
-    Returns a list of strings that are things that were logged.
+    Returns a page of the things that were logged, oldest first.
+
+    Accepts: Query String
+        - since : string => (Optional) The 'next' cursor returned with the previous page
+        - limit : number => (Optional) The most entries to return, at most LIST_PAGE_SIZE
 
     Returns: 
         403         - A connection with HPIT must be established first.
         404         - Could not find the entity stored in the session.
-        200:JSON    - A list of strings.
+        200:JSON    
+            - log - A list of log entries.
+            - next - The cursor of the next page, null if there were no entries.
     """
     if 'entity_id' not in session:
         return auth_failed_response()
 
-    log_entries = mongo.db.entity_log.find({
+    since = _since_parameter()
+    if since is False:
+        return bad_parameter_response('since')
+
+    limit = _limit_parameter()
+    if limit is None:
+        return bad_parameter_response('limit')
+
+    query = {
         'entity_id': session['entity_id'],
         'deleted': False
-    })
+    }
+    if since:
+        query['$or'] = [
+            {'created_on': {'$gt': since[0]}},
+            {'created_on': since[0], '_id': {'$gt': since[1]}}
+        ]
 
-    result = [_map_mongo_document(t) for t in log_entries]
+    log_entries = mongo.db.entity_log.find(query).sort([('created_on', 1), ('_id', 1)]).limit(limit)
 
-    return jsonify({'log': result})
+    return _stream_page('log', (((t['created_on'], t['_id']), _map_mongo_document(t)) for t in log_entries))
 
 
 @csrf.exempt
@@ -304,8 +655,7 @@ def subscribe():
         return not_found_response()
         
     #message auth
-    message_auth = MessageAuth.query.filter_by(message_name=message_name).first()
-    if not message_auth: #this will be the owner
+    if not auth_cache.exists(message_name): #this will be the owner
         if user_verified(message_name,plugin):
             new_message_auth = MessageAuth()
             new_message_auth.entity_id = str(entity_id)
@@ -313,25 +663,32 @@ def subscribe():
             new_message_auth.is_owner = True
             db.session.add(new_message_auth)
             db.session.commit()
+            auth_cache.invalidate()
         else:
             return jsonify({"error":"invalid message name"})
             
     #remove old subscriptions
+    removed_subscriptions = False
     subscriptions = Subscription.query.filter_by(plugin=plugin)
     for remove_subscription in subscriptions:
         now = datetime.now()
         if not remove_subscription.time:
             db.session.delete(remove_subscription)
+            removed_subscriptions = True
         else:
             dt = now - remove_subscription.time
             if dt.days >=1:
                 db.session.delete(remove_subscription)
+                removed_subscriptions = True
     db.session.commit()
     
     #add subscription
     subscription = Subscription.query.filter_by(plugin=plugin, message_name=message_name).first()
 
     if subscription:
+        if removed_subscriptions:
+            routing_table.invalidate()
+
         return exists_response()
 
     subscription = Subscription()
@@ -342,6 +699,8 @@ def subscribe():
     db.session.add(subscription)
     db.session.commit()
 
+    routing_table.invalidate()
+
     return ok_response()
 
 
@@ -385,6 +744,8 @@ def unsubscribe():
     db.session.delete(subscription)
     db.session.commit()
 
+    routing_table.invalidate()
+
     return ok_response()
 
 
@@ -428,40 +789,51 @@ def plugin_message_history():
 
     !!! IMPORTANT - Does not mark the messages as received. 
 
+    Reads the recent messages and every archive collection. Returns a page of the
+    messages, oldest first, pass the 'next' cursor back as 'since' for the next one.
+
     If you wish to preview queued messages only use the '/message-preview' route instead.
     If you wish to actually CONSUME the queue (mark as received) use the '/messages' route instead.
 
     DO NOT USE THIS ROUTE TO GET YOUR MESSAGES -- ONLY TO VIEW THEIR HISTORY.
 
+    Accepts: Query String
+        - since : string => (Optional) The 'next' cursor returned with the previous page
+        - limit : number => (Optional) The most messages to return, at most LIST_PAGE_SIZE
+
     Returns: 
         403         - A connection with HPIT must be established first.
-        200:OK      - A JSON list of dicts of the messages for this plugin.
+        200:JSON    
+            - message-history - A list of dicts of the messages for this plugin.
+            - next - The cursor of the next page, null if there were no messages.
     """
     if 'entity_id' not in session:
         return auth_failed_response()
 
+    since = _since_parameter()
+    if since is False:
+        return bad_parameter_response('since')
+
+    limit = _limit_parameter()
+    if limit is None:
+        return bad_parameter_response('limit')
+
     entity_id = session['entity_id']
 
-    my_messages = mongo.db.sent_messages_and_transactions.find({
+    authorized = [m for m in auth_cache.authorized(entity_id) if m != "transaction"]
+
+    query = {
         'receiver_entity_id': entity_id,
-        'message_name': {"$ne" : "transaction"}
-    })
-    
-    def is_auth(mname,eid):
-        message_auth = MessageAuth.query.filter_by(message_name=mname,entity_id=str(entity_id)).first()
-        if not message_auth:
-            return False
-        else:
-            return True
-    
-    my_messages = [m for m in my_messages if is_auth(m["message_name"],entity_id)]
+        'message_name': {"$in" : authorized}
+    }
 
-    result = [{
-        'message_name': t['message_name'],
-        'message': _map_mongo_document(t['payload'])
-        } for t in my_messages]
+    my_messages = sent_messages_archive.find_page(query, limit, since) if authorized else []
+    payloads = _hydrate_payloads(my_messages)
 
-    return jsonify({'message-history': result})
+    return _stream_page('message-history', (((t['time_received'], t['_id']), {
+        'message_name': t['message_name'],
+        'message': _map_mongo_document(p)
+        }) for t, p in zip(my_messages, payloads)))
 
     
 #@app.route("/plugin/transaction/history")
@@ -519,23 +891,17 @@ def plugin_message_preview():
 
     entity_id = session['entity_id']
 
-    my_messages = mongo.db.plugin_messages.find({
+    my_messages = list(mongo.db.plugin_messages.find({
         'receiver_entity_id': entity_id,
-    })
-    
-    def is_auth(mname,eid):
-        message_auth = MessageAuth.query.filter_by(message_name=mname,entity_id=str(entity_id)).first()
-        if not message_auth:
-            return False
-        else:
-            return True
+        'message_name': {'$in': list(auth_cache.authorized(entity_id))}
+    }))
     
-    my_messages = [m for m in my_messages if is_auth(m["message_name"],entity_id)]
+    payloads = _hydrate_payloads(my_messages)
 
     result = [{
         'message_name': t['message_name'],
-        'message': _map_mongo_document(t['payload'])
-        } for t in my_messages]
+        'message': _map_mongo_document(p)
+        } for t, p in zip(my_messages, payloads)]
 
     return jsonify({'message-preview': result})
 
@@ -573,39 +939,64 @@ def plugin_message_preview():
     return jsonify({'transaction-preview': result})
     """
 
-@app.route("/plugin/message/list")
-def plugin_message_list():
+def _claimable(now):
     """
-    SUPPORTS: GET
-    List the messages and transactions queued for a specific plugin.
-
-    !!!DANGER!!!: Will mark the messages as received by the plugin 
-    and they will not show again. If you wish to see a preview
-    of the messages queued for a plugin use the /message-preview route instead.
+    Query clause for queued messages that are unclaimed or whose lease has expired.
+    """
+    return {'$or': [
+        {'claim_token': None},
+        {'lease_expires': {'$lt': now}},
+    ]}
 
-    Returns: 
-        403         - A connection with HPIT must be established first.
-        200:OK      - A JSON list of dicts of the messages for this plugin.
+def _claim_plugin_messages(entity_id, max_messages, consumer):
     """
-    if 'entity_id' not in session:
-        return auth_failed_response()
+    Claims up to max_messages of the messages queued for a plugin, highest
+    priority first and then oldest first, on behalf of one consumer (a connected
+    session) of that plugin.
+
+    Each message is claimed with an atomic update, so concurrent consumers of the
+    same plugin never receive the same message. A claim is a lease that expires
+    after MESSAGE_LEASE_SECONDS; if the message is still queued by then it is
+    handed to the next consumer that polls. Returns the claim token and the
+    claimed messages.
+    """
+    now = datetime.now()
 
-    entity_id = session['entity_id']
+    query = _claimable(now)
+    query['receiver_entity_id'] = entity_id
 
-    #plugin = Plugin.query.filter_by(entity_id=entity_id).first()
+    candidates = mongo.db.plugin_messages.find(
+        query, {'_id': True}
+    ).sort(DELIVERY_ORDER).limit(max_messages)
 
-    #if not plugin:
-    #    return not_found_response()
+    candidate_ids = [c['_id'] for c in candidates]
+    if not candidate_ids:
+        return None, []
 
-    #plugin.time_last_polled = datetime.now()
-    #db.session.add(plugin)
-    #db.session.commit()
+    query = _claimable(now)
+    query['_id'] = {'$in': candidate_ids}
 
-    my_messages = mongo.db.plugin_messages.find({
-        'receiver_entity_id': entity_id,
-    })
+    claim_token = str(uuid4())
+    mongo.db.plugin_messages.update(query, {'$set': {
+            'claim_token': claim_token,
+            'claimed_by': consumer,
+            'time_claimed': now,
+            'lease_expires': now + timedelta(seconds=MESSAGE_LEASE_SECONDS),
+        }},
+        multi=True
+    )
 
-    my_messages = list(my_messages)
+    return claim_token, list(mongo.db.plugin_messages.find({'claim_token': claim_token}).sort(DELIVERY_ORDER))
+
+def _deliver_plugin_messages(entity_id, max_messages, consumer, ack=False):
+    """
+    Claims the messages queued for a plugin, moves them into 
+    sent_messages_and_transactions and returns them in the format sent back 
+    to the plugin. In ack mode the messages stay queued, invisible to other
+    polls until their lease expires, and are only moved once the plugin acks
+    or responds to them.
+    """
+    _, my_messages = _claim_plugin_messages(entity_id, max_messages, consumer)
 
    
     #def is_auth(mname,eid):
@@ -617,12 +1008,13 @@ def plugin_message_list():
     #
     #my_messages = [m for m in my_messages if is_auth(m["message_name"],entity_id)]
             
+    payloads = _hydrate_payloads(my_messages)
+
     result = [
-        (t['_id'], t['message_id'], t['message_name'], t['sender_entity_id'],t['time_created'],_map_mongo_document(t['payload']))
-        for t in my_messages
+        (t['_id'], t['message_id'], t['message_name'], t['sender_entity_id'],t['time_created'],_map_mongo_document(p))
+        for t, p in zip(my_messages, payloads)
     ]
 
-    to_remove = [t[0] for t in result]
     result = [{
         'message_id': str(t[1]),
         'message_name': t[2],
@@ -630,47 +1022,91 @@ def plugin_message_list():
         'time_created':t[4],
         'message': t[5]} for t in result]
 
-    #Move sent messages to another collection.
-    if my_messages:
-        for t in my_messages:
-            t['time_received'] = datetime.now() 
+    if not ack:
+        _move_to_sent(my_messages)
 
-        mongo.db.sent_messages_and_transactions.insert(my_messages)
+    return result
 
-        mongo.db.plugin_messages.remove({
-            '_id': {'$in': to_remove}
-        })
-        
-    #remove old messages
-    if random.choice(range(0,100)) == 1:
-        yesterday = datetime.now() - timedelta(days=1)
-        mongo.db.plugin_messages.remove({
-            "time_created": {"$lt":yesterday}
-        })
+def _move_to_sent(plugin_messages):
+    """
+    Moves delivered plugin messages into sent_messages_and_transactions.
+    """
+    if not plugin_messages:
+        return
 
-    return jsonify({'messages': result})
+    for t in plugin_messages:
+        t['time_received'] = datetime.now() 
 
+    mongo.db.sent_messages_and_transactions.insert(plugin_messages)
 
-#@app.route("/plugin/transaction/list")
-#def plugin_transaction_list():
+    mongo.db.plugin_messages.remove({
+        '_id': {'$in': [t['_id'] for t in plugin_messages]}
+    })
+
+    counters.record('messages_received', _entity_pairs(plugin_messages))
+
+def _finalize_leased_messages(entity_id, consumer, message_ids):
+    """
+    Moves messages delivered to a plugin in ack mode, and still leased to the
+    consumer (a connected session) that claimed them, into 
+    sent_messages_and_transactions. Messages whose lease expired may have been
+    handed to another consumer, so they are left queued. Returns the finalized
+    plugin messages.
+    """
+    leased = list(mongo.db.plugin_messages.find({
+        'receiver_entity_id': entity_id,
+        'message_id': {'$in': message_ids},
+        'claimed_by': consumer,
+        'lease_expires': {'$gt': datetime.now()},
+    }))
+
+    _move_to_sent(leased)
+
+    return leased
+
+
+@app.route("/plugin/message/list")
+def plugin_message_list():
     """
     SUPPORTS: GET
-    List the transactions queued for a specific plugin.
+    List the messages and transactions queued for a specific plugin.
 
-    !!!DANGER!!!: Will mark the transactions as received by the plugin 
+    !!!DANGER!!!: Will mark the messages as received by the plugin 
     and they will not show again. If you wish to see a preview
-    of the transactions queued for a plugin use the /transaction-preview route instead.
+    of the messages queued for a plugin use the /message-preview route instead.
+
+    Several processes may connect with the same plugin entity id and poll this
+    route concurrently. Each queued message is handed to only one of them.
+
+    Accepts: Query String
+        - wait (optional) : number => Seconds to hold the request open if nothing is
+            queued yet. Returns as soon as a message arrives. Bounded by the server.
+        - max_messages (optional) : number => The most messages to return at once,
+            oldest first. Bounded by the server. Poll again to get the rest.
+        - ack (optional) : boolean => If true, the messages are leased to this process
+            instead of being marked as received. They are hidden from other polls for
+            MESSAGE_LEASE_SECONDS and must be finalized with /plugin/message/ack or a
+            /response before the lease expires, otherwise they are delivered again.
 
     Returns: 
         403         - A connection with HPIT must be established first.
         200:OK      - A JSON list of dicts of the messages for this plugin.
     """
-    
-    """ UNUSED, transactions go with messages
     if 'entity_id' not in session:
         return auth_failed_response()
 
+    wait = _wait_parameter()
+    if wait is None:
+        return bad_parameter_response('wait')
+
+    max_messages = _max_messages_parameter()
+    if max_messages is None:
+        return bad_parameter_response('max_messages')
+
+    ack = _ack_parameter()
+
     entity_id = session['entity_id']
+    consumer = session['token']
 
     #plugin = Plugin.query.filter_by(entity_id=entity_id).first()
 
@@ -681,50 +1117,171 @@ def plugin_message_list():
     #db.session.add(plugin)
     #db.session.commit()
 
-    my_messages = mongo.db.plugin_transactions.find({
-        'receiver_entity_id': entity_id,
-    })
+    result = _long_poll(_plugin_channel(entity_id), wait, lambda: _deliver_plugin_messages(entity_id, max_messages, consumer, ack))
 
-    my_messages = list(my_messages)
+    return jsonify({'messages': result})
 
-    result = [
-        (t['_id'], t['message_id'], t['message_name'], t['sender_entity_id'],t['time_created'], _map_mongo_document(t['payload']))
-        for t in my_messages
-    ]
 
-    to_remove = [t[0] for t in result]
-    result = [{
-        'message_id': str(t[1]),
-        'message_name': t[2],
-        'sender_entity_id': t[3],
-        'time_created':t[4],
-        'message': t[5]} for t in result]
+@app.route("/plugin/message/stream")
+def plugin_message_stream():
+    """
+    SUPPORTS: GET
+    Stream the messages and transactions queued for a specific plugin as 
+    Server-Sent Events (text/event-stream) over a single open connection.
 
-    #Move sent transactions to another collection.
-    if my_messages:
-        for t in my_messages:
-            t['time_received'] = datetime.now() 
-        mongo.db.sent_messages_and_transactions.insert(my_messages)
+    !!!DANGER!!!: Like the /plugin/message/list route, each message is marked
+    as received by the plugin as soon as it is pushed down the stream.
 
-        mongo.db.plugin_transactions.remove({
-            '_id': {'$in': to_remove}
-        })
+    Each event's data is a JSON dict with the same fields as an entry
+    of the /plugin/message/list route. A comment line is sent every
+    LONG_POLL_RECHECK_INTERVAL seconds while the queue is idle to keep the
+    connection alive.
 
-    #remove old transactions
-    if random.choice([1,2,3,4,5]) == 1:
-        yesterday = datetime.now() - timedelta(days=1)
-        mongo.db.plugin_transactions.remove({
-            "time_created": {"$lt":yesterday}
-        })
+    Accepts: Query String
+        - ack (optional) : boolean => Lease the messages instead of marking them
+            as received, as with the /plugin/message/list route.
 
-    return jsonify({'transactions': result})
+    Returns: 
+        403         - A connection with HPIT must be established first.
+        200:OK      - A text/event-stream of the messages for this plugin.
     """
+    if 'entity_id' not in session:
+        return auth_failed_response()
 
-@csrf.exempt
-@app.route("/message", methods=["POST"])
-def message():
-    """
-    SUPPORTS: POST
+    entity_id = session['entity_id']
+    consumer = session['token']
+    ack = _ack_parameter()
+
+    def _stream():
+        with notifier.listen(_plugin_channel(entity_id)) as listener:
+            while True:
+                messages = _deliver_plugin_messages(entity_id, MAX_MESSAGES_PER_POLL, consumer, ack)
+
+                for message in messages:
+                    yield 'id: ' + message['message_id'] + '\ndata: ' + json.dumps(message) + '\n\n'
+
+                if not messages and not listener.wait(LONG_POLL_RECHECK_INTERVAL):
+                    yield ': keepalive\n\n'
+
+    return Response(stream_with_context(_stream()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@csrf.exempt
+@app.route("/plugin/message/ack", methods=["POST"])
+def plugin_message_ack():
+    """
+    SUPPORTS: POST
+    Acknowledges messages delivered to this plugin in ack mode, marking them as 
+    received so they are not delivered again. Responding to a message with
+    /response acknowledges it as well.
+
+    Accepts: JSON
+        - message_ids : List => The message ids of the messages to acknowledge.
+
+    Returns:
+        403         - A connection with HPIT must be established first.
+        200: JSON   
+            - message_ids - The ids of the messages acknowledged. Messages that are 
+                not leased to this session, whose lease expired, or that were already
+                acknowledged are left out.
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
+
+    if 'message_ids' not in request.json:
+        return bad_parameter_response('message_ids')
+
+    submitted = request.json['message_ids']
+    if not isinstance(submitted, list):
+        return bad_parameter_response('message_ids')
+
+    message_ids = []
+    for index, message_id in enumerate(submitted):
+        try:
+            message_ids.append(ObjectId(message_id))
+        except (InvalidId, TypeError):
+            return bad_parameter_response('message_ids[' + str(index) + ']')
+
+    acknowledged = _finalize_leased_messages(session['entity_id'], session['token'], message_ids)
+
+    return jsonify(message_ids=[str(m['message_id']) for m in acknowledged])
+
+
+#@app.route("/plugin/transaction/list")
+#def plugin_transaction_list():
+    """
+    SUPPORTS: GET
+    List the transactions queued for a specific plugin.
+
+    !!!DANGER!!!: Will mark the transactions as received by the plugin 
+    and they will not show again. If you wish to see a preview
+    of the transactions queued for a plugin use the /transaction-preview route instead.
+
+    Returns: 
+        403         - A connection with HPIT must be established first.
+        200:OK      - A JSON list of dicts of the messages for this plugin.
+    """
+    
+    """ UNUSED, transactions go with messages
+    if 'entity_id' not in session:
+        return auth_failed_response()
+
+    entity_id = session['entity_id']
+
+    #plugin = Plugin.query.filter_by(entity_id=entity_id).first()
+
+    #if not plugin:
+    #    return not_found_response()
+
+    #plugin.time_last_polled = datetime.now()
+    #db.session.add(plugin)
+    #db.session.commit()
+
+    my_messages = mongo.db.plugin_transactions.find({
+        'receiver_entity_id': entity_id,
+    })
+
+    my_messages = list(my_messages)
+
+    result = [
+        (t['_id'], t['message_id'], t['message_name'], t['sender_entity_id'],t['time_created'], _map_mongo_document(t['payload']))
+        for t in my_messages
+    ]
+
+    to_remove = [t[0] for t in result]
+    result = [{
+        'message_id': str(t[1]),
+        'message_name': t[2],
+        'sender_entity_id': t[3],
+        'time_created':t[4],
+        'message': t[5]} for t in result]
+
+    #Move sent transactions to another collection.
+    if my_messages:
+        for t in my_messages:
+            t['time_received'] = datetime.now() 
+        mongo.db.sent_messages_and_transactions.insert(my_messages)
+
+        mongo.db.plugin_transactions.remove({
+            '_id': {'$in': to_remove}
+        })
+
+    #remove old transactions
+    if random.choice([1,2,3,4,5]) == 1:
+        yesterday = datetime.now() - timedelta(days=1)
+        mongo.db.plugin_transactions.remove({
+            "time_created": {"$lt":yesterday}
+        })
+
+    return jsonify({'transactions': result})
+    """
+
+@csrf.exempt
+@app.route("/message", methods=["POST"])
+def message():
+    """
+    SUPPORTS: POST
     Submit a message to the HPIT server. Expect the data formatted as JSON
     with the application/json mimetype given in the headers. Expects two fields in
     the JSON data.
@@ -732,58 +1289,262 @@ def message():
     Accepts: JSON
         - name : string => The name of the message to submit to the server
         - payload : Object => A JSON Object of the DATA to store in the database
+        - idempotency_key (optional) : string => A key unique to this message. A retry
+            with the same key returns the original message_id without sending it again.
 
     Returns:
         403         - A connection with HPIT must be established first.
+        429         - A subscribed plugin's queue is full. Retry after the Retry-After header's seconds.
         200: JSON   
             - message_id - The ID of the message submitted to the database
     """
     if 'entity_id' not in session:
         return auth_failed_response()
         
-    for x in ['name', 'payload']:
-        if x not in request.json:
-            return bad_parameter_response(x)
+    error = _message_error(request.json)
+    if error:
+        return bad_parameter_response(error)
 
-    sender_entity_id = session['entity_id']
-    message_name = request.json['name']
-    if message_name== "transaction":
-        return bad_parameter_response("name")
-        
-    payload = request.json['payload']
-    if not isinstance(payload,dict):
-        return bad_parameter_response("payload")
+    idempotency_key = _idempotency_key_parameter()
+    if idempotency_key is False:
+        return bad_parameter_response('idempotency_key')
+
+    message_id = _sent_message_id(idempotency_key)
+    if message_id:
+        return jsonify(message_id=str(message_id))
 
+    overflow = _overflow_response([request.json['name']])
+    if overflow:
+        return overflow
+
+    message_id, receivers = _submit_message(request.json['name'], request.json['payload'], idempotency_key)
+    
+    return jsonify(message_id=str(message_id))
+
+def _idempotency_key_parameter():
+    """
+    Reads the optional 'idempotency_key' from the JSON data. Returns False if
+    it is not a string.
+    """
+    idempotency_key = request.json.get('idempotency_key')
+
+    if idempotency_key is None:
+        return None
+
+    if not isinstance(idempotency_key, str) or not idempotency_key:
+        return False
+
+    return idempotency_key
+
+def _sent_message_id(idempotency_key):
+    """
+    The id of the message the connected entity recently sent with the given
+    idempotency_key, or None. Checked before anything else about a retry (e.g.
+    queue limits), so a retry of a message that got through is always answered
+    with the original message id.
+    """
+    if idempotency_key is None:
+        return None
+
+    original = mongo.db.idempotency_keys.find_one({
+        'sender_entity_id': session['entity_id'],
+        'idempotency_key': idempotency_key,
+    }, {'message_id': True})
+
+    return original['message_id'] if original else None
+
+def _submit_message(message_name, payload, idempotency_key=None):
+    """
+    Stores a message sent by the connected entity and routes it to the
+    subscribed plugins. Returns the message id and the set of plugins it was
+    queued for.
+
+    If the entity sent a message with the same idempotency_key recently (see
+    the idempotency_keys retention), the message is neither stored nor routed
+    again and the original message id is returned, with None for the plugins. The key is reserved with an
+    insert into the unique (sender_entity_id, idempotency_key) index, so
+    concurrent retries cannot both get through, and released again if the
+    message cannot be stored and routed, so the sender can retry it.
+    """
+    message_id = ObjectId()
+    key = None
+
+    if idempotency_key is not None:
+        key = {
+            'sender_entity_id': session['entity_id'],
+            'idempotency_key': idempotency_key,
+        }
+
+        try:
+            mongo.db.idempotency_keys.insert(dict(key, message_id=message_id, time_created=datetime.now()))
+        except DuplicateKeyError:
+            original = mongo.db.idempotency_keys.find_one(key, {'message_id': True})
+            if original:
+                return original['message_id'], None
+
+    try:
+        receivers = _store_and_route_message(message_id, message_name, payload)
+    except Exception:
+        if key:
+            mongo.db.idempotency_keys.remove(dict(key, message_id=message_id))
+        raise
+
+    return message_id, receivers
+
+def _store_and_route_message(message_id, message_name, payload):
+    """
+    Stores a message sent by the connected entity under message_id and routes it.
+    Returns the set of plugins it was queued for.
+    """
     message = {
-        'sender_entity_id': sender_entity_id,
+        '_id': message_id,
+        'sender_entity_id': session['entity_id'],
         'session_token':session["token"],
         'time_created': datetime.now(),
         'message_name': message_name,
         'payload': payload,
     }     
 
-    message_id = mongo.db.messages_and_transactions.insert(message)
+    _set_ancestry([message])
+    mongo.db.messages_and_transactions.insert(message)
 
-    subscriptions = Subscription.query.filter_by(message_name=message_name)
+    return _route_messages([message])
 
-    for subscription in subscriptions:
-        plugin_entity_id = subscription.plugin.entity_id
+@csrf.exempt
+@app.route("/message/call", methods=["POST"])
+def message_call():
+    """
+    SUPPORTS: POST
+    Submit a message and wait for the response to it. The message is stored and
+    routed the same way as with the /message route, then the request is held
+    open until a plugin responds or the timeout passes. This replaces sending
+    a message and polling /response/list for a blocking call.
 
+    Accepts: JSON
+        - name : string => The name of the message to submit to the server
+        - payload : Object => A JSON Object of the DATA to store in the database
+        - timeout (optional) : number => Seconds to wait for the response. Bounded by
+            MESSAGE_CALL_TIMEOUT, which is also the default.
+        - idempotency_key (optional) : string => A key unique to this message. A retry
+            with the same key waits for the response to the original message.
+
+    Returns:
+        403         - A connection with HPIT must be established first.
+        429         - A subscribed plugin's queue is full. Retry after the Retry-After header's seconds.
+        404: JSON   - No plugin is subscribed to the message (or, with the 'dead_letter' overflow
+                      policy, every subscriber's queue is full), so no response will come.
+            - error - no subscribers
+            - message_id - The ID of the message submitted to the database
+        504: JSON   - No response arrived in time. The response is still queued for
+                      /response/list when it comes.
+            - message_id - The ID of the message submitted to the database
+        200: JSON   
+            - message_id - The ID of the message submitted to the database
+            - responses - The responses to the message, as returned by /response/list
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
         
-        mongo.db.plugin_messages.insert({
-            'message_id': message_id,
+    error = _message_error(request.json)
+    if error:
+        return bad_parameter_response(error)
 
-            'sender_entity_id': sender_entity_id,
-            'session_token':session["token"],
-            'receiver_entity_id': plugin_entity_id,
+    try:
+        timeout = float(request.json.get('timeout', MESSAGE_CALL_TIMEOUT))
+    except (TypeError, ValueError):
+        return bad_parameter_response('timeout')
 
-            'time_created': datetime.now(),
+    if timeout < 0:
+        return bad_parameter_response('timeout')
 
-            'message_name': message_name,
-            'payload': payload
-        })
-    
-    return jsonify(message_id=str(message_id))
+    idempotency_key = _idempotency_key_parameter()
+    if idempotency_key is False:
+        return bad_parameter_response('idempotency_key')
+
+    entity_id = session['entity_id']
+    session_token = session["token"]
+
+    message_id = _sent_message_id(idempotency_key)
+    if not message_id:
+        overflow = _overflow_response([request.json['name']])
+        if overflow:
+            return overflow
+
+        message_id, receivers = _submit_message(request.json['name'], request.json['payload'], idempotency_key)
+
+        #receivers is None when a concurrent retry already submitted the message.
+        if receivers is not None and not receivers:
+            response = jsonify(error="no subscribers", message_id=str(message_id))
+            response.status_code = 404
+            return response
+
+    result = _long_poll(
+        _response_channel(entity_id, session_token), min(timeout, MESSAGE_CALL_TIMEOUT),
+        lambda: _deliver_responses(entity_id, session_token, message_id))
+
+    response = jsonify(message_id=str(message_id), responses=result)
+    if not result:
+        response.status_code = 504
+
+    return response
+
+@csrf.exempt
+@app.route("/message/batch", methods=["POST"])
+def message_batch():
+    """
+    SUPPORTS: POST
+    Submit many messages to the HPIT server at once. Each message is validated
+    the same way as with the /message route, and all of them are stored and 
+    routed with bulk writes. If any message is invalid none are submitted.
+
+    Accepts: JSON
+        - messages : List => A list of JSON Objects, each with:
+            - name : string => The name of the message
+            - payload : Object => A JSON Object of the DATA to store in the database
+
+    Returns:
+        403         - A connection with HPIT must be established first.
+        429         - A subscribed plugin's queue is full. Retry after the Retry-After header's seconds.
+        200: JSON   
+            - message_ids - The IDs of the messages submitted, in the order they were given
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
+
+    if 'messages' not in request.json:
+        return bad_parameter_response('messages')
+
+    submitted = request.json['messages']
+    if not isinstance(submitted, list):
+        return bad_parameter_response('messages')
+
+    for index, item in enumerate(submitted):
+        if not isinstance(item, dict):
+            return bad_parameter_response('messages[' + str(index) + ']')
+
+        error = _message_error(item)
+        if error:
+            return bad_parameter_response('messages[' + str(index) + '].' + error)
+
+    overflow = _overflow_response([item['name'] for item in submitted])
+    if overflow:
+        return overflow
+
+    now = datetime.now()
+    messages = [{
+        'sender_entity_id': session['entity_id'],
+        'session_token':session["token"],
+        'time_created': now,
+        'message_name': item['name'],
+        'payload': item['payload'],
+    } for item in submitted]
+
+    if messages:
+        _set_ancestry(messages)
+        mongo.db.messages_and_transactions.insert(messages)
+        _route_messages(messages)
+
+    return jsonify(message_ids=[str(m['_id']) for m in messages])
 
 @csrf.exempt
 @app.route("/transaction", methods=["POST"])
@@ -796,9 +1557,12 @@ def transaction():
 
     Accepts: JSON
         - payload : Object => A JSON Object of the DATA to store in the database
+        - idempotency_key (optional) : string => A key unique to this message. A retry
+            with the same key returns the original message_id without sending it again.
 
     Returns:
         403         - A connection with HPIT must be established first.
+        429         - A subscribed plugin's queue is full. Retry after the Retry-After header's seconds.
         200: JSON   
             - message_id - The ID of the message submitted to the database
     """
@@ -808,37 +1572,19 @@ def transaction():
     if "payload" not in request.json:
         return bad_parameter_response("payload")
 
-    sender_entity_id = session['entity_id']
-    message_name = "transaction"
-        
-    payload = request.json['payload']
+    idempotency_key = _idempotency_key_parameter()
+    if idempotency_key is False:
+        return bad_parameter_response('idempotency_key')
 
-    message = {
-        'sender_entity_id': sender_entity_id,
-        'session_token':session["token"],
-        'time_created': datetime.now(),
-        'message_name': message_name,
-        'payload': payload,
-    }     
-
-    message_id = mongo.db.messages_and_transactions.insert(message)
+    message_id = _sent_message_id(idempotency_key)
+    if message_id:
+        return jsonify(message_id=str(message_id))
 
-    subscriptions = Subscription.query.filter_by(message_name=message_name)
+    overflow = _overflow_response(["transaction"])
+    if overflow:
+        return overflow
 
-    for subscription in subscriptions:
-        plugin_entity_id = subscription.plugin.entity_id
-
-        mongo.db.plugin_messages.insert({ #used to be plugin_transactions
-            'message_id': message_id,
-            'sender_entity_id': sender_entity_id,
-            'session_token':session["token"],
-            'receiver_entity_id': plugin_entity_id,
-
-            'time_created': datetime.now(),
-
-            'message_name': message_name,
-            'payload': payload
-        })
+    message_id, receivers = _submit_message("transaction", request.json['payload'], idempotency_key)
 
     return jsonify(message_id=str(message_id))
 
@@ -851,6 +1597,8 @@ def response():
     Expects the data formatted as JSON with the application/json mimetype 
     given in the headers. Expects two fields in the JSON data.
 
+    Responding to a message delivered in ack mode also acknowledges it.
+
     Accepts: JSON
         - message_id : string => The message id to the message you're responding to.
         - payload : Object => A JSON Object of the DATA to respond with
@@ -871,6 +1619,8 @@ def response():
     message_id = request.json['message_id']
     payload = request.json['payload']
 
+    _finalize_leased_messages(responder_entity_id, session['token'], [ObjectId(message_id)])
+
     plugin_message = mongo.db.sent_messages_and_transactions.find_one({
         'message_id': ObjectId(message_id),
         'receiver_entity_id': responder_entity_id,
@@ -879,54 +1629,130 @@ def response():
     if not plugin_message:
         return not_found_response()
 
-    mongo.db.sent_messages_and_transactions.update(
-        {'_id': plugin_message['_id']},
-        {"$set": {'time_responded': datetime.now()}}
-    )
-
-    response_id = mongo.db.responses.insert({
-        'message_id': plugin_message['message_id'],
-        'session_token':plugin_message["session_token"],
-        'sender_entity_id': responder_entity_id,
-        'receiver_entity_id': plugin_message['sender_entity_id'],
-        'message': plugin_message,
-        'response': payload
-    })
+    response_id = _queue_responses(responder_entity_id, [(plugin_message, payload)])[0]
 
     return jsonify(response_id=str(response_id))
 
 
-@app.route("/response/list", methods=["GET"])
-def responses():
+@csrf.exempt
+@app.route("/response/batch", methods=["POST"])
+def response_batch():
     """
-    SUPPORTS: GET
-    Poll for responses queued to original sender of a message.
+    SUPPORTS: POST
+    Submits responses to many earlier messages at once. The messages are looked
+    up, marked as responded to, and the responses stored with bulk writes.
 
-    Returns: 
+    Accepts: JSON
+        - responses : List => A list of JSON Objects, each with:
+            - message_id : string => The message id to the message you're responding to.
+            - payload : Object => A JSON Object of the DATA to respond with
+
+    Returns:
         403         - A connection with HPIT must be established first.
-        200:OK      - A JSON list of dicts of the responses for this plugin.
+        200: JSON   
+            - responses - A list with one entry per submitted response, in order. Each has
+                the message_id and either the response_id or an error if the 
+                message could not be found.
     """
     if 'entity_id' not in session:
         return auth_failed_response()
 
-    entity_id = session['entity_id']
+    if 'responses' not in request.json:
+        return bad_parameter_response('responses')
 
-    #entity = Plugin.query.filter_by(entity_id=entity_id).first()
+    submitted = request.json['responses']
+    if not isinstance(submitted, list):
+        return bad_parameter_response('responses')
 
-    #if not entity:
-    #    entity = Tutor.query.filter_by(entity_id=entity_id).first()
+    for index, item in enumerate(submitted):
+        if not isinstance(item, dict):
+            return bad_parameter_response('responses[' + str(index) + ']')
 
-    #if not entity:
-    #    return not_found_response()
+        for x in ['message_id', 'payload']:
+            if x not in item:
+                return bad_parameter_response('responses[' + str(index) + '].' + x)
 
-    #entity.time_last_polled = datetime.now()
-    #db.session.add(entity)
-    #db.session.commit()
+    responder_entity_id = session['entity_id']
+
+    message_ids = []
+    for item in submitted:
+        try:
+            message_ids.append(ObjectId(item['message_id']))
+        except (InvalidId, TypeError):
+            message_ids.append(None)
+
+    plugin_messages = {}
+    if any(message_ids):
+        _finalize_leased_messages(responder_entity_id, session['token'], [m for m in message_ids if m])
+
+        for plugin_message in mongo.db.sent_messages_and_transactions.find({
+            'message_id': {'$in': [m for m in message_ids if m]},
+            'receiver_entity_id': responder_entity_id,
+        }):
+            plugin_messages[plugin_message['message_id']] = plugin_message
+
+    found = [(item, plugin_messages[m]) for item, m in zip(submitted, message_ids) if m in plugin_messages]
+    response_ids = iter(_queue_responses(responder_entity_id, [(p, item['payload']) for item, p in found]))
+
+    result = []
+    for item, message_id in zip(submitted, message_ids):
+        if message_id in plugin_messages:
+            result.append({'message_id': item['message_id'], 'response_id': str(next(response_ids))})
+        else:
+            result.append({'message_id': item['message_id'], 'error': 'not found'})
 
-    my_responses = mongo.db.responses.find({
+    return jsonify(responses=result)
+
+
+def _queue_responses(responder_entity_id, replies):
+    """
+    Queues responses for the senders of the given (sent plugin message, payload)
+    pairs and marks those messages as responded to, using bulk writes. Returns
+    the response ids in order.
+    """
+    if not replies:
+        return []
+
+    plugin_messages = [p for p, _ in replies]
+    for plugin_message, payload in zip(plugin_messages, _hydrate_payloads(plugin_messages)):
+        plugin_message['payload'] = payload
+
+    mongo.db.sent_messages_and_transactions.update(
+        {'_id': {'$in': [p['_id'] for p in plugin_messages]}},
+        {"$set": {'time_responded': datetime.now()}},
+        multi=True
+    )
+
+    response_ids = mongo.db.responses.insert([{
+        'message_id': plugin_message['message_id'],
+        'session_token':plugin_message["session_token"],
+        'sender_entity_id': responder_entity_id,
+        'receiver_entity_id': plugin_message['sender_entity_id'],
+        'message': plugin_message,
+        'response': payload,
+        'time_created': datetime.now(),
+    } for plugin_message, payload in replies])
+
+    notifier.notify(*{_response_channel(p['sender_entity_id'], p['session_token']) for p in plugin_messages})
+    counters.record('responses_created', _entity_pairs(plugin_messages))
+
+    return response_ids
+
+
+def _deliver_responses(entity_id, session_token, message_id=None):
+    """
+    Moves the responses queued for an entity's session (to one message if 
+    message_id is given) into sent_responses and returns them in the format 
+    sent back to the entity.
+    """
+    query = {
         'receiver_entity_id': entity_id,
-        'session_token':session["token"],
-    })
+        'session_token':session_token,
+    }
+    if message_id:
+        query['message_id'] = message_id
+
+    my_responses = mongo.db.responses.find(query)
     
     #def is_auth(r):
     #    if "resource_id" in r["response"]:
@@ -961,13 +1787,51 @@ def responses():
         mongo.db.responses.remove({
             '_id': {'$in': to_remove}
         })
-        
-    #remove old responses
-    if random.choice(range(0,100)) == 1:
-        yesterday = datetime.now() - timedelta(days=1)
-        mongo.db.responses.remove({
-            "message.time_received": {"$lt":yesterday}
-        })
+
+        counters.record('responses_received', _entity_pairs(my_responses))
+
+    return result
+
+
+@app.route("/response/list", methods=["GET"])
+def responses():
+    """
+    SUPPORTS: GET
+    Poll for responses queued to original sender of a message.
+
+    Accepts: Query String
+        - wait (optional) : number => Seconds to hold the request open if no response
+            is queued yet. Returns as soon as a response arrives. Bounded by the server.
+
+    Returns: 
+        403         - A connection with HPIT must be established first.
+        200:OK      - A JSON list of dicts of the responses for this plugin.
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
+
+    wait = _wait_parameter()
+    if wait is None:
+        return bad_parameter_response('wait')
+
+    entity_id = session['entity_id']
+    session_token = session["token"]
+
+    #entity = Plugin.query.filter_by(entity_id=entity_id).first()
+
+    #if not entity:
+    #    entity = Tutor.query.filter_by(entity_id=entity_id).first()
+
+    #if not entity:
+    #    return not_found_response()
+
+    #entity.time_last_polled = datetime.now()
+    #db.session.add(entity)
+    #db.session.commit()
+
+    result = _long_poll(
+        _response_channel(entity_id, session_token), wait,
+        lambda: _deliver_responses(entity_id, session_token))
 
     return jsonify({'responses': result})
  
@@ -1012,11 +1876,45 @@ def message_owner(message_name):
 
     entity_id = session['entity_id']
 
-    message_auth = MessageAuth.query.filter_by(message_name=message_name,is_owner=True).first()
-    if not message_auth:
+    owner = auth_cache.owner(message_name)
+    if not owner:
         return not_found_response()
     else:
-        return  jsonify({"owner":message_auth.entity_id})
+        return  jsonify({"owner":owner})
+
+
+def _share_messages(entity_id, shared_messages):
+    """
+    Authorizes other entities for messages owned by entity_id. shared_messages
+    maps message names to lists of entity ids. The existing authorizations are
+    found with one query and the missing ones added in one commit. Messages
+    entity_id does not own are skipped, and returned as a sorted list.
+    """
+    not_owned = sorted(m for m in shared_messages if not auth_cache.is_owner(entity_id, m))
+    shared_messages = {m: eids for m, eids in shared_messages.items() if m not in not_owned}
+
+    wanted = set((message_name, str(eid)) for message_name, eids in shared_messages.items() for eid in eids)
+    if not wanted:
+        return not_owned
+
+    existing = db.session.query(MessageAuth.message_name, MessageAuth.entity_id).filter(
+        MessageAuth.message_name.in_(list(shared_messages)),
+        MessageAuth.entity_id.in_(list(set(eid for _, eid in wanted))))
+
+    missing = wanted - set((message_name, eid) for message_name, eid in existing)
+
+    for message_name, eid in missing:
+        new_message_auth = MessageAuth()
+        new_message_auth.entity_id = eid
+        new_message_auth.message_name = message_name
+        new_message_auth.is_owner = False
+        db.session.add(new_message_auth)
+
+    if missing:
+        db.session.commit()
+        auth_cache.invalidate()
+
+    return not_owned
 
 
 @csrf.exempt
@@ -1040,20 +1938,51 @@ def share_message():
     elif not isinstance(other_entity_ids,list):
         return bad_parameter_response("other_entity_ids")
     
-    message_auth = MessageAuth.query.filter_by(message_name=message_name,entity_id=str(entity_id),is_owner=True).first()
-    if not message_auth:
+    if _share_messages(entity_id, {message_name: other_entity_ids}):
         return jsonify({"error":"not owner"})
     else:
-        for eid in other_entity_ids:
-            existing_message_auth = MessageAuth.query.filter_by(message_name=message_name, entity_id=str(eid)).first()
-            if not existing_message_auth:
-                new_message_auth = MessageAuth()
-                new_message_auth.entity_id = str(eid)
-                new_message_auth.message_name = message_name
-                new_message_auth.is_owner = False
-                db.session.add(new_message_auth)
-                db.session.commit()
-                
+        return ok_response()
+
+
+@csrf.exempt
+@app.route("/share-messages", methods=["POST"])
+def share_messages():
+    """
+    SUPPORTS: POST
+    Shares several messages owned by the connected entity at once, e.g. all
+    of a plugin's shared messages when it starts.
+
+    Accepts: JSON
+        - shared_messages : Object => Maps message names to the entity id, or list
+          of entity ids, to share each message with
+
+    Returns:
+        403         - A connection with HPIT must be established first.
+        200:OK      - The messages were shared
+        200:JSON    - error: not owner, message_names: the messages the entity does not own.
+                      The messages it does own are still shared.
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
+
+    entity_id = session['entity_id']
+
+    if "shared_messages" not in request.json or not isinstance(request.json["shared_messages"], dict):
+        return bad_parameter_response("shared_messages")
+
+    shared_messages = {}
+    for message_name, other_entity_ids in request.json["shared_messages"].items():
+        if isinstance(other_entity_ids,str):
+            other_entity_ids = [other_entity_ids]
+        elif not isinstance(other_entity_ids,list):
+            return bad_parameter_response("shared_messages." + message_name)
+
+        shared_messages[message_name] = other_entity_ids
+
+    not_owned = _share_messages(entity_id, shared_messages)
+    if not_owned:
+        return jsonify({"error":"not owner", "message_names":not_owned})
+    else:
         return ok_response()
 
 
@@ -1079,6 +2008,51 @@ def new_resource():
     db.session.commit()
     
     return jsonify({"resource_id":new_id})
+
+
+@csrf.exempt
+@app.route("/new-resource/batch", methods=["POST"])
+def new_resource_batch():
+    """
+    SUPPORTS: POST
+    Allocates a block of resource ids owned by the same entity, with a single
+    insert and commit, for plugins that keep a pool of ids to hand out.
+
+    Accepts: JSON
+        - owner_id : string => The entity that will own the resources
+        - count : number => How many resource ids to allocate, at most MAX_NEW_RESOURCES
+
+    Returns:
+        403         - A connection with HPIT must be established first.
+        200: JSON
+            - resource_ids - The new resource ids
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
+
+    if "owner_id" not in request.json:
+        return bad_parameter_response("owner_id")
+
+    try:
+        count = int(request.json.get("count", 1))
+    except (TypeError, ValueError):
+        return bad_parameter_response("count")
+
+    if count < 1:
+        return bad_parameter_response("count")
+
+    owner_id = request.json["owner_id"]
+    new_ids = [str(uuid.uuid4()) for i in range(0, min(count, MAX_NEW_RESOURCES))]
+
+    db.session.execute(ResourceAuth.__table__.insert(), [{
+        'entity_id': owner_id,
+        'is_owner': True,
+        'resource_id': new_id,
+    } for new_id in new_ids])
+    db.session.commit()
+
+    return jsonify({"resource_ids":new_ids})
+
        
  
 @csrf.exempt
@@ -1107,15 +2081,20 @@ def share_resource():
     if not resource_auth:
         return jsonify({"error":"not owner"})
     else:
-        for eid in other_entity_ids:
-            existing_resource_auth = ResourceAuth().query.filter_by(entity_id=eid,resource_id=resource_id).first()
-            if not existing_resource_auth:
-                new_resource_auth = ResourceAuth()
-                new_resource_auth.entity_id = eid
-                new_resource_auth.resource_id = resource_id
-                new_resource_auth.is_owner = False
-                db.session.add(new_resource_auth)
-                db.session.commit()
+        existing = set(eid for eid, in db.session.query(ResourceAuth.entity_id).filter(
+            ResourceAuth.resource_id == resource_id,
+            ResourceAuth.entity_id.in_(other_entity_ids)))
+
+        missing = set(other_entity_ids) - existing
+        for eid in missing:
+            new_resource_auth = ResourceAuth()
+            new_resource_auth.entity_id = eid
+            new_resource_auth.resource_id = resource_id
+            new_resource_auth.is_owner = False
+            db.session.add(new_resource_auth)
+
+        if missing:
+            db.session.commit()
     
         return ok_response()
 
@@ -1126,6 +2105,9 @@ def ping():
     SUPPORTS: POST
     Tell the server a plugin is still connected.
 
+    The heartbeat is recorded in memory and written to the database together
+    with the others every few seconds.
+
     Returns: 
         403         - A connection with HPIT must be established first.
         200:OK      - All is well
@@ -1134,18 +2116,6 @@ def ping():
     if 'entity_id' not in session:
         return auth_failed_response()
 
-    entity_id = session['entity_id']
-    
-    entity = Plugin.query.filter_by(entity_id=entity_id).first()
-    
-    if not entity:
-        entity = Tutor.query.filter_by(entity_id=entity_id).first()
-
-    if not entity:
-        return not_found_response()
-
-    entity.time_last_polled = datetime.now()
-    db.session.add(entity)
-    db.session.commit()
+    heartbeats.beat(session['entity_id'])
     
     return ok_response()
@@ -2,7 +2,7 @@ import os
 from datetime import datetime, timedelta
 from uuid import uuid4
 
-from flask import request, render_template, redirect, url_for, jsonify
+from flask import request, render_template, redirect, url_for, jsonify, Response
 from flask.ext.user import login_required, current_user
 
 from hpit.server.app import ServerApp
@@ -11,8 +11,18 @@ app = app_instance.app
 db = app_instance.db
 mongo = app_instance.mongo
 csrf = app_instance.csrf
+counters = app_instance.counters
+metrics = app_instance.metrics
+sent_messages_archive = app_instance.sent_messages_archive
+sent_responses_archive = app_instance.sent_responses_archive
+response_rollups = app_instance.response_rollups
+queue_depths = app_instance.queue_depths
 
 from hpit.server.models import Plugin, Tutor
+from hpit.server.routing import SubscriptionRoutingTable
+routing_table = SubscriptionRoutingTable.get_instance()
+from hpit.server.heartbeats import HeartbeatStore
+heartbeats = HeartbeatStore.get_instance()
 from hpit.server.forms import PluginForm, TutorForm
 
 #for the student monitor
@@ -53,96 +63,91 @@ class PluginCommunication(object):
              self.total_time = self.plugin_received_dt
             
 class MessageTimes(object):
-    def __init__(self,message_id):
-        self.hpit_received = None
+    def __init__(self, message, sent_messages, responses):
+        self.message_id = str(message["_id"])
+        self.message_name = message["message_name"]
+        self.hpit_received = message["time_created"].replace(tzinfo=None)
         self.plugin_communications = []
 
-        self.message_name = None        
-        self.message_id = message_id
-        
-        self.mongo = MongoClient(settings.MONGODB_URI)
-        self.db = self.mongo[server_settings.MONGO_DBNAME]
-        
-    def get(self): #used for message tracking
-        orig_message = self.db.messages_and_transactions.find_one({"_id":ObjectId(self.message_id)})
-        self.hpit_received = orig_message["time_created"].replace(tzinfo=None)
-        self.message_name = orig_message["message_name"]
-        self.get_plugin_connections()
-    
-    def get_from_existing_query(self,time_created,message_name):
-        self.hpit_received = time_created.replace(tzinfo=None)
-        self.message_name = message_name
-        self.get_plugin_connections()
-        
-    def get_plugin_connections(self):
-        messages_received_by_plugins = self.db.sent_messages_and_transactions.find({"message_id":ObjectId(self.message_id)})
-        for message in messages_received_by_plugins:
-            time_responded = None
+        for sent in sent_messages:
+            time_responded = sent.get("time_responded")
             time_response_received = None
-            if "time_responded" in message:
-                time_responded = message["time_responded"]
-                response = self.db.sent_responses.find_one({"message_id":ObjectId(message["message_id"]),"receiver_entity_id":message["sender_entity_id"]})
-                if response:
-                    time_response_received = response["time_response_received"]
-            plugin_communication = PluginCommunication(message["receiver_entity_id"],self.hpit_received,message["time_received"],time_responded,time_response_received)
+
+            response = responses.get((sent["message_id"], sent["receiver_entity_id"], sent["sender_entity_id"]))
+            if time_responded and response:
+                time_response_received = response["time_response_received"]
+
+            plugin_communication = PluginCommunication(sent["receiver_entity_id"],self.hpit_received,sent["time_received"],time_responded,time_response_received)
             self.plugin_communications.append(plugin_communication)
-            
-        
-    def get_child_messages(self,mid):
-        ids = []
-        child_messages = self.db.messages_and_transactions.find({"payload._seed_message_id":mid})
-        for c in child_messages:
-            ids.append(str(c["_id"]))
-            ids = ids + self.get_child_messages(str(c["_id"]))
-            
-        return ids
-    
 
+    @classmethod
+    def track(cls, message_id):
+        """
+        Returns the MessageTimes of a message and every message sent in reaction to 
+        it (its descendants), parents before children. The whole tree and its
+        deliveries and responses are fetched in a constant number of queries.
+        """
+        root_id = ObjectId(message_id)
+
+        messages = list(mongo.db.messages_and_transactions.find({
+            "$or": [{"_id": root_id}, {"ancestors": root_id}]
+        }))
+
+        if not messages:
+            return []
+
+        if len(messages) == 1 and "ancestors" not in messages[0]:
+            #Stored before messages recorded their ancestors, walk the tree a level at a time.
+            level = [message_id]
+            while level:
+                children = list(mongo.db.messages_and_transactions.find({"payload._seed_message_id": {"$in": level}}))
+                messages.extend(children)
+                level = [str(c["_id"]) for c in children]
+
+        children = {}
+        for m in messages:
+            ancestors = m.get("ancestors")
+            payload = m.get("payload")
+
+            if ancestors:
+                parent = ancestors[-1]
+            elif isinstance(payload, dict):
+                parent = payload.get("_seed_message_id")
+            else:
+                #/transaction accepts payloads that are not objects.
+                parent = None
 
-def query_metrics(collection, metric_name, senders=None, receivers=None):
-    end = datetime.now()
-
-    def _query_metrics_with_time(time_delta):
-        query_count = None
-
-        if senders and receivers:
-            query_count = collection.find({
-                metric_name: {'$gte': end - time_delta, '$lt': end },
-                '$or' : [
-                    {
-                        'sender_entity_id': {
-                            '$in' : senders
-                        }
-                    }, {
-                        'receiver_entity_id': {
-                            '$in': receivers
-                        }
-                    }
-                ] 
-            }).count()
-        elif senders:
-            query_count = collection.find({
-                metric_name: {'$gte': end - time_delta, '$lt': end },
-                'sender_entity_id': {'$in' : senders},
-            }).count()
-        elif receivers:
-            query_count = collection.find({
-                metric_name: {'$gte': end - time_delta, '$lt': end },
-                'receiver_entity_id': {'$in': receivers},
-            }).count()
-        else:
-            query_count = collection.find({
-                metric_name: {'$gte': end - time_delta, '$lt': end }
-            }).count()
+            children.setdefault(str(parent), []).append(m)
+
+        ordered = []
+        def _walk(m):
+            ordered.append(m)
+            for child in sorted(children.get(str(m["_id"]), []), key=lambda c: c["_id"]):
+                _walk(child)
 
-        return query_count
+        _walk(next(m for m in messages if m["_id"] == root_id))
 
-    seconds = _query_metrics_with_time(timedelta(seconds=1))
-    minutes = _query_metrics_with_time(timedelta(minutes=1))
-    hours = _query_metrics_with_time(timedelta(hours=1))
-    days = _query_metrics_with_time(timedelta(days=1))
+        ids = [m["_id"] for m in ordered]
+        #Plugins receive and respond to messages after they are created, so older archives can be skipped.
+        start = min(m["time_created"] for m in ordered).replace(tzinfo=None)
 
-    return (seconds, minutes, hours, days)
+        sent_messages = {}
+        for sent in sent_messages_archive.find({"message_id": {"$in": ids}}, start=start):
+            sent_messages.setdefault(sent["message_id"], []).append(sent)
+
+        responses = {}
+        for response in sent_responses_archive.find({"message_id": {"$in": ids}}, start=start):
+            responses[(response["message_id"], response["sender_entity_id"], response["receiver_entity_id"])] = response
+
+        return [cls(m, sent_messages.get(m["_id"], []), responses) for m in ordered]
+    
+
+def query_metrics(metric_name, senders=None, receivers=None):
+    """
+    The number of events for metric_name (e.g. 'messages_created') in the last
+    second, minute, hour and day, read from the rolling counters kept by the API.
+    """
+    return counters.counts(metric_name, senders, receivers)
 
 
 @app.route("/")
@@ -152,15 +157,16 @@ def index():
     Shows the main page for HPIT.
     """
     last_poll_time = datetime.now() - timedelta(minutes=1)
-    plugins = list(Plugin.query.filter(Plugin.time_last_polled >= last_poll_time))
-    tutors = list(Tutor.query.filter(Tutor.time_last_polled >= last_poll_time))
+    plugins = heartbeats.active(Plugin, last_poll_time)
+    tutors = heartbeats.active(Tutor, last_poll_time)
 
-    messages_created = query_metrics(mongo.db.plugin_messages, 'time_created')
-    messages_received = query_metrics(mongo.db.sent_messages_and_transactions, 'time_received')
-    responses_created = query_metrics(mongo.db.sent_messages_and_transactions, 'time_responded')
-    responses_received = query_metrics(mongo.db.sent_responses, 'time_response_received')
+    messages_created = query_metrics('messages_created')
+    messages_received = query_metrics('messages_received')
+    responses_created = query_metrics('responses_created')
+    responses_received = query_metrics('responses_received')
 
     return render_template('index.html', 
+        queues=queue_status(),
         tutor_count=len(tutors),
         plugin_count=len(plugins),
         tutors=tutors,
@@ -168,10 +174,35 @@ def index():
         messages_created=messages_created,
         messages_received=messages_received,
         responses_created=responses_created,
-        responses_received=responses_received
+        responses_received=responses_received,
+        route_metrics=metrics.summary()
     )
 
 
+def queue_status():
+    """
+    The plugins with queued messages, fullest first, as a list of dicts with the
+    plugin's name, entity id, queue depth and queue limit (None for no limit).
+    """
+    entity_ids = [entity_id for entity_id, in db.session.query(Plugin.entity_id)]
+    depths = dict((entity_id, depth) for entity_id, depth in queue_depths.depths(entity_ids).items() if depth)
+
+    if not depths:
+        return []
+
+    max_depths = routing_table.max_queue_depths(depths.keys())
+    names = dict(db.session.query(Plugin.entity_id, Plugin.name).filter(Plugin.entity_id.in_(list(depths))))
+
+    queues = [{
+        'entity_id': entity_id,
+        'name': names.get(entity_id, "unknown"),
+        'depth': depth,
+        'limit': queue_depths.limit(max_depths[entity_id]),
+    } for entity_id, depth in depths.items()]
+
+    return sorted(queues, key=lambda q: q['depth'], reverse=True)
+
+
 @app.route("/docs")
 def docs():
     """
@@ -210,6 +241,17 @@ def routes():
         links=links)
 
 
+@app.route("/metrics")
+def request_metrics():
+    """
+    SUPPORTS: GET
+    Per route request counts, latency histograms and percentiles, response
+    sizes and MongoDB/SQL calls for this server process, in the Prometheus 
+    text format.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/plugins')
 @login_required
 def plugins():
@@ -331,6 +373,8 @@ def plugin_edit(plugin_id):
             db.session.add(plugin)
             db.session.commit()
 
+            routing_table.invalidate()
+
             return redirect(url_for('plugins'))
 
     return render_template('plugin_edit.html', form=plugin_form, isadmin=current_user.administrator)
@@ -375,6 +419,8 @@ def plugin_delete(plugin_id):
     db.session.delete(plugin)
     db.session.commit()
 
+    routing_table.invalidate()
+
     return redirect(url_for('plugins'))
 
 
@@ -582,10 +628,10 @@ def account_details():
     senders = list(map(lambda x: x.entity_id, tutors))
     receivers = list(map(lambda x: x.entity_id, plugins))
 
-    messages_created = query_metrics(mongo.db.plugin_messages, 'time_created', senders, receivers)
-    messages_received = query_metrics(mongo.db.sent_messages_and_transactions, 'time_received', senders, receivers)
-    responses_created = query_metrics(mongo.db.sent_messages_and_transactions, 'time_responded', senders, receivers)
-    responses_received = query_metrics(mongo.db.sent_responses, 'time_response_received', senders, receivers)
+    messages_created = query_metrics('messages_created', senders, receivers)
+    messages_received = query_metrics('messages_received', senders, receivers)
+    responses_created = query_metrics('responses_created', senders, receivers)
+    responses_received = query_metrics('responses_received', senders, receivers)
 
     return render_template('account_detail.html', 
         tutor_count=len(active_tutors),
@@ -598,6 +644,79 @@ def account_details():
         responses_received=responses_received
     )
 
+STUDENT_MONITOR_PAGE_SIZE = 20
+
+_plugin_mongo = None
+
+def _plugin_db():
+    """
+    The plugins' MongoDB database, over a client shared by all dashboard requests.
+    """
+    global _plugin_mongo
+    if _plugin_mongo is None:
+        _plugin_mongo = MongoClient(settings.MONGODB_URI)
+
+    return _plugin_mongo[settings.MONGO_DBNAME]
+
+def _student_problems(plugin_db, student_id, page):
+    """
+    One page of the problems a student worked, most recent first, with their
+    names, step counts and skills looked up in bulk. Returns the problems and 
+    whether there are more pages.
+    """
+    worked = list(plugin_db.hpit_problems_worked.find(
+        {"student_id":str(student_id)}, {"problem_id": True}
+    ).sort("_id", pymongo.DESCENDING).skip(page * STUDENT_MONITOR_PAGE_SIZE).limit(STUDENT_MONITOR_PAGE_SIZE + 1))
+
+    more = len(worked) > STUDENT_MONITOR_PAGE_SIZE
+    worked = worked[:STUDENT_MONITOR_PAGE_SIZE]
+
+    problem_ids = [w["problem_id"] for w in worked]
+
+    problem_names = {}
+    steps = {}
+    if problem_ids:
+        for problem in plugin_db.hpit_problems.find({"_id": {"$in": problem_ids}}, {"problem_name": True}):
+            problem_names[problem["_id"]] = problem["problem_name"]
+
+        for step in plugin_db.hpit_steps.find({"problem_id": {"$in": problem_ids}}, {"problem_id": True, "skill_names": True}):
+            steps.setdefault(step["problem_id"], []).append(step)
+
+    problems = []
+    for w in worked:
+        problem_steps = steps.get(w["problem_id"], [])
+        problems.append({
+            "problem_name": problem_names.get(w["problem_id"], "unknown"),
+            "problem_id": str(w["_id"]),
+            "number_of_steps": len(problem_steps),
+            "skills_involved": [skill for step in problem_steps for skill in step.get("skill_names", [])],
+        })
+
+    return problems, more
+
+
+@app.route('/student-monitor/problems',methods=["GET"])
+@login_required
+def student_monitor_problems():
+    """
+    SUPPORTS: GET
+    A page of the problems a student worked, for the student monitor to load
+    as the user scrolls through them.
+
+    Accepts: Query String
+        - student_id : string => The student's id
+        - page : number => The page to return, starting from 0
+    """
+    try:
+        page = max(int(request.args.get("page", 0)), 0)
+    except ValueError:
+        page = 0
+
+    problems, more = _student_problems(_plugin_db(), request.args.get("student_id", ""), page)
+
+    return jsonify(problems=problems, more=more, page=page)
+
+
 @csrf.exempt
 @app.route('/student-monitor',methods=["GET","POST"])
 @login_required
@@ -615,10 +734,11 @@ def student_monitor(student_id=""):
                   student_attributes={},
                   student_skills=[],
                   student_problems=[],
+                  more_problems=False,
                   bored=False,      
                 )
         
-        mongo = MongoClient(settings.MONGODB_URI)
+        plugin_db = _plugin_db()
         
         #student_id
         student_id = request.form["student_id"]
@@ -628,10 +748,10 @@ def student_monitor(student_id=""):
         
         #student_attributes
         student_attributes = {}
-        db = mongo[settings.MONGO_DBNAME].hpit_students
+        db = plugin_db.hpit_students
         
         try:
-            student = db.find_one({"_id":ObjectId(str(student_id))})
+            student = db.find_one({"_id":ObjectId(str(student_id))}, {"attributes": True})
             if not student:
                 return error_template("Could not find student with ID " + str(student_id))
             for item in student["attributes"]:
@@ -642,11 +762,28 @@ def student_monitor(student_id=""):
         
         #student_skills
         student_skills = []
-        skill_db = mongo[settings.MONGO_DBNAME].hpit_skills
-        kt_db = mongo[settings.MONGO_DBNAME].hpit_knowledge_tracing
-        kts = kt_db.find({"student_id":str(student_id)})
+        kts = list(plugin_db.hpit_knowledge_tracing.find({"student_id":str(student_id)}, {
+            "skill_id": True,
+            "probability_known": True,
+            "probability_learned": True,
+            "probability_mistake": True,
+            "probability_guess": True,
+        }))
+        
+        skill_ids = []
+        for kt in kts:
+            try:
+                skill_ids.append(ObjectId(kt["skill_id"]))
+            except (bson.errors.InvalidId, TypeError):
+                pass
+        
+        skills = {}
+        if skill_ids:
+            for skill in plugin_db.hpit_skills.find({"_id": {"$in": skill_ids}}, {"skill_name": True, "skill_model": True}):
+                skills[str(skill["_id"])] = skill
+        
         for kt in kts:
-            skill = skill_db.find_one({"_id":ObjectId(kt["skill_id"])})
+            skill = skills.get(str(kt["skill_id"]))
             if not skill:
                 skill_name = "unknown"
                 skill_model = "unknown"
@@ -664,54 +801,19 @@ def student_monitor(student_id=""):
                  "prob_guess":kt["probability_guess"],
                })
             
-        student_problems = [
-            {"problem_name":"Area of a door",
-             "problem_id":"p123",
-             "number_of_steps":"4",
-             "skills_involved":["addition","reading","some other skill"],
-            },
-            {"problem_name":"Angles problem",
-             "problem_id":"p1235",
-             "number_of_steps":"6",
-             "skills_involved":["baseball","eating contest","skydiving"],
-            }
-           
-        ]    
-            
-        #student_problems
-        student_problems = []
-        problem_worked_db = mongo[settings.MONGO_DBNAME].hpit_problems_worked
-        problem_db = mongo[settings.MONGO_DBNAME].hpit_problems
-        step_db = mongo[settings.MONGO_DBNAME].hpit_steps
-        
-        problems_worked = problem_worked_db.find({"student_id":str(student_id)})
-        for problem in problems_worked:
-            actual_problem = problem_db.find_one({"_id":problem["problem_id"]})
-            step_count = 0
-            skill_list = []
-            steps = step_db.find({"problem_id":problem["problem_id"]})
-            for step in steps:
-                for skill in step["skill_names"]:
-                    skill_list.append(skill)
-                step_count +=1
-                
-            student_problems.append({
-                "problem_name":actual_problem["problem_name"],
-                "problem_id":str(problem["_id"]),
-                "number_of_steps":step_count,
-                "skills_involved":skill_list,
-            })
+        #student_problems, the first page (more are loaded from /student-monitor/problems)
+        student_problems, more_problems = _student_problems(plugin_db, student_id, 0)
         
         #boredom (straight from boredom_detector.boredom_calculation())
         bored = False
         
-        boredom_db = mongo[settings.MONGO_DBNAME].hpit_boredom_detection
+        boredom_db = plugin_db.hpit_boredom_detection
         dt_sum = 0
         dt_mean = 0
         dt_std_dev = 0
         dts = []
         
-        records = list(boredom_db.find({"student_id":student_id},limit=1000).sort("time",pymongo.DESCENDING))
+        records = list(boredom_db.find({"student_id":student_id},{"time": True},limit=1000).sort("time",pymongo.DESCENDING))
         if len(records) > 1:
             for xx in range(0,len(records)-1):
                 dt = (records[xx]["time"] - records[xx+1]["time"]).total_seconds();
@@ -739,6 +841,7 @@ def student_monitor(student_id=""):
               student_attributes=student_attributes,
               student_skills=student_skills,
               student_problems=student_problems,
+              more_problems=more_problems,
               bored=bored,      
         )
         
@@ -751,21 +854,21 @@ def student_monitor(student_id=""):
 def message_tracker(message_id=""):
     if request.method == 'POST':
         message_id = request.form["message_id"]
-        message_times = []
-        
-        first_message = MessageTimes(message_id)
-        first_message.get()
-        message_times.append(first_message)
-        
-        child_messages = first_message.get_child_messages(message_id)
-        for c in child_messages:
-            m = MessageTimes(c)
-            m.get()
-            message_times.append(m)
+
+        try:
+            message_times = MessageTimes.track(message_id)
+        except bson.errors.InvalidId:
+            message_times = []
+
+        if not message_times:
+            return render_template('message_tracker_detail.html',
+                    message_id=message_id,
+                    error="Could not find message " + message_id,
+                    )
             
         return render_template('message_tracker_detail.html',
                 message_id=message_id,
-                first_message=first_message,
+                first_message=message_times[0],
                 message_times=message_times,
                 )
         
@@ -809,36 +912,23 @@ def detailed_report():
             one_day = timedelta(days=1)
             two_hours = timedelta(hours=2)
             
-            idx = mongo.db.sent_responses.create_index("message.time_created")
+            #the report is built from the hourly rollups kept by 'manage.py rollup'
+            hours = response_rollups.hours(current_day, end_day, exclude_message_names=[
+                "carnegie_learning.eq_ping",
+                "carnegie_learning.survey_ping",
+                "carnegie_learning.akira_ping",
+                "carnegie_learning.pulse",
+            ])
             
             while current_day < end_day:
-                print(str(current_day))
                 date_string = datetime.strftime(current_day,"%m/%d %I%p")
                 
-                responses = mongo.db.sent_responses.find({
-                        "message.time_created":{
-                            "$gt":current_day,
-                            "$lt":current_day + two_hours
-                         },
-                         "message.message_name":{ 
-                             "$nin":[
-                                 "carnegie_learning.eq_ping",
-                                 "carnegie_learning.survey_ping",
-                                 "carnegie_learning.akira_ping",
-                                 "carnegie_learning.pulse",
-                            ]
-                         } 
-                })
-                
-                total_responses = responses.count() 
-                    
-                total_time = timedelta()
-                for r in responses:
-                    time = r["time_response_received"] - r["message"]["time_created"]
-                    total_time += time
+                window = [h for h in hours if current_day <= h[0] < current_day + two_hours]
+                total_responses = sum(h[1] for h in window)
+                total_time = sum(h[2] for h in window)
                 
                 if total_responses>0:
-                    avg = total_time.seconds / total_responses
+                    avg = total_time / total_responses
                 else:
                     avg = 0
                 
@@ -852,8 +942,6 @@ def detailed_report():
             report_end = datetime.now()
             report_time = ((report_end-report_start).seconds) / 60
             
-            mongo.db.sent_responses.drop_index(idx)
-            
             #return jsonify({"rows":rows,"report_time":report_time})
             return render_template("detailed_report.html",
                     error=None,
@@ -1,4 +1,7 @@
 import os
+import shutil
+import signal
+import tempfile
 import unittest
 from mock import *
 import sure
@@ -70,3 +73,89 @@ class TestBaseManager(unittest.TestCase):
         pass
 
 
+    def entity_helper(self, **fields):
+        return dict({
+            'name': "Test",
+            'type': "example",
+            'entity_id': "1234",
+            'api_key': "5678",
+        }, **fields)
+
+
+    def spin_up_helper(self, entity):
+        """
+        Spins an entity up and down in a scratch directory with the processes
+        mocked. Returns the Popen and os.kill mocks and the pidfiles left after
+        spin up and after wind down.
+        """
+        cwd = os.getcwd()
+        scratch = tempfile.mkdtemp()
+
+        try:
+            os.chdir(scratch)
+            os.makedirs('tmp')
+            os.makedirs('log')
+
+            with patch('hpit.management.entity_manager.subprocess.Popen') as popen, \
+                 patch('hpit.management.entity_manager.os.kill') as kill:
+                popen.side_effect = [Mock(pid=100 + i) for i in range(0, 5)]
+
+                self.subject.spin_up_entity(entity, 'plugin')
+                started = sorted(os.listdir('tmp'))
+
+                self.subject.wind_down_entity(entity, 'plugin')
+                stopped = sorted(os.listdir('tmp'))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(scratch)
+
+        return popen, kill, started, stopped
+
+
+    def test_entity_replicas(self):
+        """
+        EntityManager.entity_replicas() Test plan:
+            - should default to 1
+            - should read replicas from the configuration, at least 1
+        """
+        self.subject.entity_replicas(self.entity_helper()).should.equal(1)
+        self.subject.entity_replicas(self.entity_helper(replicas=3)).should.equal(3)
+        self.subject.entity_replicas(self.entity_helper(replicas=0)).should.equal(1)
+
+
+    def test_entity_pidfile(self):
+        """
+        EntityManager.entity_pidfile() Test plan:
+            - the first replica should keep the unnumbered pidfile name
+            - later replicas should be numbered
+        """
+        self.subject.entity_pidfile("Test", 'plugin', "1234", 0).should.equal(os.path.join('tmp', 'Test_plugin_1234.pid'))
+        self.subject.entity_pidfile("Test", 'plugin', "1234", 2).should.equal(os.path.join('tmp', 'Test_plugin_1234_2.pid'))
+
+
+    def test_spin_up_one_replica(self):
+        """
+        EntityManager.spin_up_entity() and wind_down_entity() with one replica Test plan:
+            - should start one process with the unnumbered pidfile
+            - should stop it and remove its pidfile
+        """
+        popen, kill, started, stopped = self.spin_up_helper(self.entity_helper())
+
+        popen.call_count.should.equal(1)
+        started.should.equal(['Test_plugin_1234.pid'])
+        kill.assert_called_once_with(100, signal.SIGTERM)
+        stopped.should.equal([])
+
+
+    def test_spin_up_replicas(self):
+        """
+        EntityManager.spin_up_entity() and wind_down_entity() with replicas Test plan:
+            - should start one process and write one pidfile per replica
+            - should stop every replica and remove all the pidfiles
+        """
+        popen, kill, started, stopped = self.spin_up_helper(self.entity_helper(replicas=3))
+
+        popen.call_count.should.equal(3)
+        started.should.equal(['Test_plugin_1234.pid', 'Test_plugin_1234_1.pid', 'Test_plugin_1234_2.pid'])
+        sorted(c[0][0] for c in kill.call_args_list).should.equal([100, 101, 102])
+        stopped.should.equal([])
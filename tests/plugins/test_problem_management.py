@@ -64,6 +64,38 @@ class TestProblemManagementPlugin(unittest.TestCase):
         isinstance(pmp.worked_db,Collection).should.equal(True)
         pmp.worked_db.full_name.should.equal("hpit_unit_test_db.hpit_problems_worked")
         
+
+    def test_post_connect(self):
+        """
+        ProblemManagementPlugin.post_connect() Test plan:
+            - should share its shared_messages
+            - should log nothing when they were all shared
+            - should log the messages it does not own
+            - should log the body of a failed request without parsing it as JSON
+        """
+        self.test_subject.subscribe = MagicMock()
+        self.test_subject._post_data = MagicMock()
+        self.test_subject.logger = MagicMock()
+        self.test_subject.send_log_entry = MagicMock()
+        
+        self.test_subject._post_data.return_value = MagicMock(status_code=200, text="OK")
+        with patch('hpitclient.Plugin.post_connect'):
+            self.test_subject.post_connect()
+        self.test_subject._post_data.assert_called_with("share-messages",{"shared_messages":self.test_subject.shared_messages})
+        self.test_subject.send_log_entry.called.should.equal(False)
+        
+        self.test_subject._post_data.return_value = MagicMock(status_code=200, text='{"error": "not owner"}')
+        self.test_subject._post_data.return_value.json.return_value = {"error":"not owner","message_names":["get_student_model_fragment"]}
+        with patch('hpitclient.Plugin.post_connect'):
+            self.test_subject.post_connect()
+        self.test_subject.send_log_entry.assert_called_with("ERROR: could not share messages this plugin does not own, ['get_student_model_fragment']")
+        
+        self.test_subject._post_data.return_value = MagicMock(status_code=403, text="Could not authenticate.")
+        self.test_subject._post_data.return_value.json.side_effect = ValueError
+        with patch('hpitclient.Plugin.post_connect'):
+            self.test_subject.post_connect()
+        self.test_subject.send_log_entry.assert_called_with("ERROR: could not share messages, Could not authenticate.")
+
     def test_add_problem_callback(self):
         """
         ProblemManagementPlugin.add_problem_callback() Test plan:
@@ -79,7 +79,7 @@ class TestStudentManagementPlugin(unittest.TestCase):
         calls = [call("ADD_STUDENT"),call(test_message)]
         self.test_subject.send_response = MagicMock()
         self.test_subject._post_data = MagicMock(return_value=requests.Response())
-        requests.Response.json = MagicMock(return_value={"resource_id":"456"})
+        requests.Response.json = MagicMock(return_value={"resource_ids":["456"]})
         
         self.test_subject.add_student_callback(test_message)
         self.test_subject.send_log_entry.assert_has_calls(calls)
@@ -104,6 +104,27 @@ class TestStudentManagementPlugin(unittest.TestCase):
         
         self.test_subject.send_response.assert_called_with("2",{"student_id":str(result[1]["_id"]),"attributes":{"attr":"value"},"resource_id":"456","session_id":str(session["_id"])})
         
+    def test_next_resource_id(self):
+        """
+        StudentManagementPlugin.next_resource_id() Test plan:
+            - should ask HPIT for a block of ids when the owner's pool is empty
+            - should hand out the pooled ids without asking again
+            - should keep a separate pool per owner
+        """
+        self.test_subject._post_data = MagicMock(return_value=requests.Response())
+        requests.Response.json = MagicMock(return_value={"resource_ids":["1","2"]})
+        
+        self.test_subject.next_resource_id("3").should.equal("1")
+        self.test_subject._post_data.assert_called_with("new-resource/batch",{"owner_id":"3","count":self.test_subject.RESOURCE_ID_BLOCK_SIZE})
+        self.test_subject.next_resource_id("3").should.equal("2")
+        self.test_subject._post_data.call_count.should.equal(1)
+        
+        self.test_subject.next_resource_id("4").should.equal("1")
+        self.test_subject._post_data.call_count.should.equal(2)
+        
+        self.test_subject.next_resource_id("3").should.equal("1")
+        self.test_subject._post_data.call_count.should.equal(3)
+        
     def test_get_student_callback(self):
         """
         StudentManagementPlugin.get_student_callback() Test plan:
@@ -333,7 +354,7 @@ class TestStudentManagementPlugin(unittest.TestCase):
         """
         self.test_subject.send_response = MagicMock()
         self.test_subject._post_data = MagicMock(return_value=requests.Response())
-        requests.Response.json = MagicMock(return_value={"resource_id":"456"})
+        requests.Response.json = MagicMock(return_value={"resource_ids":["456"]})
         
         #neither name or value
         msg = {"message_id":"1","sender_entity_id":"123"}
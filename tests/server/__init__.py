@@ -0,0 +1,29 @@
+import unittest
+
+from pymongo import MongoClient
+
+from hpit.management.settings_manager import SettingsManager
+settings = SettingsManager.get_server_settings()
+
+class MongoStub:
+    """
+    Stands in for the app's Flask-PyMongo wrapper, exposing a database as .db.
+    """
+    def __init__(self, db):
+        self.db = db
+
+class MongoTestCase(unittest.TestCase):
+    """
+    Base class for tests of the server classes that take the app's mongo
+    wrapper. Each test starts with an empty test database, self.db, wrapped
+    as self.mongo.
+    """
+
+    def setUp(self):
+        self.client = MongoClient()
+        self.client.drop_database(settings.MONGO_DBNAME)
+        self.db = self.client[settings.MONGO_DBNAME]
+        self.mongo = MongoStub(self.db)
+
+    def tearDown(self):
+        self.client.drop_database(settings.MONGO_DBNAME)
@@ -0,0 +1,110 @@
+import sure
+
+from datetime import datetime, timedelta
+
+from hpit.server.archive import MessageArchive
+
+from tests.server import MongoTestCase
+
+class TestMessageArchive(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.subject = MessageArchive(self.mongo, 'sent', 'sent_', 'time_received',
+            hot_days=7, indexes=['receiver_entity_id'])
+
+    def test_partition_name(self):
+        """
+        MessageArchive.partition_name() Test plan:
+            - daily partitions should be named after the day
+            - weekly partitions should be named after the monday starting the week
+            - an unknown period should raise a ValueError
+        """
+        self.subject.partition_name(datetime(2026, 10, 18, 13, 5)).should.equal('sent_2026_10_18')
+
+        weekly = MessageArchive(self.mongo, 'sent', 'sent_', 'time_received', period='week')
+        weekly.partition_name(datetime(2026, 10, 18, 13, 5)).should.equal('sent_2026_10_12')
+
+        MessageArchive.when.called_with(self.mongo, 'sent', 'sent_', 'time_received', period='month').should.throw(ValueError)
+
+    def test_archive(self):
+        """
+        MessageArchive.archive() Test plan:
+            - documents older than the hot window should be moved into their partitions
+            - recent documents should stay in the hot collection
+            - queries over a time range should only read the overlapping partitions
+            - find and count should cover the hot collection and the partitions
+        """
+        now = datetime(2026, 10, 18, 12)
+        self.db.sent.insert([
+            {'receiver_entity_id': '1', 'time_received': datetime(2026, 10, 1, 9)},
+            {'receiver_entity_id': '1', 'time_received': datetime(2026, 10, 1, 17)},
+            {'receiver_entity_id': '2', 'time_received': datetime(2026, 10, 2, 9)},
+            {'receiver_entity_id': '1', 'time_received': datetime(2026, 10, 17, 9)},
+        ])
+
+        self.subject.archive(now).should.equal(3)
+
+        self.db.sent.count().should.equal(1)
+        self.db.sent_2026_10_01.count().should.equal(2)
+        self.db.sent_2026_10_02.count().should.equal(1)
+
+        [c.name for c in self.subject.collections()].should.equal(['sent', 'sent_2026_10_01', 'sent_2026_10_02'])
+        [c.name for c in self.subject.collections(start=datetime(2026, 10, 2))].should.equal(['sent', 'sent_2026_10_02'])
+        [c.name for c in self.subject.collections(end=datetime(2026, 10, 2))].should.equal(['sent', 'sent_2026_10_01'])
+
+        self.subject.count({'receiver_entity_id': '1'}).should.equal(3)
+        len(list(self.subject.find({'receiver_entity_id': '1'}, start=datetime(2026, 10, 2)))).should.equal(1)
+        self.subject.find_one({'receiver_entity_id': '2'})['time_received'].should.equal(datetime(2026, 10, 2, 9))
+
+        self.subject.archive(now).should.equal(0)
+
+    def test_find_page(self):
+        """
+        MessageArchive.find_page() Test plan:
+            - should return documents from the hot collection and the partitions in time_received order
+            - should return at most limit documents
+            - should continue after the (time_received, _id) of the last document of the previous page
+            - should order documents received at the same time by _id
+        """
+        now = datetime(2026, 10, 18, 12)
+        ids = self.db.sent.insert([
+            {'receiver_entity_id': '1', 'time_received': datetime(2026, 10, 17, 9)},
+            {'receiver_entity_id': '1', 'time_received': datetime(2026, 10, 1, 9)},
+            {'receiver_entity_id': '1', 'time_received': datetime(2026, 10, 2, 9)},
+            {'receiver_entity_id': '2', 'time_received': datetime(2026, 10, 2, 10)},
+            {'receiver_entity_id': '1', 'time_received': datetime(2026, 10, 18, 9)},
+            {'receiver_entity_id': '1', 'time_received': datetime(2026, 10, 18, 9)},
+        ])
+        self.subject.archive(now)
+
+        def after(page):
+            return page[-1]['time_received'], page[-1]['_id']
+
+        page = self.subject.find_page({'receiver_entity_id': '1'}, 2)
+        [d['_id'] for d in page].should.equal([ids[1], ids[2]])
+
+        page = self.subject.find_page({'receiver_entity_id': '1'}, 2, after(page))
+        [d['_id'] for d in page].should.equal([ids[0], ids[4]])
+
+        page = self.subject.find_page({'receiver_entity_id': '1'}, 2, after(page))
+        [d['_id'] for d in page].should.equal([ids[5]])
+
+        page = self.subject.find_page({'receiver_entity_id': '1'}, 2, after(page))
+        page.should.equal([])
+
+    def test_drop_before(self):
+        """
+        MessageArchive.drop_before() Test plan:
+            - should drop the partitions that end before the given time
+            - should keep the hot collection and newer partitions
+        """
+        self.db.sent.insert([
+            {'time_received': datetime(2026, 10, 1, 9)},
+            {'time_received': datetime(2026, 10, 2, 9)},
+        ])
+        self.subject.archive(datetime(2026, 10, 18))
+
+        self.subject.drop_before(datetime(2026, 10, 2, 12)).should.equal(['sent_2026_10_01'])
+
+        [c.name for c in self.subject.collections()].should.equal(['sent', 'sent_2026_10_02'])
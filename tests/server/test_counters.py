@@ -0,0 +1,72 @@
+import sure
+from mock import patch
+
+from datetime import datetime, timedelta
+
+from hpit.server.counters import RollingCounters
+
+from tests.server import MongoTestCase
+
+NOW = datetime(2026, 10, 18, 12, 30, 30, 500000)
+
+class FrozenDatetime(datetime):
+    """
+    A datetime whose now() stays in the middle of a second, so events are never
+    split across buckets or windows by the wall clock.
+    """
+
+    @classmethod
+    def now(cls, tz=None):
+        return NOW
+
+class TestRollingCounters(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.clock = patch('hpit.server.counters.datetime', FrozenDatetime)
+        self.clock.start()
+        self.subject = RollingCounters(self.mongo)
+
+    def tearDown(self):
+        self.clock.stop()
+        super().tearDown()
+
+    def test_counts(self):
+        """
+        RollingCounters.counts() Test plan:
+            - recorded events should be counted in every window
+            - events should be counted per metric
+            - older buckets should only count in the longer windows
+        """
+        self.subject.record('messages_created', [('tutor', 'plugin_a'), ('tutor', 'plugin_b')])
+        self.subject.record('messages_received', [('tutor', 'plugin_a')])
+
+        self.subject.counts('messages_created').should.equal((2, 2, 2, 2))
+        self.subject.counts('messages_received').should.equal((1, 1, 1, 1))
+
+        self.db.metric_counters.insert({
+            'metric': 'messages_created',
+            'granularity': 'hour',
+            'time': NOW - timedelta(hours=3),
+            'total': 5,
+            'pairs': {'tutor|plugin_a': 5},
+        })
+
+        self.subject.counts('messages_created').should.equal((2, 2, 2, 7))
+
+    def test_counts_by_entity(self):
+        """
+        RollingCounters.counts() senders and receivers Test plan:
+            - should count the events sent by one of the senders or received by one of the receivers
+            - should handle entity ids that are not valid MongoDB field names
+        """
+        self.subject.record('messages_created', [
+            ('tutor.1', 'plugin_a'),
+            ('tutor.2', 'plugin_a'),
+            ('tutor.2', 'plugin_b'),
+        ])
+
+        self.subject.counts('messages_created', senders=['tutor.1'])[0].should.equal(1)
+        self.subject.counts('messages_created', receivers=['plugin_a'])[0].should.equal(2)
+        self.subject.counts('messages_created', ['tutor.1'], ['plugin_b'])[0].should.equal(2)
+        self.subject.counts('messages_created', ['tutor.3'], ['plugin_c'])[0].should.equal(0)
@@ -0,0 +1,101 @@
+import sure
+import unittest
+from mock import MagicMock
+
+from flask import Flask, Response, g, stream_with_context
+
+from hpit.server.metrics import RequestMetrics, _CountedCollection
+
+class TestRequestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.subject = RequestMetrics()
+
+    def test_summary(self):
+        """
+        RequestMetrics.summary() Test plan:
+            - should have one entry per route, busiest first
+            - should estimate percentiles from the latency histogram
+            - should average the response size and calls per request
+        """
+        for i in range(0, 98):
+            self.subject.record('/message', 'POST', 200, 0.004, 100, 2, 0)
+        self.subject.record('/message', 'POST', 200, 0.2, 300, 4, 0)
+        self.subject.record('/message', 'POST', 401, 3, 100, 0, 1)
+        self.subject.record('/ping', 'POST', 200, 0.001, 2, 0, 0)
+
+        summary = self.subject.summary()
+        [r['route'] for r in summary].should.equal(['/message', '/ping'])
+
+        message = summary[0]
+        message['count'].should.equal(100)
+        message['p50'].should.equal(0.005)
+        message['p95'].should.equal(0.005)
+        message['p99'].should.equal(0.25)
+        message['mean_bytes'].should.equal(102)
+        message['mongo_calls'].should.equal(2)
+        message['sql_calls'].should.equal(0.01)
+
+    def test_render(self):
+        """
+        RequestMetrics.render() Test plan:
+            - should count requests by route, method and status
+            - should render cumulative histogram buckets
+            - should render the call and size counters
+        """
+        self.subject.record('/message', 'POST', 200, 0.03, 100, 2, 1)
+        self.subject.record('/message', 'POST', 200, 0.3, 100, 2, 1)
+
+        text = self.subject.render()
+        text.should.contain('hpit_requests_total{route="/message",method="POST",status="200"} 2\n')
+        text.should.contain('hpit_request_duration_seconds_bucket{route="/message",le="0.025"} 0\n')
+        text.should.contain('hpit_request_duration_seconds_bucket{route="/message",le="0.05"} 1\n')
+        text.should.contain('hpit_request_duration_seconds_bucket{route="/message",le="+Inf"} 2\n')
+        text.should.contain('hpit_request_duration_seconds_count{route="/message"} 2\n')
+        text.should.contain('hpit_response_size_bytes_total{route="/message"} 200\n')
+        text.should.contain('hpit_mongo_calls_total{route="/message"} 4\n')
+        text.should.contain('hpit_sql_calls_total{route="/message"} 2\n')
+
+    def test_counted_collection(self):
+        """
+        CountedPyMongo collections Test plan:
+            - calls that make a round trip should be counted into the request, a find once
+            - chained cursor calls should stay counted
+            - other calls should not be counted
+        """
+        cursor = MagicMock()
+        cursor.sort.return_value = cursor
+        collection = MagicMock()
+        collection.find.return_value = cursor
+
+        with Flask(__name__).test_request_context():
+            g.metrics_mongo_calls = 0
+            subject = _CountedCollection(collection)
+
+            subject.find({}).sort('_id', 1).count()
+            subject.insert({})
+            subject.create_index('a')
+
+            g.metrics_mongo_calls.should.equal(3)
+
+    def test_streamed_response(self):
+        """
+        RequestMetrics streamed responses Test plan:
+            - should be recorded when the response closes, with the bytes streamed
+        """
+        app = Flask(__name__)
+        self.subject.init_app(app)
+
+        @app.route('/stream')
+        def stream():
+            return Response(stream_with_context(chunk for chunk in ['ab', 'cde']))
+
+        response = app.test_client().get('/stream')
+        self.subject.summary().should.equal([])
+
+        response.get_data().should.equal(b'abcde')
+        response.close()
+
+        summary = self.subject.summary()
+        [r['route'] for r in summary].should.equal(['/stream'])
+        summary[0]['mean_bytes'].should.equal(5)
@@ -0,0 +1,55 @@
+import sure
+import unittest
+import threading
+
+from hpit.server.notifier import MessageNotifier
+
+class TestMessageNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.subject = MessageNotifier()
+
+    def test_wait_timeout(self):
+        """
+        MessageNotifier.wait() Test plan:
+            - without a notify, wait should time out and return False
+            - a zero timeout should not block
+        """
+        with self.subject.listen('a') as listener:
+            listener.wait(0.05).should.equal(False)
+            listener.wait(0).should.equal(False)
+
+    def test_notify_wakes_listener(self):
+        """
+        MessageNotifier.notify() Test plan:
+            - a notify from another thread should wake the listener
+            - a notify on another channel should not
+        """
+        with self.subject.listen('a') as listener:
+            timer = threading.Timer(0.05, self.subject.notify, args=['b', 'a'])
+            timer.start()
+            listener.wait(5).should.equal(True)
+
+            self.subject.notify('b')
+            listener.wait(0.05).should.equal(False)
+
+    def test_notify_before_wait(self):
+        """
+        MessageNotifier.notify() before the listener waits should not be lost.
+        """
+        with self.subject.listen('a') as listener:
+            self.subject.notify('a')
+            listener.wait(0.05).should.equal(True)
+
+    def test_channels_cleaned_up(self):
+        """
+        MessageNotifier.listen() should forget channels nobody listens to.
+        """
+        with self.subject.listen('a'):
+            with self.subject.listen('a'):
+                pass
+            self.subject.channels.should.have.key('a')
+
+        self.subject.channels.should.equal({})
+        self.subject.notify('a')
+        self.subject.channels.should.equal({})
@@ -0,0 +1,61 @@
+import sure
+from mock import patch
+
+from hpit.server.queues import QueueDepths
+
+from tests.server import MongoTestCase
+
+class TestQueueDepths(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.subject = QueueDepths(self.mongo)
+
+    def test_depths(self):
+        """
+        QueueDepths.depths() Test plan:
+            - should count the queued messages of the given receivers
+            - messages added between counts should be included
+            - refresh should recount a receiver from plugin_messages
+        """
+        self.db.plugin_messages.insert([
+            {'receiver_entity_id': 'a'},
+            {'receiver_entity_id': 'a'},
+            {'receiver_entity_id': 'b'},
+        ])
+
+        self.subject.depths(['a', 'b', 'c']).should.equal({'a': 2, 'b': 1, 'c': 0})
+
+        self.subject.add('a', 3)
+        self.subject.add('c', 1)
+        self.subject.depth('a').should.equal(5)
+        self.subject.depth('c').should.equal(1)
+        self.subject.depth('d').should.equal(0)
+
+        self.db.plugin_messages.remove({'receiver_entity_id': 'a'})
+        self.subject.depth('a').should.equal(5)
+        self.subject.refresh('a')
+        self.subject.depths(['a', 'b']).should.equal({'a': 0, 'b': 1})
+
+    def test_full(self):
+        """
+        QueueDepths.full() Test plan:
+            - a plugin's own max_queue_depth should be its limit
+            - plugins without one should use MAX_QUEUE_DEPTH, no limit if it is None
+            - plugins without a limit should not be counted
+        """
+        self.subject.add('a', 2)
+        self.subject.add('b', 5)
+        self.subject.refresh = lambda entity_id: None
+        self.subject.counted = {'a': float('inf'), 'b': float('inf')}
+
+        self.subject.full({'a': 2, 'b': 10}).should.equal({'a'})
+        self.subject.full({'a': None, 'b': None}).should.equal(set())
+
+        with patch('hpit.server.queues.MAX_QUEUE_DEPTH', 5):
+            self.subject.full({'a': None, 'b': None}).should.equal({'b'})
+            self.subject.full({'a': None, 'b': 6}).should.equal(set())
+
+        with patch.object(self.subject, 'depths') as depths:
+            self.subject.full({'a': None})
+            depths.called.should.equal(False)
@@ -0,0 +1,65 @@
+import sure
+
+from datetime import datetime, timedelta
+
+from hpit.server.archive import MessageArchive
+from hpit.server.rollups import ResponseRollups
+
+from tests.server import MongoTestCase
+
+class TestResponseRollups(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        archive = MessageArchive(self.mongo, 'sent_responses', 'sent_responses_', 'time_response_received')
+        self.subject = ResponseRollups(self.mongo, archive)
+
+    def response_helper(self, message_name, created, latency):
+        self.db.sent_responses.insert({
+            'message': {'message_name': message_name, 'time_created': created},
+            'time_response_received': created + timedelta(seconds=latency),
+        })
+
+    def test_run(self):
+        """
+        ResponseRollups.run() Test plan:
+            - should sum the responses per hour and message name
+            - should build a latency histogram
+            - a second run should only add the responses received since the first
+        """
+        now = datetime(2026, 10, 18, 12)
+        self.response_helper('a', datetime(2026, 10, 18, 9, 10), 2)
+        self.response_helper('a', datetime(2026, 10, 18, 9, 50), 4)
+        self.response_helper('b', datetime(2026, 10, 18, 9, 20), 0.2)
+
+        self.subject.run(now).should.equal(3)
+
+        rollup = self.db.response_rollups.find_one({'hour': datetime(2026, 10, 18, 9), 'message_name': 'a'})
+        rollup['count'].should.equal(2)
+        rollup['latency_sum'].should.equal(6)
+        rollup['histogram'].should.equal({'4': 1, '5': 1})
+
+        self.subject.run(now + timedelta(hours=1)).should.equal(0)
+
+        self.response_helper('a', datetime(2026, 10, 18, 13, 10), 1)
+        self.subject.run(now + timedelta(hours=2)).should.equal(1)
+        self.db.response_rollups.count().should.equal(3)
+
+    def test_hours(self):
+        """
+        ResponseRollups.hours() Test plan:
+            - should sum the message names of each hour, oldest first
+            - should leave out the excluded message names and hours outside the range
+        """
+        self.response_helper('a', datetime(2026, 10, 18, 9, 10), 2)
+        self.response_helper('b', datetime(2026, 10, 18, 9, 20), 4)
+        self.response_helper('ping', datetime(2026, 10, 18, 9, 30), 1)
+        self.response_helper('a', datetime(2026, 10, 18, 8, 10), 1)
+        self.response_helper('a', datetime(2026, 10, 18, 11, 10), 1)
+        self.subject.run(datetime(2026, 10, 18, 12))
+
+        hours = self.subject.hours(datetime(2026, 10, 18, 8), datetime(2026, 10, 18, 10), ['ping'])
+        [(h[0], h[1], h[2]) for h in hours].should.equal([
+            (datetime(2026, 10, 18, 8), 1, 1),
+            (datetime(2026, 10, 18, 9), 2, 6),
+        ])
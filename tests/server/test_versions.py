@@ -0,0 +1,48 @@
+import sure
+import unittest
+from mock import MagicMock
+
+from flask import Flask
+
+from hpit.server.versions import SharedVersion
+
+class TestSharedVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.mongo = MagicMock()
+        self.mongo.db.cache_versions.find_one.return_value = {'version': 'a'}
+        self.subject = SharedVersion(self.mongo, 'test')
+        self.app = Flask(__name__)
+
+    def test_current_outside_request(self):
+        """
+        SharedVersion.current() Test plan:
+            - outside a request, should read the stamp every time
+            - should return None if there is no stamp
+        """
+        self.subject.current().should.equal('a')
+        self.subject.current().should.equal('a')
+        self.mongo.db.cache_versions.find_one.call_count.should.equal(2)
+
+        self.mongo.db.cache_versions.find_one.return_value = None
+        self.subject.current().should.equal(None)
+
+    def test_current_in_request(self):
+        """
+        SharedVersion.current() Test plan:
+            - within a request, should read the stamp once
+            - a bump in the request should be seen by the rest of the request
+            - the next request should read the stamp again
+        """
+        with self.app.test_request_context():
+            self.subject.current().should.equal('a')
+            self.subject.current().should.equal('a')
+            self.mongo.db.cache_versions.find_one.call_count.should.equal(1)
+
+            self.subject.bump()
+            self.subject.current().should_not.equal('a')
+            self.mongo.db.cache_versions.find_one.call_count.should.equal(1)
+
+        with self.app.test_request_context():
+            self.subject.current().should.equal('a')
+            self.mongo.db.cache_versions.find_one.call_count.should.equal(2)
@@ -19,6 +19,9 @@ mongo = app_instance.mongo
 db = app_instance.db
 csrf = app_instance.csrf
 
+from hpit.server.routing import SubscriptionRoutingTable
+routing_table = SubscriptionRoutingTable.get_instance()
+
 from uuid import uuid4
 
 from pymongo import MongoClient
@@ -273,25 +276,25 @@ class TestServerAPI(unittest.TestCase):
                 'entity_id':self.plugin_entity_id,
                 'deleted':False,
                 'log_entry':"This is a log entry",
-                'created_on': datetime.now().isoformat(),
+                'created_on': datetime.now(),
             },
             {
                 'entity_id':self.plugin_entity_id,
                 'deleted':False,
                 'log_entry':"This is another log entry",
-                'created_on': datetime.now().isoformat(),
+                'created_on': datetime.now(),
             },
             {
                 'entity_id':"1234",
                 'deleted':False,
                 'log_entry':"This is a log entry from another entity.",
-                'created_on': datetime.now().isoformat(),
+                'created_on': datetime.now(),
             },
             {
                 'entity_id':self.plugin_entity_id,
                 'deleted':True,
                 'log_entry':"This is a deleted log entry",
-                'created_on': datetime.now().isoformat(),
+                'created_on': datetime.now(),
             },
         ])
         
@@ -308,6 +311,43 @@ class TestServerAPI(unittest.TestCase):
         
         self.disconnect_helper("plugin")
     
+    def test_log_list_pages(self):
+        """
+        api.log_list() Test plan:
+            - bad parameter raised for an invalid since or limit
+            - should return at most limit entries, oldest first, with a next cursor
+            - passing next as since should return the following page
+            - the page after the last should be empty with a null cursor
+        """
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].entity_log.insert([{
+            'entity_id':self.plugin_entity_id,
+            'deleted':False,
+            'log_entry':"Log entry " + str(i),
+            'created_on': datetime.now(),
+        } for i in range(0, 3)])
+        
+        self.connect_helper("plugin")
+        
+        response = self.test_client.get("/log/list?since=notanid")
+        response.data.should.contain(b'Missing parameter: since')
+        
+        response = self.test_client.get("/log/list?limit=0")
+        response.data.should.contain(b'Missing parameter: limit')
+        
+        result = json.loads(self.test_client.get("/log/list?limit=2").get_data().decode('utf-8'))
+        [e['log_entry'] for e in result['log']].should.equal(["Log entry 0", "Log entry 1"])
+        result['next'].should.end_with('_' + result['log'][-1]['_id'])
+        
+        result = json.loads(self.test_client.get("/log/list?limit=2&since=" + result['next']).get_data().decode('utf-8'))
+        [e['log_entry'] for e in result['log']].should.equal(["Log entry 2"])
+        
+        result = json.loads(self.test_client.get("/log/list?limit=2&since=" + result['next']).get_data().decode('utf-8'))
+        result['log'].should.equal([])
+        result['next'].should.equal(None)
+        
+        self.disconnect_helper("plugin")
+    
     def test_log_clear(self):
         """
         api.log_clear() Test plan:
@@ -340,6 +380,37 @@ class TestServerAPI(unittest.TestCase):
         
         self.disconnect_helper("plugin")
         
+    def test_log_batch(self):
+        """
+        api.log_batch() Test plan:
+            - no auth raised if entity_id not in session
+            - bad parameter raised if log_entries missing or not a list
+            - all log entries should be present
+            - ok response returned
+        """
+        response = self.test_client.post("/log/batch",data = json.dumps({"log_entries":["log"]}),content_type="application/json")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+        
+        self.connect_helper("plugin")
+        
+        response = self.test_client.post("/log/batch",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: log_entries')
+        
+        response = self.test_client.post("/log/batch",data = json.dumps({"log_entries":"log"}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: log_entries')
+        
+        response = self.test_client.post("/log/batch",data = json.dumps({"log_entries":["first entry", "second entry"]}),content_type="application/json")
+        response.data.should.contain(b'OK')
+        
+        client = MongoClient()
+        entries = client[settings.MONGO_DBNAME].entity_log.find({
+                "entity_id":self.plugin_entity_id,
+                'deleted':False
+        })
+        sorted([e['log_entry'] for e in entries]).should.equal(["first entry", "second entry"])
+        
+        self.disconnect_helper("plugin")
+        
     def test_subscribe(self):
         """
         api.subscribe() Test plan:
@@ -485,16 +556,19 @@ class TestServerAPI(unittest.TestCase):
             {
                 'receiver_entity_id':self.plugin_entity_id,
                 'message_name':"some_message",
+                'time_received':datetime.now(),
                 'payload':{"msg":"Valid payload 1"},
             },
             {
                 'receiver_entity_id':self.plugin_entity_id,
                 'message_name':"some_message",
+                'time_received':datetime.now(),
                 'payload':{"msg":"Valid payload 2"},
             },
             {
                 'receiver_entity_id':self.plugin_entity_id,
                 'message_name':"transaction",
+                'time_received':datetime.now(),
                 'payload':{"msg":"Bad payload"},
             }
         ])
@@ -716,6 +790,263 @@ class TestServerAPI(unittest.TestCase):
         response.data.should_not.contain(b'OLD')
         response.data.should_not.contain(b'OLD2')
 
+    def test_plugin_message_list_wait(self):
+        """
+        api.plugin_message_list() long-polling:
+            - a malformed wait should return a bad parameter response
+            - with nothing queued, should wait and return an empty list
+            - with a message queued, should return it without waiting
+        """
+        self.connect_helper("plugin")
+        
+        response = self.test_client.get("/plugin/message/list?wait=bogus")
+        response.data.should.contain(b'Missing parameter:')
+        
+        response = self.test_client.get("/plugin/message/list?wait=-1")
+        response.data.should.contain(b'Missing parameter:')
+        
+        start = datetime.now()
+        response = self.test_client.get("/plugin/message/list?wait=0.2")
+        json.loads(response.get_data().decode('utf-8'))["messages"].should.equal([])
+        (datetime.now() - start).should.be.greater_than(timedelta(seconds=0.2))
+        
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        self.test_client.post("/message",data = json.dumps({"name":"test","payload":{"test":"Waited for"}}),content_type="application/json")
+        
+        start = datetime.now()
+        response = self.test_client.get("/plugin/message/list?wait=10")
+        response.data.should.contain(b'Waited for')
+        (datetime.now() - start).should.be.lower_than(timedelta(seconds=10))
+        
+        self.disconnect_helper("plugin")
+
+    def test_plugin_message_list_max_messages(self):
+        """
+        api.plugin_message_list() max_messages:
+            - a malformed max_messages should return a bad parameter response
+            - should return at most max_messages messages, oldest first
+            - messages claimed by another poll should not be returned
+        """
+        self.connect_helper("plugin")
+        
+        response = self.test_client.get("/plugin/message/list?max_messages=0")
+        response.data.should.contain(b'Missing parameter:')
+        
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].plugin_messages.insert([{
+                'receiver_entity_id':self.plugin_entity_id,
+                'message_name':"some_message",
+                'payload':{"msg":"Message " + str(i)},
+                'message_id':ObjectId(),
+                'sender_entity_id':"1",
+                'time_created':datetime.now(),
+            } for i in range(0, 3)])
+        client[settings.MONGO_DBNAME].plugin_messages.insert({
+                'receiver_entity_id':self.plugin_entity_id,
+                'message_name':"some_message",
+                'payload':{"msg":"Claimed elsewhere"},
+                'message_id':ObjectId(),
+                'sender_entity_id':"1",
+                'time_created':datetime.now(),
+                'claim_token':"another poll",
+            })
+        
+        response = self.test_client.get("/plugin/message/list?max_messages=2")
+        response.data.should.contain(b'Message 0')
+        response.data.should.contain(b'Message 1')
+        response.data.should_not.contain(b'Message 2')
+        
+        response = self.test_client.get("/plugin/message/list?max_messages=2")
+        response.data.should.contain(b'Message 2')
+        response.data.should_not.contain(b'Claimed elsewhere')
+        
+        client[settings.MONGO_DBNAME].plugin_messages.count().should.equal(1)
+        
+        self.disconnect_helper("plugin")
+
+    def test_plugin_message_list_expired_lease(self):
+        """
+        api.plugin_message_list() leases:
+            - messages claimed by another consumer with a live lease should not be returned
+            - messages whose lease has expired should be redelivered
+            - delivered messages should record the consumer and lease expiry
+        """
+        self.connect_helper("plugin")
+        
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].plugin_messages.insert([{
+                'receiver_entity_id':self.plugin_entity_id,
+                'message_name':"some_message",
+                'payload':{"msg":"Lease " + state},
+                'message_id':ObjectId(),
+                'sender_entity_id':"1",
+                'time_created':datetime.now(),
+                'claim_token':"another consumer",
+                'lease_expires':lease_expires,
+            } for state, lease_expires in [
+                ("live", datetime.now() + timedelta(hours=1)),
+                ("expired", datetime.now() - timedelta(hours=1))]])
+        
+        response = self.test_client.get("/plugin/message/list")
+        
+        response.data.should.contain(b'Lease expired')
+        response.data.should_not.contain(b'Lease live')
+        
+        client[settings.MONGO_DBNAME].plugin_messages.count().should.equal(1)
+        
+        claimed = client[settings.MONGO_DBNAME].sent_messages_and_transactions.find_one({'payload.msg':"Lease expired"})
+        claimed['claim_token'].shouldnt.equal("another consumer")
+        claimed['claimed_by'].should_not.be(None)
+        claimed['lease_expires'].should.be.greater_than(datetime.now())
+        
+        self.disconnect_helper("plugin")
+
+    def test_plugin_message_list_priorities(self):
+        """
+        api.plugin_message_list() priorities:
+            - queued messages should carry the priority of their message name from MESSAGE_PRIORITIES
+            - higher priority messages should be delivered first
+            - messages with the same priority should be delivered oldest first
+        """
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"bulk"}),content_type="application/json")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"hint"}),content_type="application/json")
+        
+        with patch('hpit.server.views.api.MESSAGE_PRIORITIES', {"hint": 10}):
+            for name, text in [("bulk", "Bulk 1"), ("bulk", "Bulk 2"), ("hint", "Hint 1"), ("bulk", "Bulk 3"), ("hint", "Hint 2")]:
+                self.test_client.post("/message",data = json.dumps({"name":name,"payload":{"msg":text}}),content_type="application/json")
+        
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].plugin_messages.find({'message_name':"hint",'priority':10}).count().should.equal(2)
+        client[settings.MONGO_DBNAME].plugin_messages.find({'message_name':"bulk",'priority':0}).count().should.equal(3)
+        
+        response = self.test_client.get("/plugin/message/list?max_messages=3")
+        messages = json.loads(response.get_data().decode('utf-8'))['messages']
+        [m['message']['msg'] for m in messages].should.equal(["Hint 1", "Hint 2", "Bulk 1"])
+        
+        response = self.test_client.get("/plugin/message/list")
+        messages = json.loads(response.get_data().decode('utf-8'))['messages']
+        [m['message']['msg'] for m in messages].should.equal(["Bulk 2", "Bulk 3"])
+        
+        self.disconnect_helper("plugin")
+
+    def test_plugin_message_ack(self):
+        """
+        api.plugin_message_ack():
+            - should only be accessible by a connected entity
+            - should reject missing or malformed message_ids
+            - messages polled with ack=true should stay queued until acknowledged
+            - acknowledged messages should be moved to sent_messages_and_transactions
+            - responding to a message should acknowledge it
+            - messages leased to another session, or whose lease expired, should not be acknowledged
+        """
+        response = self.test_client.post("/plugin/message/ack", data=json.dumps({
+                "message_ids":[],
+            }), content_type="application/json")
+        response.data.should.contain(b'Could not authenticate')
+        
+        self.connect_helper("plugin")
+        
+        response = self.test_client.post("/plugin/message/ack", data=json.dumps({
+            }), content_type="application/json")
+        response.data.should.contain(b'Missing parameter: message_ids')
+        
+        response = self.test_client.post("/plugin/message/ack", data=json.dumps({
+                "message_ids":["not an id"],
+            }), content_type="application/json")
+        response.data.should.contain(b'Missing parameter: message_ids[0]')
+        
+        message_ids = [ObjectId(), ObjectId()]
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].plugin_messages.insert([{
+                'receiver_entity_id':self.plugin_entity_id,
+                'message_name':"some_message",
+                'payload':{"msg":"Message " + str(i)},
+                'message_id':message_id,
+                'sender_entity_id':"1",
+                'session_token':"1",
+                'time_created':datetime.now(),
+            } for i, message_id in enumerate(message_ids)])
+        
+        response = self.test_client.get("/plugin/message/list?ack=true")
+        response.data.should.contain(b'Message 0')
+        response.data.should.contain(b'Message 1')
+        
+        response = self.test_client.get("/plugin/message/list?ack=true")
+        response.data.should_not.contain(b'Message')
+        client[settings.MONGO_DBNAME].plugin_messages.count().should.equal(2)
+        
+        response = self.test_client.post("/plugin/message/ack", data=json.dumps({
+                "message_ids":[str(message_ids[0])],
+            }), content_type="application/json")
+        json.loads(response.data.decode('utf-8'))['message_ids'].should.equal([str(message_ids[0])])
+        
+        response = self.test_client.post("/response", data=json.dumps({
+                "message_id":str(message_ids[1]),
+                "payload":{"msg":"Response"},
+            }), content_type="application/json")
+        response.data.should.contain(b'response_id')
+        
+        client[settings.MONGO_DBNAME].plugin_messages.count().should.equal(0)
+        client[settings.MONGO_DBNAME].sent_messages_and_transactions.count().should.equal(2)
+        
+        other_ids = [ObjectId(), ObjectId()]
+        client[settings.MONGO_DBNAME].plugin_messages.insert([{
+                'receiver_entity_id':self.plugin_entity_id,
+                'message_name':"some_message",
+                'payload':{"msg":"Leased message"},
+                'message_id':other_ids[0],
+                'claim_token':"1",
+                'claimed_by':"another session",
+                'lease_expires':datetime.now() + timedelta(seconds=60),
+            }, {
+                'receiver_entity_id':self.plugin_entity_id,
+                'message_name':"some_message",
+                'payload':{"msg":"Expired message"},
+                'message_id':other_ids[1],
+                'claim_token':"2",
+                'claimed_by':"another session",
+                'lease_expires':datetime.now() - timedelta(seconds=60),
+            }])
+        
+        response = self.test_client.post("/plugin/message/ack", data=json.dumps({
+                "message_ids":[str(m) for m in other_ids],
+            }), content_type="application/json")
+        json.loads(response.data.decode('utf-8'))['message_ids'].should.equal([])
+        client[settings.MONGO_DBNAME].plugin_messages.count().should.equal(2)
+        
+        self.disconnect_helper("plugin")
+
+    def test_plugin_message_stream(self):
+        """
+        api.plugin_message_stream() Test plan:
+            - If not connected, should return an auth_failed
+            - queued messages should be pushed as events and moved to sent_messages_and_transactions
+        """
+        response = self.test_client.get("/plugin/message/stream")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+        
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        self.test_client.post("/message",data = json.dumps({"name":"test","payload":{"test":"Streamed"}}),content_type="application/json")
+        
+        response = self.test_client.get("/plugin/message/stream", buffered=False)
+        response.mimetype.should.equal("text/event-stream")
+        
+        event = next(iter(response.response))
+        event.should.contain(b'data: ')
+        event.should.contain(b'Streamed')
+        response.close()
+        
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].plugin_messages.count().should.equal(0)
+        client[settings.MONGO_DBNAME].sent_messages_and_transactions.find({
+            'receiver_entity_id':self.plugin_entity_id,
+            'payload':{"test":"Streamed"}
+        }).count().should.equal(1)
+        
+        self.disconnect_helper("plugin")
+
     def test_plugin_transaction_list(self):
         """
         api.plugin_transaction_list() Test plan:
@@ -816,6 +1147,352 @@ class TestServerAPI(unittest.TestCase):
         ).count().should.equal(1)
         
         
+    def test_message_routing_table(self):
+        """
+        api.message() routing table:
+            - routing a message should not query subscriptions once the table is built
+            - subscribe and unsubscribe should invalidate the table
+        """
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        self.test_client.post("/message",data = json.dumps({"name":"test","payload":{"test":"test"}}),content_type="application/json")
+        
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].plugin_messages.find({'message_name':"test"}).count().should.equal(1)
+        
+        with patch.object(db.session, 'query') as mock_query:
+            self.test_client.post("/message",data = json.dumps({"name":"test","payload":{"test":"test"}}),content_type="application/json")
+            mock_query.called.should.equal(False)
+        
+        client[settings.MONGO_DBNAME].plugin_messages.find({'message_name':"test"}).count().should.equal(2)
+        
+        self.test_client.post("/plugin/unsubscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        self.test_client.post("/message",data = json.dumps({"name":"test","payload":{"test":"test"}}),content_type="application/json")
+        
+        client[settings.MONGO_DBNAME].plugin_messages.find({'message_name':"test"}).count().should.equal(2)
+        
+        self.disconnect_helper("plugin")
+        
+    def test_message_shared_payloads(self):
+        """
+        api.message() with SHARED_MESSAGE_PAYLOADS:
+            - plugin_messages copies should not carry the payload
+            - plugin_message_list should still return the payload
+        """
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        
+        with patch('hpit.server.views.api.SHARED_MESSAGE_PAYLOADS', True):
+            self.test_client.post("/message",data = json.dumps({"name":"test","payload":{"test":"Shared payload"}}),content_type="application/json")
+        
+        client = MongoClient()
+        plugin_message = client[settings.MONGO_DBNAME].plugin_messages.find_one({'message_name':"test"})
+        plugin_message.shouldnt.have.key('payload')
+        
+        response = self.test_client.get("/plugin/message/list")
+        response.data.should.contain(b'Shared payload')
+        
+        self.disconnect_helper("plugin")
+        
+    def test_message_ancestry(self):
+        """
+        api.message() ancestry:
+            - a message without a _seed_message_id should have no ancestors
+            - a message seeded by another should list that message's ancestors and the message, root first
+            - an unknown or malformed _seed_message_id should be ignored
+        """
+        self.connect_helper("plugin")
+        
+        def send(payload):
+            response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":payload}),content_type="application/json")
+            return json.loads(response.data.decode('utf-8'))['message_id']
+        
+        root_id = send({"step":"root"})
+        child_id = send({"step":"child","_seed_message_id":root_id})
+        grandchild_id = send({"step":"grandchild","_seed_message_id":child_id})
+        unknown_id = send({"step":"unknown","_seed_message_id":str(ObjectId())})
+        malformed_id = send({"step":"malformed","_seed_message_id":"not an id"})
+        
+        messages = MongoClient()[settings.MONGO_DBNAME].messages_and_transactions
+        messages.find_one({'_id':ObjectId(root_id)})['ancestors'].should.equal([])
+        messages.find_one({'_id':ObjectId(child_id)})['ancestors'].should.equal([ObjectId(root_id)])
+        messages.find_one({'_id':ObjectId(grandchild_id)})['ancestors'].should.equal([ObjectId(root_id), ObjectId(child_id)])
+        messages.find_one({'_id':ObjectId(unknown_id)})['ancestors'].should.equal([])
+        messages.find_one({'_id':ObjectId(malformed_id)})['ancestors'].should.equal([])
+        
+        messages.find({'ancestors':ObjectId(root_id)}).count().should.equal(2)
+        
+        self.disconnect_helper("plugin")
+        
+    def test_message_call(self):
+        """
+        api.message_call() Test plan:
+            - if not connected, should return auth failed
+            - bad parameter raised for a missing name or a bad timeout
+            - the message should be routed to subscribers
+            - with no response in time, should return 504 with the message id
+            - a response to the message should be returned inline and moved to sent_responses
+            - a message nobody is subscribed to should return 404 without waiting
+            - a retry that loses the idempotency key race should wait on the original message
+        """
+        response = self.test_client.post("/message/call",data = json.dumps({"name":"test","payload":{}}),content_type="application/json")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+        
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        
+        response = self.test_client.post("/message/call",data = json.dumps({"payload":{}}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: name')
+        
+        response = self.test_client.post("/message/call",data = json.dumps({"name":"test","payload":{},"timeout":"soon"}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: timeout')
+        
+        response = self.test_client.post("/message/call",data = json.dumps({"name":"test","payload":{},"timeout":0}),content_type="application/json")
+        response.status_code.should.equal(504)
+        message_id = json.loads(response.get_data().decode('utf-8'))['message_id']
+        
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].plugin_messages.find({'message_id':ObjectId(message_id)}).count().should.equal(1)
+        
+        client[settings.MONGO_DBNAME].responses.insert({
+            'message_id': ObjectId(),
+            'receiver_entity_id': self.plugin_entity_id,
+            'session_token': "other",
+            'message': {},
+            'response': {"answer": "Other response"},
+        })
+        
+        def respond(messages):
+            client[settings.MONGO_DBNAME].responses.insert({
+                'message_id': messages[0]['_id'],
+                'receiver_entity_id': messages[0]['sender_entity_id'],
+                'session_token': messages[0]['session_token'],
+                'message': {'message_name': "test"},
+                'response': {"answer": "Inline response"},
+            })
+            return {self.plugin_entity_id}
+        
+        with patch('hpit.server.views.api._route_messages', side_effect=respond):
+            response = self.test_client.post("/message/call",data = json.dumps({"name":"test","payload":{},"timeout":5}),content_type="application/json")
+        
+        response.status_code.should.equal(200)
+        response.data.should.contain(b'Inline response')
+        response.data.should_not.contain(b'Other response')
+        client[settings.MONGO_DBNAME].sent_responses.find({'response.answer':"Inline response"}).count().should.equal(1)
+        
+        with patch('hpit.server.views.api._long_poll') as long_poll:
+            response = self.test_client.post("/message/call",data = json.dumps({"name":"nobody","payload":{},"timeout":5}),content_type="application/json")
+        
+        response.status_code.should.equal(404)
+        json.loads(response.get_data().decode('utf-8'))['error'].should.equal("no subscribers")
+        long_poll.called.should.equal(False)
+        
+        client[settings.MONGO_DBNAME].idempotency_keys.create_index([
+            ('sender_entity_id', 1),
+            ('idempotency_key', 1)
+        ], unique=True)
+        original_id = ObjectId()
+        client[settings.MONGO_DBNAME].idempotency_keys.insert({
+            'sender_entity_id': self.plugin_entity_id,
+            'idempotency_key': "raced",
+            'message_id': original_id,
+        })
+        
+        #The key is stored between the route's lookup and its own insert.
+        with patch('hpit.server.views.api._sent_message_id', return_value=None):
+            with patch('hpit.server.views.api._long_poll', return_value=[]) as long_poll:
+                response = self.test_client.post("/message/call",data = json.dumps({"name":"nobody","payload":{},"timeout":5,"idempotency_key":"raced"}),content_type="application/json")
+        
+        response.status_code.should.equal(504)
+        json.loads(response.get_data().decode('utf-8'))['message_id'].should.equal(str(original_id))
+        long_poll.called.should.equal(True)
+        
+        self.disconnect_helper("plugin")
+        
+    def test_message_queue_limit(self):
+        """
+        api.message() queue limits:
+            - messages should be queued while the subscriber's queue is below its max_queue_depth
+            - with the reject policy, a full queue should return 429 with a Retry-After header and store nothing
+            - with the dead_letter policy, the copy for the full queue should go to dead_letter_messages
+        """
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        
+        plugin = Plugin.query.filter_by(entity_id=self.plugin_entity_id).first()
+        plugin.max_queue_depth = 1
+        db.session.add(plugin)
+        db.session.commit()
+        routing_table.invalidate()
+        
+        response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":{}}),content_type="application/json")
+        response.status_code.should.equal(200)
+        
+        response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":{}}),content_type="application/json")
+        response.status_code.should.equal(429)
+        response.headers['Retry-After'].should.equal("30")
+        
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].messages_and_transactions.find({'message_name':"test"}).count().should.equal(1)
+        client[settings.MONGO_DBNAME].plugin_messages.find({'message_name':"test"}).count().should.equal(1)
+        
+        with patch('hpit.server.views.api.QUEUE_OVERFLOW_POLICY', 'dead_letter'):
+            response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":{}}),content_type="application/json")
+        
+        response.status_code.should.equal(200)
+        client[settings.MONGO_DBNAME].plugin_messages.find({'message_name':"test"}).count().should.equal(1)
+        client[settings.MONGO_DBNAME].dead_letter_messages.find({
+            'message_name':"test",
+            'receiver_entity_id':self.plugin_entity_id
+        }).count().should.equal(1)
+        
+        self.disconnect_helper("plugin")
+        
+    def test_message_queue_limit_one_full(self):
+        """
+        api.message() queue limits with several subscribers:
+            - a full subscriber should not cause a 429 while another subscriber has room
+            - the message should be queued for the subscriber with room
+            - the copy for the full subscriber should go to dead_letter_messages
+        """
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        
+        plugin = Plugin.query.filter_by(entity_id=self.plugin_entity_id).first()
+        plugin.max_queue_depth = 0
+        db.session.add(plugin)
+        
+        healthy = Plugin()
+        healthy.name = "Healthy plugin"
+        healthy.description = "for testing."
+        healthy.entity_id = str(uuid4())
+        healthy.generate_key()
+        healthy.user = self.user
+        db.session.add(healthy)
+        db.session.commit()
+        
+        subscription = Subscription()
+        subscription.plugin_id = healthy.id
+        subscription.message_name = "test"
+        subscription.time = datetime.now()
+        db.session.add(subscription)
+        db.session.commit()
+        routing_table.invalidate()
+        
+        response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":{}}),content_type="application/json")
+        response.status_code.should.equal(200)
+        
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].plugin_messages.find({'receiver_entity_id':healthy.entity_id}).count().should.equal(1)
+        client[settings.MONGO_DBNAME].plugin_messages.find({'receiver_entity_id':self.plugin_entity_id}).count().should.equal(0)
+        client[settings.MONGO_DBNAME].dead_letter_messages.find({'receiver_entity_id':self.plugin_entity_id}).count().should.equal(1)
+        
+        self.disconnect_helper("plugin")
+        
+    def test_message_idempotency_key(self):
+        """
+        api.message() idempotency keys:
+            - a key that is not a string should return a bad parameter response
+            - a repeated key should return the original message_id without routing the message again
+            - a new key should submit a new message
+            - keys should be per sender and shared with /transaction
+            - a repeated key should return the original message_id even when the queue is full
+            - a key should be released when the message cannot be routed
+        """
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].idempotency_keys.create_index([
+            ('sender_entity_id', 1),
+            ('idempotency_key', 1)
+        ], unique=True)
+        
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        
+        response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":{},"idempotency_key":3}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: idempotency_key')
+        
+        response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":{},"idempotency_key":"abc"}),content_type="application/json")
+        message_id = json.loads(response.get_data().decode('utf-8'))['message_id']
+        
+        response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":{},"idempotency_key":"abc"}),content_type="application/json")
+        json.loads(response.get_data().decode('utf-8'))['message_id'].should.equal(message_id)
+        
+        client[settings.MONGO_DBNAME].messages_and_transactions.find({'message_name':"test"}).count().should.equal(1)
+        client[settings.MONGO_DBNAME].plugin_messages.find({'message_name':"test"}).count().should.equal(1)
+        
+        response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":{},"idempotency_key":"def"}),content_type="application/json")
+        json.loads(response.get_data().decode('utf-8'))['message_id'].should_not.equal(message_id)
+        client[settings.MONGO_DBNAME].plugin_messages.find({'message_name':"test"}).count().should.equal(2)
+        
+        response = self.test_client.post("/transaction",data = json.dumps({"payload":{},"idempotency_key":"abc"}),content_type="application/json")
+        json.loads(response.get_data().decode('utf-8'))['message_id'].should.equal(message_id)
+        client[settings.MONGO_DBNAME].messages_and_transactions.find({'message_name':"transaction"}).count().should.equal(0)
+        
+        plugin = Plugin.query.filter_by(entity_id=self.plugin_entity_id).first()
+        plugin.max_queue_depth = 1
+        db.session.add(plugin)
+        db.session.commit()
+        routing_table.invalidate()
+        
+        response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":{},"idempotency_key":"abc"}),content_type="application/json")
+        response.status_code.should.equal(200)
+        json.loads(response.get_data().decode('utf-8'))['message_id'].should.equal(message_id)
+        
+        with patch('hpit.server.views.api._route_messages', side_effect=RuntimeError):
+            self.test_client.post.when.called_with("/transaction",data = json.dumps({"payload":{},"idempotency_key":"ghi"}),content_type="application/json").should.throw(RuntimeError)
+        
+        client[settings.MONGO_DBNAME].idempotency_keys.find({'idempotency_key':"ghi"}).count().should.equal(0)
+        
+        self.disconnect_helper("plugin")
+        
+    def test_message_batch(self):
+        """
+        api.message_batch() Test plan:
+            - if not connected, should return an auth_failed
+            - messages param should be a list of valid messages, otherwise bad response
+            - messages should be written to db and routed to subscribers
+            - response should have the message_ids, in order
+        """
+        response = self.test_client.post("/message/batch",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+        
+        self.connect_helper("plugin")
+        response = self.test_client.post("/message/batch",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: messages')
+        
+        response = self.test_client.post("/message/batch",data = json.dumps({"messages":{"name":"test"}}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: messages')
+        
+        response = self.test_client.post("/message/batch",data = json.dumps({"messages":[
+            {"name":"test","payload":{"test":"test"}},
+            {"name":"transaction","payload":{"test":"test"}},
+        ]}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: messages[1].name')
+        
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].messages_and_transactions.count().should.equal(0)
+        
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        
+        response = self.test_client.post("/message/batch",data = json.dumps({"messages":[
+            {"name":"test","payload":{"order":1}},
+            {"name":"other","payload":{"order":2}},
+            {"name":"test","payload":{"order":3}},
+        ]}),content_type="application/json")
+        message_ids = json.loads(response.get_data().decode('utf-8'))["message_ids"]
+        len(message_ids).should.equal(3)
+        
+        for order, message_id in enumerate(message_ids):
+            message = client[settings.MONGO_DBNAME].messages_and_transactions.find_one({'_id':ObjectId(message_id)})
+            message["payload"]["order"].should.equal(order + 1)
+        
+        client[settings.MONGO_DBNAME].plugin_messages.find({
+            'receiver_entity_id':self.plugin_entity_id,
+            'message_name':"test",
+        }).count().should.equal(2)
+        
+        self.disconnect_helper("plugin")
+        
     def test_transaction(self):
         """
         api.transaction() Test plan:
@@ -909,6 +1586,60 @@ class TestServerAPI(unittest.TestCase):
         ).count().should.equal(1)
         self.disconnect_helper("plugin")
         
+    def test_response_batch(self):
+        """
+        api.response_batch() Test plan:
+            - if not connected, should return an auth_failed
+            - responses param should be a list of message_id/payload pairs, otherwise bad response
+            - found messages should get a response, in order
+            - unknown message ids should be reported as not found
+        """
+        response = self.test_client.post("/response/batch",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+        
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        response = self.test_client.post("/response/batch",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: responses')
+        response = self.test_client.post("/response/batch",data = json.dumps({"responses":[{"message_id":"1"}]}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: responses[0].payload')
+        self.disconnect_helper("plugin")
+        
+        self.connect_helper("tutor")
+        message_ids = []
+        for i in range(0, 2):
+            response = self.test_client.post("/message",data = json.dumps({"name":"test","payload":{"test":"test"}}),content_type="application/json")
+            message_ids.append(json.loads(response.get_data().decode('utf-8'))["message_id"])
+        self.disconnect_helper("tutor")
+        
+        self.connect_helper("plugin")
+        self.test_client.get("/plugin/message/list")
+        response = self.test_client.post("/response/batch",data = json.dumps({"responses":[
+            {"message_id":message_ids[1],"payload":{"response":"second"}},
+            {"message_id":str(ObjectId()),"payload":{"response":"missing"}},
+            {"message_id":"bogus","payload":{"response":"bogus"}},
+            {"message_id":message_ids[0],"payload":{"response":"first"}},
+        ]}),content_type="application/json")
+        result = json.loads(response.get_data().decode('utf-8'))["responses"]
+        
+        result[0]["message_id"].should.equal(message_ids[1])
+        result[0].should.have.key("response_id")
+        result[1]["error"].should.equal("not found")
+        result[2]["error"].should.equal("not found")
+        result[3]["message_id"].should.equal(message_ids[0])
+        result[3].should.have.key("response_id")
+        
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].responses.find({
+            'receiver_entity_id':self.tutor_entity_id,
+            'sender_entity_id':self.plugin_entity_id,
+        }).count().should.equal(2)
+        client[settings.MONGO_DBNAME].sent_messages_and_transactions.find({
+            'time_responded':{'$exists':True},
+        }).count().should.equal(2)
+        
+        self.disconnect_helper("plugin")
+        
     def test_response_list(self):
         """
         api.response_list() Test plan:
@@ -993,6 +1724,24 @@ class TestServerAPI(unittest.TestCase):
         
             c.post("/disconnect",data = json.dumps({"entity_id":self.plugin_entity_id,"api_key":self.plugin_secret_key}),content_type="application/json")
         
+    def test_response_list_wait(self):
+        """
+        api.response_list() long-polling:
+            - a malformed wait should return a bad parameter response
+            - with nothing queued, should wait and return an empty list
+        """
+        self.connect_helper("tutor")
+        
+        response = self.test_client.get("/response/list?wait=bogus")
+        response.data.should.contain(b'Missing parameter:')
+        
+        start = datetime.now()
+        response = self.test_client.get("/response/list?wait=0.2")
+        json.loads(response.get_data().decode('utf-8'))["responses"].should.equal([])
+        (datetime.now() - start).should.be.greater_than(timedelta(seconds=0.2))
+        
+        self.disconnect_helper("tutor")
+        
     def test_response_list_auth_required(self):
         """
         api.response_list() auth required():
@@ -1150,6 +1899,72 @@ class TestServerAPI(unittest.TestCase):
         MessageAuth.query.filter_by(message_name="test",entity_id="123",is_owner=False).first().should_not.equal(None)
         MessageAuth.query.filter_by(message_name="test",entity_id="456",is_owner=False).first().should_not.equal(None)
         
+    def test_share_messages(self):
+        """
+        api.share_messages() Test plan:
+            - no entity_id in session, should return auth failed
+            - shared_messages missing or not an object, should return bad parameter
+            - if entity_id does not own some of the messages, should return error naming them and share the rest
+            - if entity_id owns them all, should add auth for each message and other entity id once
+        """
+        response = self.test_client.post("/share-messages",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+        
+        for message_name in ["test", "test2"]:
+            ma = MessageAuth()
+            ma.entity_id  = str(self.plugin_entity_id)
+            ma.message_name = message_name
+            ma.is_owner = True
+            db.session.add(ma)
+        db.session.commit()
+        
+        self.connect_helper("plugin")
+        
+        response = self.test_client.post("/share-messages",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: shared_messages')
+        
+        response = self.test_client.post("/share-messages",data = json.dumps({"shared_messages":{"test":3}}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: shared_messages.test')
+        
+        response = self.test_client.post("/share-messages",data = json.dumps({"shared_messages":{"test":["789"],"other":["789"]}}),content_type="application/json")
+        json.loads(response.data.decode('utf-8')).should.equal({"error":"not owner","message_names":["other"]})
+        MessageAuth.query.filter_by(message_name="test",entity_id="789").count().should.equal(1)
+        MessageAuth.query.filter_by(message_name="other",entity_id="789").count().should.equal(0)
+        
+        response = self.test_client.post("/share-messages",data = json.dumps({"shared_messages":{"test":["123","456"],"test2":"123"}}),content_type="application/json")
+        response.data.should.contain(b"OK")
+        
+        response = self.test_client.post("/share-messages",data = json.dumps({"shared_messages":{"test":["123"]}}),content_type="application/json")
+        response.data.should.contain(b"OK")
+        
+        MessageAuth.query.filter_by(message_name="test",entity_id="123",is_owner=False).count().should.equal(1)
+        MessageAuth.query.filter_by(message_name="test",entity_id="456",is_owner=False).count().should.equal(1)
+        MessageAuth.query.filter_by(message_name="test2",entity_id="123",is_owner=False).count().should.equal(1)
+        
+    def test_message_auth_cache(self):
+        """
+        api message authorization cache:
+            - message_owner should not query the database once the cache is built
+            - subscribing to a new message should invalidate the cache
+        """
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        
+        response = self.test_client.get("/message-owner/test")
+        response.data.should.contain(self.plugin_entity_id.encode('utf-8'))
+        
+        with patch.object(db.session, 'query') as mock_query:
+            response = self.test_client.get("/message-owner/test")
+            mock_query.called.should.equal(False)
+        
+        response.data.should.contain(self.plugin_entity_id.encode('utf-8'))
+        
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test2"}),content_type="application/json")
+        response = self.test_client.get("/message-owner/test2")
+        response.data.should.contain(self.plugin_entity_id.encode('utf-8'))
+        
+        self.disconnect_helper("plugin")
+        
     def test_new_resource(self):
         """
         api.new_resource() Test plan:
@@ -1177,6 +1992,31 @@ class TestServerAPI(unittest.TestCase):
        response = self.test_client.post("/new-resource",data = json.dumps({"owner_id":"213"}),headers={'content-type': 'application/json'})
        response.data.should.contain(b'"resource_id":')
 
+    def test_new_resource_batch(self):
+        """
+        api.new_resource_batch() Test plan:
+            - if not connected, should respond auth_failed
+            - if no owner_id or a bad count, should respond with bad param
+            - otherwise, should add count owned resource auths and return their ids
+        """
+        response = self.test_client.post("/new-resource/batch",data = json.dumps({"owner_id":"213","count":2}),content_type="application/json")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+        
+        self.connect_helper("plugin")
+        
+        response = self.test_client.post("/new-resource/batch",data = json.dumps({"count":2}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: owner_id')
+        
+        response = self.test_client.post("/new-resource/batch",data = json.dumps({"owner_id":"213","count":0}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: count')
+        
+        response = self.test_client.post("/new-resource/batch",data = json.dumps({"owner_id":"213","count":3}),content_type="application/json")
+        resource_ids = json.loads(response.get_data().decode('utf-8'))['resource_ids']
+        len(set(resource_ids)).should.equal(3)
+        
+        for resource_id in resource_ids:
+            ResourceAuth.query.filter_by(entity_id="213",resource_id=resource_id,is_owner=True).first().should_not.equal(None)
+
     def test_share_resource(self):
         """
         api.share_resource() Test plan:
@@ -1251,12 +2091,46 @@ class TestServerAPI(unittest.TestCase):
         
         ResourceAuth.query.filter_by(entity_id="4",resource_id="123",is_owner=False).first().should_not.equal(None)
         ResourceAuth.query.filter_by(entity_id="5",resource_id="123",is_owner=False).first().should_not.equal(None)
+
+    def test_ping(self):
+        """
+        api.ping():
+            - should only be accessible by a connected entity
+            - should record the heartbeat in memory without touching the database
+            - a flush should write the heartbeats to the plugin table
+            - any request after the flush interval should flush the pending heartbeats
+        """
+        from hpit.server.heartbeats import HeartbeatStore
+        heartbeats = HeartbeatStore.get_instance()
+        heartbeats.flush()
         
+        response = self.test_client.post("/ping")
+        response.data.should.contain(b'Could not authenticate')
         
+        self.connect_helper("plugin")
         
+        last_polled = datetime.now() - timedelta(days=1)
+        Plugin.query.filter_by(entity_id=self.plugin_entity_id).update({'time_last_polled': last_polled})
+        db.session.commit()
         
+        with patch('hpit.server.heartbeats.HEARTBEAT_FLUSH_INTERVAL', 60):
+            response = self.test_client.post("/ping")
+        response.data.should.contain(b'OK')
         
+        heartbeats.pending.should.have.key(self.plugin_entity_id)
+        Plugin.query.filter_by(entity_id=self.plugin_entity_id).first().time_last_polled.should.equal(last_polled)
         
+        heartbeats.flush()
+        db.session.expire_all()
+        heartbeats.pending.shouldnt.have.key(self.plugin_entity_id)
+        Plugin.query.filter_by(entity_id=self.plugin_entity_id).first().time_last_polled.should.be.greater_than(last_polled)
         
+        with patch('hpit.server.heartbeats.HEARTBEAT_FLUSH_INTERVAL', 60):
+            self.test_client.post("/ping")
+        heartbeats.pending.should.have.key(self.plugin_entity_id)
         
+        with patch('hpit.server.heartbeats.HEARTBEAT_FLUSH_INTERVAL', 0):
+            self.test_client.get("/log/list")
+        heartbeats.pending.shouldnt.have.key(self.plugin_entity_id)
         
+        self.disconnect_helper("plugin")
@@ -0,0 +1,132 @@
+import sure
+import unittest
+from mock import patch
+
+from hpit.management.settings_manager import SettingsManager
+settings = SettingsManager.get_server_settings()
+
+from hpit.server.app import ServerApp
+
+app_instance = ServerApp.get_instance()
+app = app_instance.app
+
+from hpit.server.views.dashboard import MessageTimes, _student_problems
+
+from pymongo import MongoClient
+from bson.objectid import ObjectId
+
+from datetime import datetime, timedelta
+
+class TestDashboard(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MongoClient()
+        self.client.drop_database(settings.MONGO_DBNAME)
+        self.db = self.client[settings.MONGO_DBNAME]
+
+    def tearDown(self):
+        self.client.drop_database(settings.MONGO_DBNAME)
+
+    def message_helper(self, created, **fields):
+        message = dict({
+            '_id': ObjectId(),
+            'message_name': "test",
+            'sender_entity_id': "tutor",
+            'time_created': created,
+            'payload': {},
+        }, **fields)
+        self.db.messages_and_transactions.insert(message)
+        return message['_id']
+
+    def sent_helper(self, message_id, received):
+        self.db.sent_messages_and_transactions.insert({
+            'message_id': message_id,
+            'sender_entity_id': "tutor",
+            'receiver_entity_id': "plugin",
+            'time_received': received,
+        })
+
+    def test_track_ancestry(self):
+        """
+        MessageTimes.track() with recorded ancestry Test plan:
+            - should return the message and its descendants, parents before children
+            - should not include unrelated messages
+            - a payload that is not an object should not break the tree
+            - should attach each message's deliveries
+        """
+        now = datetime.now()
+        root = self.message_helper(now, ancestors=[], message_name="transaction", payload=["not", "an", "object"])
+        child = self.message_helper(now + timedelta(seconds=1), ancestors=[root])
+        grandchild = self.message_helper(now + timedelta(seconds=2), ancestors=[root, child])
+        sibling = self.message_helper(now + timedelta(seconds=3), ancestors=[root])
+        self.message_helper(now, ancestors=[])
+
+        self.sent_helper(root, now + timedelta(seconds=1))
+        self.sent_helper(child, now + timedelta(seconds=2))
+
+        with app.app_context():
+            tracked = MessageTimes.track(str(root))
+
+        [t.message_id for t in tracked].should.equal([str(root), str(child), str(grandchild), str(sibling)])
+        [len(t.plugin_communications) for t in tracked].should.equal([1, 1, 0, 0])
+
+    def test_track_legacy(self):
+        """
+        MessageTimes.track() without recorded ancestry Test plan:
+            - should walk the tree through payload._seed_message_id a level at a time
+            - should return parents before children
+        """
+        now = datetime.now()
+        root = self.message_helper(now)
+        child = self.message_helper(now + timedelta(seconds=1), payload={'_seed_message_id': str(root)})
+        grandchild = self.message_helper(now + timedelta(seconds=2), payload={'_seed_message_id': str(child)})
+        self.message_helper(now, payload={'_seed_message_id': str(ObjectId())})
+
+        with app.app_context():
+            tracked = MessageTimes.track(str(root))
+
+        [t.message_id for t in tracked].should.equal([str(root), str(child), str(grandchild)])
+
+    def test_track_unknown(self):
+        """
+        MessageTimes.track() Test plan:
+            - an unknown message id should return an empty list
+        """
+        with app.app_context():
+            MessageTimes.track(str(ObjectId())).should.equal([])
+
+    def test_student_problems(self):
+        """
+        _student_problems() Test plan:
+            - should return a page of the problems the student worked, most recent first
+            - should look up each problem's name, steps and skills
+            - should say whether there are more pages
+            - should not include other students' problems
+        """
+        problem_ids = self.db.hpit_problems.insert([
+            {'problem_name': "Problem " + str(i)} for i in range(0, 3)
+        ])
+        self.db.hpit_steps.insert([
+            {'problem_id': problem_ids[0], 'skill_names': ["addition"]},
+            {'problem_id': problem_ids[0], 'skill_names': ["subtraction"]},
+            {'problem_id': problem_ids[2], 'skill_names': []},
+        ])
+        for problem_id in problem_ids:
+            self.db.hpit_problems_worked.insert({'student_id': "student", 'problem_id': problem_id})
+        self.db.hpit_problems_worked.insert({'student_id': "other", 'problem_id': problem_ids[1]})
+
+        with patch('hpit.server.views.dashboard.STUDENT_MONITOR_PAGE_SIZE', 2):
+            problems, more = _student_problems(self.db, "student", 0)
+            [p['problem_name'] for p in problems].should.equal(["Problem 2", "Problem 1"])
+            [p['number_of_steps'] for p in problems].should.equal([1, 0])
+            more.should.equal(True)
+
+            problems, more = _student_problems(self.db, "student", 1)
+            [p['problem_name'] for p in problems].should.equal(["Problem 0"])
+            problems[0]['number_of_steps'].should.equal(2)
+            problems[0]['skills_involved'].should.equal(["addition", "subtraction"])
+            more.should.equal(False)
+
+            problems, more = _student_problems(self.db, "student", 2)
+            problems.should.equal([])
+            more.should.equal(False)